@@ -1,15 +1,186 @@
-from flask import Flask, render_template, request, session, redirect
+from flask import Flask, Response, g, render_template, stream_template, request, session, redirect, jsonify, abort
+from flask import before_render_template, template_rendered
+from auth import require_login, require_member, require_admin
+import assets
+import auth
+import cache
 import db
+import events
+import metrics
+import models
+import purge
+from passwords import HashingBusy
+import create_db
 from dotenv import load_dotenv
+from werkzeug.middleware.proxy_fix import ProxyFix
+import hashlib
 import os
 
 # Main Flask application with routing and session management
 
 load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env'))
 
+# Create the database or migrate it to the latest schema
+create_db.create_db(db.db_path)
+
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY')
 
+# Number of reverse proxies in front of the app, serve.py assumes one. Their X-Forwarded-For entries are trusted for
+# the client address. Every request reaches the app from a proxy on this machine, so /metrics then needs METRICS_TOKEN
+PROXY_HOPS = int(os.getenv('PROXY_HOPS', 0))
+if PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS)
+
+# Fingerprint and compress the stylesheets and scripts. With ASSETS_BUILD=0 the files built ahead of time by
+# `python assets.py` are used instead, for deployments where the static folder is read-only
+if os.getenv('ASSETS_BUILD', '1') == '1':
+    assets.build()
+else:
+    assets.load()
+app.add_template_global(assets.asset_url)
+
+# Time every request and split it into db, model and template phases. Registered first so it covers the other hooks
+app.before_request(metrics.start_request)
+app.after_request(metrics.finish_request)
+before_render_template.connect(metrics.template_started, app)
+template_rendered.connect(metrics.template_finished, app)
+
+# Resolve the logged-in user and their project role once per request
+app.before_request(auth.load_identity)
+
+# Return each request's pooled database connection when the request ends
+app.teardown_appcontext(db.close_connection)
+
+# Remove the rows of deleted projects in the background
+if os.getenv('PURGE_IN_BACKGROUND', '1') == '1':
+    purge.purger.start()
+
+# How long an idle event stream or long-poll request waits before sending a heartbeat or an empty response
+EVENT_TIMEOUT = float(os.getenv('EVENT_TIMEOUT', 25))
+
+# Project pages are sent while they render, so the top of the page arrives before the task board and messages are read
+STREAM_PAGES = os.getenv('STREAM_PAGES', '1') == '1'
+
+# Least number of characters sent at once when a page is streamed, apart from the flush points in the template
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', 16384))
+
+# Bearer token required to read /metrics. Without one, only requests from this machine are answered, and none at all
+# behind a proxy (PROXY_HOPS)
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+# Most tasks that can be created by one request to the task API or the import form
+MAX_BULK_TASKS = int(os.getenv('MAX_BULK_TASKS', 500))
+
+# Search hits returned per page by default, and the most a client may ask for
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', 20))
+MAX_SEARCH_PAGE_SIZE = 100
+
+def _release():
+    # Digest of the templates and asset names, so browsers revalidating a page after a deploy get the new markup
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(repr(sorted(assets.manifest.items())).encode())
+    folder = os.path.join(app.root_path, app.template_folder)
+    for name in sorted(os.listdir(folder)):
+        with open(os.path.join(folder, name), 'rb') as template:
+            digest.update(template.read())
+    return digest.hexdigest()
+
+# Part of every ETag. Set RELEASE to tag responses with a deploy identifier instead
+RELEASE = os.getenv('RELEASE') or _release()
+
+def make_etag(*parts):
+    '''Build a strong ETag from the values a response is derived from, e.g. a version number and the viewer.'''
+    return hashlib.blake2b(repr((RELEASE,) + parts).encode(), digest_size=12).hexdigest()
+
+def not_modified(etag):
+    '''Return a 304 response if the client's If-None-Match already has `etag`, otherwise None.'''
+    if request.if_none_match.contains_weak(etag):
+        return with_etag(Response(status=304), etag)
+    return None
+
+def with_etag(response, etag):
+    '''Tag a response and make browsers revalidate it on every use instead of reusing it blindly.'''
+    response = app.make_response(response)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def coalesce(pieces, size=STREAM_CHUNK_SIZE):
+    '''Join the many small pieces a streamed template yields into chunks of at least `size` characters.
+
+    An empty piece, which templates produce with {{ flush }}, sends what is buffered right away.
+    '''
+    buffer, buffered = [], 0
+    for piece in pieces:
+        if piece:
+            buffer.append(piece)
+            buffered += len(piece)
+            if buffered < size:
+                continue
+        if buffer:
+            yield ''.join(buffer)
+            buffer, buffered = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+def wants_json():
+    '''Check whether the client asked for a JSON response instead of a redirect.'''
+    return request.accept_mimetypes.best == 'application/json'
+
+def json_response(value, status=200):
+    '''Stream models, or dictionaries and lists of them, as a JSON response.'''
+    return Response(models.stream_json(value), status=status, mimetype='application/json')
+
+def json_error(status, message):
+    '''Build a JSON error response for the API endpoints.'''
+    return jsonify(error=message), status
+
+def publish_added(project_id, tasks):
+    '''Tell the project's members about new tasks, with one event however many were created.'''
+    if len(tasks) == 1:
+        events.broker.publish(project_id, 'task', {'action': 'added', 'task': tasks[0]})
+    else:
+        events.broker.publish(project_id, 'task', {'action': 'added', 'tasks': tasks})
+
+def load_project_data(project_id, view, key):
+    '''Read a project page's task board and messages lazily, as the template renders them.
+
+    Returns the task board as an iterator of JSON chunks and a function returning (messages, has_more). The page data
+    is cached under `key` once both have been read.
+    '''
+    chunks = []
+    caching = cache.cache.max_bytes > 0  # Don't keep the task board around for a cache that is turned off
+
+    def tasks():
+        for chunk in models.stream_json(db.iter_project_tasks(project_id)):
+            if caching:
+                chunks.append(chunk)
+            yield chunk
+
+    def message_page():
+        messages, has_more = db.get_message_page(project_id, timezone=view['timezone'], archived=view['archived_messages'])
+        if caching:
+            cache.cache.set(key, {**view, 'tasks': ''.join(chunks), 'messages': messages, 'has_more_messages': has_more})
+        return messages, has_more
+
+    return tasks(), message_page
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    '''Serve a fingerprinted static file. Its name changes with its content, so browsers may cache it for good.'''
+    return assets.send(filename, request.accept_encodings)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    '''Expose request and query metrics in the Prometheus text format.'''
+    if METRICS_TOKEN:
+        if request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+            abort(401)
+    elif PROXY_HOPS or request.remote_addr not in ('127.0.0.1', '::1'):
+        abort(403)  # A proxy that doesn't forward the client address would make every request look local
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def home():
     '''Landing page with login and registration options.'''
@@ -27,7 +198,10 @@ def register():
     password = request.form['password']
     
     # Call the register_user function from db.py
-    register = db.register_user(username, password)
+    try:
+        register = db.register_user(username, password)
+    except HashingBusy:
+        return render_template('register.html', busy=True), 503
 
     if not register:
         return go_to_register(True)
@@ -41,7 +215,10 @@ def login():
     password = request.form['password']
     
     # Call the login_user function from db.py
-    user = db.login_user(username, password)
+    try:
+        user = db.login_user(username, password)
+    except HashingBusy:
+        return render_template('login.html', busy=True), 503
 
     if not user:
         return render_template('login.html', error=True)
@@ -50,69 +227,261 @@ def login():
         return redirect('/dashboard')
 
 @app.route('/dashboard')
+@require_login
 def dashboard():
-    '''Display the user's dashboard with their projects.'''
-    if not session.get('user_id'):
-        return redirect('/')
-    
-    user = db.get_user(session.get('user_id'))
-    if not user:
-        return redirect('/')
-    
-    # Fetch user projects
-    projects = db.get_user_projects(user.user_id)
-    
-    return render_template('dashboard.html', username=user.username, projects=projects)
+    '''Display the user's dashboard with a summary of each of their projects.'''
+    projects = db.get_dashboard(g.user.user_id)
+
+    # Every change to a project's counters comes with a version bump, reading its messages moves the unread count
+    etag = make_etag('dashboard', g.user.user_id, g.user.version,
+                     [(project.project_id, project.version, project.unread_count) for project in projects])
+    response = not_modified(etag)
+    if response:
+        return response
+
+    def render():
+        return render_template('dashboard.html', username=g.user.username, projects=projects,
+                               statuses=models.TASK_STATUSES, timezone=g.user.timezone)
+
+    # The release is part of the key because a shared cache outlives deploys
+    return with_etag(cache.get_or_build(f'dashboard:{RELEASE}:{g.user.user_id}:{etag}', render), etag)
+
+@app.route('/set_timezone', methods=['POST'])
+@require_login
+def set_timezone():
+    '''Handle changing the time zone messages are displayed in.'''
+    timezone = request.form['timezone'].strip()
+    if models.is_valid_timezone(timezone):
+        db.set_user_timezone(g.user.user_id, timezone)
+
+    return redirect('/dashboard')
 
 @app.route('/project/<int:project_id>')
+@require_member
 def project(project_id):
     '''Display the project page with tasks and messages.'''
-    if not session.get('user_id'):
-        return redirect('/')
-    
-    user = db.get_user(session.get('user_id'))
-    if not user:
-        return redirect('/')
-    
-    # Fetch user projects
-    projects = db.get_user_projects(user.user_id)
-
-    # Fetch project name
-    project = db.get_project_name(project_id)
-    if not project:
-        return redirect('/dashboard')
-    
-    # Fetch tasks for the project
-    tasks = db.get_project_tasks(project_id)
-
-    tasks = [task.to_dict() for task in tasks]
-    for task in tasks:
-        task["assigned_members"] = db.get_task_assignees(task['task_id'])
-
-    # Fetch project users
-    users = db.get_project_users(project_id)
-
-    if user.username not in [member.username for member in users]:
-        return redirect('/dashboard')
-
-    # Fetch messages
-    messages = db.get_project_messages(project_id)
-    messages.sort(key=lambda x: x.date_time)
-    messages = [i.to_dict() for i in messages]
-    for message in messages:
-        message['sender_name'] = db.get_user(message['user_id']).username
-    
-    return render_template('project.html', isAdmin=db.is_admin(user.user_id, project_id), username=user.username, projects=projects, project_id=project_id, project_name=project, tasks=tasks, members=[member.username for member in users], messages=messages)
+    # Read before the version so no event published while the page loads is missed
+    last_event_id = events.broker.last_event_id(project_id)
+
+    # The page is determined by the project's version and who is viewing it. A copy the browser already has stays
+    # valid along with the event ID it embeds, because every event comes with a version bump, unless the broker
+    # was replaced and its IDs started over
+    def etag(version):
+        return make_etag('project', project_id, version, g.user.user_id, g.user.version, g.role, events.broker.epoch)
+
+    version = db.get_project_version(project_id)
+    response = not_modified(etag(version))
+    if response:
+        return response
+
+    # Reuse the page data while neither the project nor the viewer changed
+    def key(version):
+        return f'project:{project_id}:{version}:{g.user.user_id}:{g.user.version}:{g.role}'
+
+    view = cache.cache.get(key(version))
+    if view is not None:
+        tasks, message_page = [view['tasks']], lambda: (view['messages'], view['has_more_messages'])
+    else:
+        # Fetch the user, projects and members now, the task board and messages as the template reaches them
+        # Returns None if the project doesn't exist or the user is not a member
+        view = db.load_project_header(project_id, g.user.user_id)
+        if not view:
+            return redirect('/dashboard')
+        tasks, message_page = load_project_data(project_id, view, key(view['version']))
+
+        # The page shows the newest messages. A cached view means this user already loaded this version
+        if view['messages_read'] < view['message_count']:
+            db.mark_project_read(project_id, g.user.user_id, view['message_count'])
+
+    context = dict(isAdmin=view['role'] == 'admin', username=view['username'], projects=view['projects'], project_id=project_id, project_name=view['project_name'], tasks=tasks, members=view['members'], message_page=message_page, last_event_id=last_event_id, version=view['version'], timezone=view['timezone'], flush='')
+    if STREAM_PAGES:
+        page = Response(coalesce(stream_template('project.html', **context)), mimetype='text/html')
+    else:
+        page = render_template('project.html', **context)
+    return with_etag(page, etag(view['version']))
+
+@app.route('/project/<int:project_id>/messages')
+@require_member(api=True)
+def message_history(project_id):
+    '''Return a page of messages older than the before_ts/before_id cursor as JSON.'''
+    before = None
+    if request.args.get('before_ts') and request.args.get('before_id'):
+        before = (request.args['before_ts'], request.args.get('before_id', type=int))
+
+    # Messages are localized to the viewer's time zone, which is covered by their version
+    etag = make_etag('messages', project_id, db.get_project_version(project_id), before, g.user.user_id, g.user.version)
+    response = not_modified(etag)
+    if response:
+        return response
+
+    messages, has_more = db.get_message_page(project_id, before, timezone=g.user.timezone)
+    return with_etag(json_response({'messages': messages, 'has_more': has_more}), etag)
+
+@app.route('/project/<int:project_id>/read', methods=['POST'])
+@require_member(api=True)
+def mark_read(project_id):
+    '''Mark every message of a project as read, for messages that arrived while the page was open.'''
+    db.mark_project_read(project_id, g.user.user_id)
+    return '', 204
+
+@app.route('/project/<int:project_id>/search')
+@require_member(api=True)
+def search_project(project_id):
+    '''Full-text search a project's messages (type=messages, the default) or tasks (type=tasks) for ?q=.
+
+    All words must match, a word ending in * matches as a prefix. Hits are ranked best first and paged with ?offset=
+    and ?limit=. The response includes the offset of the next page, or null on the last page.
+    '''
+    text = request.args.get('q', '').strip()
+    if not text:
+        return json_error(400, 'q is required')
+    kind = request.args.get('type', 'messages')
+    if kind not in ('messages', 'tasks'):
+        return json_error(400, 'type must be messages or tasks')
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = min(max(1, request.args.get('limit', SEARCH_PAGE_SIZE, type=int)), MAX_SEARCH_PAGE_SIZE)
+
+    etag = make_etag('search', project_id, db.get_project_version(project_id), kind, text, offset, limit,
+                     g.user.user_id, g.user.version)
+    response = not_modified(etag)
+    if response:
+        return response
+
+    if kind == 'messages':
+        hits, next_offset = db.search_messages(project_id, text, limit, offset, timezone=g.user.timezone)
+    else:
+        hits, next_offset = db.search_tasks(project_id, text, limit, offset)
+
+    return with_etag(json_response({'query': text, 'type': kind, 'hits': hits, 'next_offset': next_offset}), etag)
+
+@app.route('/project/<int:project_id>/tasks')
+@require_member(api=True)
+def get_tasks(project_id):
+    '''Return the task board as JSON. With ?since=<version> only tasks changed or deleted after that version are included.'''
+    since = request.args.get('since', type=int)
+    response = not_modified(make_etag('tasks', project_id, db.get_project_version(project_id), since))
+    if response:
+        return response
+
+    board = db.get_task_board(project_id, since)
+    if board is None:
+        return json_error(404, 'Project not found')
+    return with_etag(json_response(board), make_etag('tasks', project_id, board['version'], since))
+
+@app.route('/project/<int:project_id>/tasks', methods=['POST'])
+@require_member(api=True)
+def create_task(project_id):
+    '''Create tasks from a JSON body.
+
+    The body is one task with task_title, task_description and assigned_members, or {"tasks": [...]} with many of them.
+    All tasks are created and assigned in one transaction.
+    '''
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return json_error(400, 'Expected a JSON object')
+    bulk = isinstance(data.get('tasks'), list)
+    items = data['tasks'] if bulk else [data]
+    if not items or len(items) > MAX_BULK_TASKS:
+        return json_error(400, f'Between 1 and {MAX_BULK_TASKS} tasks can be created at once')
+
+    tasks = []
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get('task_title'), str) or not item['task_title']:
+            return json_error(400, 'task_title is required')
+        description = item.get('task_description') or ''
+        if not isinstance(description, str):
+            return json_error(400, 'task_description must be a string')
+        members = item.get('assigned_members') or []
+        if not isinstance(members, list) or not all(isinstance(member, str) for member in members):
+            return json_error(400, 'assigned_members must be a list of usernames')
+        tasks.append((item['task_title'], description, 'todo', members))
+
+    version, created = db.add_tasks(project_id, tasks)
+    created = [task.to_dict() for task in created]
+    publish_added(project_id, created)
+    if bulk:
+        return jsonify(tasks=created, version=version), 201
+    return jsonify(task=created[0], version=version), 201
+
+@app.route('/project/<int:project_id>/tasks/<int:task_id>', methods=['PATCH'])
+@require_member(api=True)
+def update_task(project_id, task_id):
+    '''Change a task's status from a JSON body with task_status.'''
+    if db.get_task_project(task_id) != project_id:
+        return json_error(404, 'Task not found')
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return json_error(400, 'Expected a JSON object')
+    status = data.get('task_status')
+    if status not in models.TASK_STATUSES:
+        return json_error(400, 'Invalid task_status')
+
+    version = db.change_task_status(task_id, status)
+    events.broker.publish(project_id, 'task', {'action': 'updated', 'task_id': task_id, 'task_status': status})
+    return jsonify(task_id=task_id, task_status=status, version=version)
+
+@app.route('/project/<int:project_id>/tasks/<int:task_id>', methods=['DELETE'])
+@require_member(api=True)
+def remove_task(project_id, task_id):
+    '''Delete a task.'''
+    if db.get_task_project(task_id) != project_id:
+        return json_error(404, 'Task not found')
+
+    version = db.delete_task(task_id)
+    events.broker.publish(project_id, 'task', {'action': 'deleted', 'task_id': task_id})
+    return jsonify(task_id=task_id, version=version)
+
+@app.route('/project/<int:project_id>/events')
+@require_member(api=True)
+def project_events(project_id):
+    '''Stream new messages and task changes for a project as Server-Sent Events.'''
+    # Don't hold a pooled connection for as long as the stream stays open
+    db.close_connection()
+
+    # Browsers send Last-Event-ID when they reconnect, so nothing published in between is missed
+    # The first connection uses ?after= with the event ID the page was rendered at
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    if last_id is None:
+        last_id = request.args.get('after', type=int)
+    if last_id is None:
+        last_id = events.broker.last_event_id(project_id)
+
+    def stream(after):
+        yield 'retry: 3000\n\n'
+        while True:
+            new_events = events.broker.wait(project_id, after, EVENT_TIMEOUT)
+            if not new_events:
+                yield ': keep-alive\n\n'  # Comment line that stops proxies closing an idle stream
+                continue
+            for event in new_events:
+                after = event.event_id
+                yield events.format_sse(event)
+
+    return Response(stream(last_id), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/project/<int:project_id>/poll')
+@require_member(api=True)
+def poll_events(project_id):
+    '''Long-poll fallback for clients without EventSource. Waits for events newer than ?after=.'''
+    db.close_connection()
+
+    after = request.args.get('after', type=int)
+    if after is None:
+        # First poll only tells the client where to start
+        return jsonify(events=[], last_event_id=events.broker.last_event_id(project_id))
+
+    new_events = events.broker.wait(project_id, after, EVENT_TIMEOUT)
+    last_id = new_events[-1].event_id if new_events else after
+    return jsonify(events=[events.to_dict(event) for event in new_events], last_event_id=last_id)
 
 @app.route('/create_project', methods=['POST'])
+@require_login
 def create_project():
     '''Handle project creation.'''
-    if not session.get('user_id'):
-        return redirect('/')
-    
     project_name = request.form['project_name']
     
-    new_id = int(db.add_project(project_name, session.get('user_id')))
+    new_id = int(db.add_project(project_name, g.user.user_id))
 
     if not new_id:
         return redirect('/dashboard')
@@ -120,18 +489,12 @@ def create_project():
         return redirect(f'/project/{new_id}')
 
 @app.route('/project/add_project_member', methods=['POST'])
+@require_admin
 def add_member():
     '''Handle adding a member to a project.'''
-    if not session.get('user_id'):
-        return redirect('/')
-    
     project_id = request.form['project_id']
     user_to_add = request.form['username']
     role = request.form['role']
-    
-    if not db.is_admin(session.get('user_id'), project_id):
-        return redirect('/dashboard')
-    
 
     user_to_add = db.get_user_by_username(user_to_add)
     if not user_to_add:
@@ -146,20 +509,15 @@ def add_member():
     return redirect(f'/project/{project_id}')
 
 @app.route('/project/remove_project_member', methods=['POST'])
+@require_admin
 def remove_member():
     '''Handle removing a member from a project.'''
-    if not session.get('user_id'):
-        return redirect('/')
-    
     project_id = request.form['project_id']
     user_to_remove = request.form['username']
     
-    if not db.is_admin(session.get('user_id'), project_id):
-        return redirect('/dashboard')
-    
     # Admin cannot remove a user if they don't exist, are not a member of the project, or are the admin themselves
     user_to_remove = db.get_user_by_username(user_to_remove)
-    if not (user_to_remove and db.is_member(user_to_remove.user_id, project_id)) or user_to_remove.user_id == session.get('user_id'):
+    if not (user_to_remove and db.is_member(user_to_remove.user_id, project_id)) or user_to_remove.user_id == g.user.user_id:
         return redirect(f'/project/{project_id}')
 
     db.remove_member_from_project(project_id, user_to_remove.user_id)
@@ -167,129 +525,112 @@ def remove_member():
     return redirect(f'/project/{project_id}')
 
 @app.route('/project/leave_project', methods=['POST'])
+@require_member
 def leave_project():
     '''Handle a user leaving a project.'''
-    if not session.get('user_id'):
-        return redirect('/')
-    
     project_id = request.form['project_id']
     
-    user = db.get_user(session.get('user_id'))
-    if not user:
-        return redirect('/dashboard')
-    
-    if db.is_admin(user.user_id, project_id):
+    # The admin can't leave their own project
+    if g.role == 'admin':
         return redirect('/dashboard')
 
-    db.remove_member_from_project(project_id, user.user_id)
+    db.remove_member_from_project(project_id, g.user.user_id)
 
     return redirect('/dashboard')
 
 @app.route('/project/delete_project', methods=['POST'])
+@require_admin
 def delete_project():
     '''Handle project deletion.'''
-    if not session.get('user_id'):
-        return redirect('/')
-    
     project_id = request.form['project_id']
-    
-    user = db.get_user(session.get('user_id'))
-    if not user:
-        return redirect('/dashboard')
-    if not db.is_admin(user.user_id, project_id):
-        return redirect('/dashboard')
 
     db.delete_project(project_id)
+    purge.purger.wake()
 
     return redirect('/dashboard')
 
 @app.route('/project/send_message', methods=['POST'])
+@require_member
 def send_message():
     '''Handle sending a message in a project.'''
-    if not session.get('user_id'):
-        return redirect('/')
-    
-    project_id = request.form['project_id']
+    project_id = request.form.get('project_id', type=int)  # Checked by require_member, so always a valid ID here
     content = request.form['message']
-    
-    user = db.get_user(session.get('user_id'))
-    if not user:
-        return redirect('/dashboard')
-    if not db.is_member(user.user_id, project_id):
-        return redirect('/dashboard')
 
-    db.add_message(content, user.user_id, project_id)
+    message = db.add_message(content, g.user.user_id, project_id)
+    message.timezone = g.user.timezone
+    message.sender_name = g.user.username
 
+    # Push the message to everyone viewing the project, each page shows it in its own viewer's time zone
+    events.broker.publish(project_id, 'message', message.to_event())
+
+    if wants_json():
+        return jsonify(message.to_dict()), 201
     return redirect(f'/project/{project_id}#messages')
 
 @app.route('/project/add_task', methods=['POST'])
+@require_member
 def add_task():
     '''Handle adding a task to a project.'''
-    if not session.get('user_id'):
-        return redirect('/')
-    
     project_id = request.form['project_id']
     task_title = request.form['task_title']
     task_description = request.form['task_description']
     task_members = request.form.getlist('assigned_members')
-    
-    user = db.get_user(session.get('user_id'))
-    if not user:
-        return redirect('/dashboard')
-    
-    if not db.is_member(user.user_id, project_id):
-        return redirect('/dashboard')
 
-    task_id = db.add_task(task_title, task_description, 'todo', project_id)
-    
-    # Assign task to selected members
-    for member in task_members:
-        member = db.get_user_by_username(member)
-        if member:
-            db.assign_task_to_user(task_id, member.user_id)
+    # Create the task and its assignments together
+    _, created = db.add_tasks(project_id, [(task_title, task_description, 'todo', task_members)])
+    publish_added(project_id, [task.to_dict() for task in created])
+
+    return redirect(f'/project/{project_id}')
+
+@app.route('/project/import_tasks', methods=['POST'])
+@require_member
+def import_tasks():
+    '''Handle adding a pasted list of tasks, one per line as "title" or "title | description".'''
+    project_id = request.form['project_id']
+    task_members = request.form.getlist('assigned_members')
+
+    tasks = []
+    for line in request.form['task_list'].splitlines():
+        task_title, _, task_description = line.partition('|')
+        if task_title.strip():
+            tasks.append((task_title.strip(), task_description.strip(), 'todo', task_members))
+
+    if tasks:
+        _, created = db.add_tasks(project_id, tasks[:MAX_BULK_TASKS])
+        publish_added(project_id, [task.to_dict() for task in created])
 
     return redirect(f'/project/{project_id}')
 
 @app.route('/project/change_status', methods=['POST'])
+@require_member
 def change_status():
     '''Handle changing the status of a task.'''
-    if not session.get('user_id'):
-        return redirect('/')
-    
-    project_id = request.form['project_id']
-    task_id = request.form['task_id']
+    project_id = request.form.get('project_id', type=int)  # Checked by require_member, so always a valid ID here
+    task_id = request.form.get('task_id', type=int)
     status = request.form['task_status']
-
-    print(project_id, task_id, status)
-    
-    user = db.get_user(session.get('user_id'))
-    if not user:
-        return redirect('/dashboard')
-    
-    if not db.is_member(user.user_id, project_id):
-        return redirect('/dashboard')
+    if task_id is None or status not in models.TASK_STATUSES:
+        abort(400)
+    if db.get_task_project(task_id) != project_id:
+        abort(404)  # Only tasks of the project the form was checked against
 
     db.change_task_status(task_id, status)
+    events.broker.publish(project_id, 'task', {'action': 'updated', 'task_id': task_id, 'task_status': status})
 
     return redirect(f'/project/{project_id}')
 
 @app.route('/project/delete_task', methods=['POST'])
+@require_member
 def delete_task():
     '''Handle deleting a task from a project.'''
-    if not session.get('user_id'):
-        return redirect('/')
-    
-    project_id = request.form['project_id']
-    task_id = request.form['task_id']
-    
-    user = db.get_user(session.get('user_id'))
-    if not user:
-        return redirect('/dashboard')
-    
-    if not db.is_member(user.user_id, project_id):
-        return redirect('/dashboard')
+    project_id = request.form.get('project_id', type=int)  # Checked by require_member, so always a valid ID here
+    task_id = request.form.get('task_id', type=int)
+    if task_id is None:
+        abort(400)
+    if db.get_task_project(task_id) != project_id:
+        abort(404)  # Only tasks of the project the form was checked against
 
     db.delete_task(task_id)
+    events.broker.publish(project_id, 'task', {'action': 'deleted', 'task_id': task_id})
 
     return redirect(f'/project/{project_id}')
 
@@ -301,4 +642,5 @@ def logout():
 
 
 if __name__ == '__main__':
+    # Werkzeug's development server. serve.py runs the app in several worker processes, asgi.py in the async mode
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,149 @@
+import json
+import mmap
+import os
+import shutil
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+# Cold storage for old chat history
+# `python archive.py` moves messages older than ARCHIVE_AFTER_DAYS out of the Message table into append-only segment
+# files, a folder per project, as zlib-compressed blocks of up to ARCHIVE_BLOCK_SIZE messages. The Message_Archive
+# table indexes every block by the (timestamp, message_id) of its first and last message, so history pages past the
+# hot messages read only the blocks they need, through a memory map of the segment (db._select_archived_messages)
+# The Message table, its indexes and backups keep only the recent history pages actually load. Archived messages stay
+# searchable through Message_Archive_fts, a contentless FTS5 index whose rowids point at a block and a position in it
+# A block's bytes are written and synced before the transaction that indexes them and deletes the messages commits.
+# A crash in between leaves unindexed bytes at the end of a segment, which are never read
+
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR')  # Defaults to an `archive` folder next to the database
+
+# Age at which messages are archived
+ARCHIVE_AFTER_DAYS = float(os.getenv('ARCHIVE_AFTER_DAYS', 180))
+
+# Positions available in a block, the low bits of an archived message's search rowid
+BLOCK_POSITIONS = 1 << 16
+
+# Messages per compressed block, the unit read back from the archive
+ARCHIVE_BLOCK_SIZE = min(int(os.getenv('ARCHIVE_BLOCK_SIZE', 256)), BLOCK_POSITIONS)
+
+# Size after which a project's next blocks go to a new segment file
+ARCHIVE_SEGMENT_BYTES = int(os.getenv('ARCHIVE_SEGMENT_BYTES', 64 * 1024 * 1024))
+
+# Messages moved per transaction, the writer is held for the time it takes to delete them
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', 2000))
+
+# Segments kept memory-mapped at once
+MAX_MAPPED_SEGMENTS = 64
+
+_maps = OrderedDict()  # Segment path -> mmap, least recently used first
+_maps_lock = threading.Lock()
+
+def directory(db_path):
+    '''Folder holding the archive of the database at `db_path`.'''
+    return ARCHIVE_DIR or os.path.join(os.path.dirname(os.path.abspath(db_path)), 'archive')
+
+def segment_path(archive_dir, project_id, segment):
+    return os.path.join(archive_dir, str(int(project_id)), f'{segment:06d}.seg')
+
+def search_rowid(block_id, position):
+    '''Rowid in Message_Archive_fts of the message at `position` in a block.'''
+    return block_id * BLOCK_POSITIONS + position
+
+def append(archive_dir, project_id, segment, rows, block_size=ARCHIVE_BLOCK_SIZE):
+    '''Append (message_id, content, sender_id, timestamp) rows, oldest first, as compressed blocks.
+
+    Starts with `segment` and moves on to a new segment once it is full. Returns (segment, offset, length, first row,
+    last row, number of rows) for every block written.
+    '''
+    os.makedirs(os.path.dirname(segment_path(archive_dir, project_id, segment)), exist_ok=True)
+    written = []
+    output = None
+    try:
+        for start in range(0, len(rows), block_size):
+            block = rows[start:start + block_size]
+            data = zlib.compress(json.dumps(block, separators=(',', ':')).encode(), 6)
+            while output is None or output.tell() >= ARCHIVE_SEGMENT_BYTES:
+                if output is not None:
+                    _sync(output)
+                    output.close()
+                    segment += 1
+                output = open(segment_path(archive_dir, project_id, segment), 'ab')
+            written.append((segment, output.tell(), len(data), block[0], block[-1], len(block)))
+            output.write(data)
+        if output is not None:
+            _sync(output)
+    finally:
+        if output is not None:
+            output.close()
+    return written
+
+def _sync(output):
+    output.flush()
+    os.fsync(output.fileno())
+
+def read_block(path, offset, length):
+    '''Read one block back as a list of (message_id, content, sender_id, timestamp) rows, oldest first.'''
+    with _maps_lock:
+        mapped = _maps.get(path)
+        if mapped is None or offset + length > len(mapped):
+            # Not mapped yet, or mapped before the segment grew
+            with open(path, 'rb') as segment:
+                mapped = _maps[path] = mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ)
+            while len(_maps) > MAX_MAPPED_SEGMENTS:
+                _maps.popitem(last=False)  # Unmapped once no reader holds it any more
+        _maps.move_to_end(path)
+    return json.loads(zlib.decompress(mapped[offset:offset + length]))
+
+def remove_project(archive_dir, project_id):
+    '''Delete a purged project's segments.'''
+    folder = os.path.dirname(segment_path(archive_dir, project_id, 0))
+    with _maps_lock:
+        for path in [path for path in _maps if os.path.dirname(path) == folder]:
+            del _maps[path]
+    shutil.rmtree(folder, ignore_errors=True)
+
+def archive_all(days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE):
+    '''Archive the messages older than `days` days in every project. Returns {project_id: messages moved}.'''
+    import db  # db reads the archive, so it imports this module and not the other way round
+
+    cutoff = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - days * 86400))
+    moved = {}
+    for project_id in db.get_archivable_projects(cutoff):
+        while True:
+            count = db.archive_messages(project_id, cutoff, batch_size)
+            if not count:
+                break
+            moved[project_id] = moved.get(project_id, 0) + count
+    return moved
+
+if __name__ == '__main__':
+    import argparse
+    import sqlite3
+    import create_db
+    import db
+
+    parser = argparse.ArgumentParser(description='Move old messages from the database into the archive.')
+    parser.add_argument('--days', type=float, default=ARCHIVE_AFTER_DAYS, help='archive messages older than this')
+    parser.add_argument('--vacuum', action='store_true', help='rebuild the database file afterwards to shrink it')
+    args = parser.parse_args()
+
+    create_db.create_db(db.db_path)
+    size_before = os.path.getsize(db.db_path)
+    moved = archive_all(args.days)
+    db.writer.close()
+
+    if args.vacuum:
+        # VACUUM needs a connection of its own outside any transaction, it waits for the write lock like any writer
+        conn = sqlite3.connect(db.db_path, timeout=60)
+        conn.execute('VACUUM')
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        conn.close()
+
+    print(json.dumps({
+        'messages_archived': sum(moved.values()),
+        'projects': len(moved),
+        'database_bytes_before': size_before,
+        'database_bytes_after': os.path.getsize(db.db_path),
+    }, indent=2))
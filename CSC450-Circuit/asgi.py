@@ -0,0 +1,236 @@
+import asyncio
+import io
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+from flask import g
+from werkzeug.exceptions import HTTPException
+import auth
+import db
+import events
+from app import app, EVENT_TIMEOUT
+
+# Async serving mode: an ASGI application around the Flask app
+# `python app.py` (or any WSGI server) gives every connection its own thread for as long as it stays open, so a few
+# hundred idle event streams use up the threads long before the CPU. Here the connections are coroutines on one event
+# loop. The event stream and long-poll routes are handled on the loop and only go to a thread for their short database
+# reads, and every other route runs the unchanged Flask view on a bounded pool of DB_WORKERS threads
+# Run it with any ASGI server, e.g. `uvicorn asgi:application`, or `python asgi.py` when uvicorn is installed
+
+# Threads running database work and Flask views. More than the connection pool would only queue for connections
+DB_WORKERS = int(os.getenv('ASYNC_DB_WORKERS', db.POOL_SIZE))
+
+executor = ThreadPoolExecutor(DB_WORKERS, thread_name_prefix='db')
+
+async def run(function, *args):
+    '''Run a blocking function on the database executor and wait for it without blocking the event loop.'''
+    return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+def to_environ(scope, body):
+    '''Build the WSGI environ for an ASGI HTTP request.'''
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': (scope.get('client') or ('127.0.0.1', 0))[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = name if name == 'CONTENT_TYPE' else f'HTTP_{name}'
+        if key in environ:
+            value = f"{environ[key]}{'; ' if name == 'COOKIE' else ','}{value}"
+        environ[key] = value
+    return environ
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+def _call_flask(environ, loop, queue):
+    # Runs on the executor. The response is handed to the event loop chunk by chunk, so a streamed page still
+    # streams, and the thread is free again as soon as the page is rendered, however slowly the client reads it
+    def put(item):
+        loop.call_soon_threadsafe(queue.put_nowait, item)
+
+    def start_response(status, headers, exc_info=None):
+        put((int(status.split(' ', 1)[0]), headers))
+        return put
+
+    try:
+        body = app(environ, start_response)
+        try:
+            for chunk in body:
+                if chunk:
+                    put(chunk)
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+    except BaseException as error:
+        put(error)
+    put(None)
+
+async def send_start(send, status, headers):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+
+async def flask_view(scope, receive, send):
+    '''Serve a request with the Flask app on the executor.'''
+    body = await read_body(receive)
+    if body is None:
+        return
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    loop.run_in_executor(executor, _call_flask, to_environ(scope, body), loop, queue)
+
+    started = False
+    while True:
+        item = await queue.get()
+        if isinstance(item, BaseException):
+            raise item
+        if item is None:
+            break
+        if isinstance(item, tuple):
+            await send_start(send, *item)
+            started = True
+        else:
+            await send({'type': 'http.response.body', 'body': item, 'more_body': True})
+    if started:
+        await send({'type': 'http.response.body', 'body': b''})
+
+def _authorize(environ):
+    # The same session and membership checks as @require_member(api=True). Returns an error status or None
+    with app.request_context(environ):
+        auth.load_identity()
+        if g.user is None:
+            return 401
+        if g.role is None:
+            return 403
+        return None
+
+async def send_json(send, value, status=200):
+    await send_start(send, status, [('Content-Type', 'application/json')])
+    await send({'type': 'http.response.body', 'body': json.dumps(value).encode()})
+
+def to_int(value):
+    # Like Flask's `type=int`: None when the value is missing or not a number
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+async def project_events(scope, receive, send, environ, project_id, query):
+    '''Async version of the /project/<id>/events Server-Sent Events stream.'''
+    # Browsers send Last-Event-ID when they reconnect, the first connection uses ?after=
+    after = to_int(environ.get('HTTP_LAST_EVENT_ID'))
+    if after is None:
+        after = to_int(query.get('after'))
+    if after is None:
+        after = await run(events.broker.last_event_id, project_id)
+
+    await send_start(send, 200, [('Content-Type', 'text/event-stream; charset=utf-8'), ('Cache-Control', 'no-cache'),
+                                 ('X-Accel-Buffering', 'no')])
+    await send({'type': 'http.response.body', 'body': b'retry: 3000\n\n', 'more_body': True})
+
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        while True:
+            waiting = asyncio.ensure_future(events.broker.wait_async(project_id, after, EVENT_TIMEOUT, executor))
+            await asyncio.wait({waiting, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():
+                waiting.cancel()
+                return
+            new_events = waiting.result()
+            if not new_events:
+                frames = ': keep-alive\n\n'  # Comment line that stops proxies closing an idle stream
+            else:
+                after = new_events[-1].event_id
+                frames = ''.join(events.format_sse(event) for event in new_events)
+            await send({'type': 'http.response.body', 'body': frames.encode(), 'more_body': True})
+    finally:
+        disconnected.cancel()
+
+async def poll_events(scope, receive, send, environ, project_id, query):
+    '''Async version of the /project/<id>/poll long-poll.'''
+    after = to_int(query.get('after'))
+    if after is None:
+        # First poll only tells the client where to start
+        await send_json(send, {'events': [], 'last_event_id': await run(events.broker.last_event_id, project_id)})
+        return
+
+    new_events = await events.broker.wait_async(project_id, after, EVENT_TIMEOUT, executor)
+    last_id = new_events[-1].event_id if new_events else after
+    await send_json(send, {'events': [events.to_dict(event) for event in new_events], 'last_event_id': last_id})
+
+# Flask endpoints handled on the event loop instead of by their views. Both mostly wait
+NATIVE = {
+    'project_events': project_events,
+    'poll_events': poll_events,
+}
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            executor.shutdown(wait=False, cancel_futures=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    '''ASGI entry point.'''
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    # Match against the Flask routes so both modes serve the same URLs
+    try:
+        endpoint, view_args = app.url_map.bind('').match(scope['path'], scope['method'])
+    except HTTPException:
+        endpoint, view_args = None, {}
+    if endpoint not in NATIVE:
+        return await flask_view(scope, receive, send)
+
+    environ = to_environ(scope, b'')
+    status = await run(_authorize, environ)
+    if status is not None:
+        return await send_json(send, {'error': 'Not logged in' if status == 401 else 'Forbidden'}, status)
+
+    query = dict(parse_qsl(environ['QUERY_STRING']))
+    await NATIVE[endpoint](scope, receive, send, environ, view_args['project_id'], query)
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit('The async mode needs an ASGI server: pip install uvicorn, or point another server at asgi:application')
+    uvicorn.run(application, host=os.getenv('HOST', '127.0.0.1'), port=int(os.getenv('PORT', 8000)))
@@ -0,0 +1,109 @@
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+from flask import send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Fingerprinted, precompressed copies of the static files
+# build() copies every stylesheet and script into static/dist under a name that includes a hash of its content, next
+# to .gz and, when the brotli package is installed, .br variants. Templates link them with asset_url(), so a changed
+# file gets a new URL and browsers can keep every version forever without revalidating
+# Old versions are left in place, pages rendered before a deploy may still link them
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+
+# File types that are fingerprinted and compressed
+EXTENSIONS = ('.css', '.js')
+
+# Served with every fingerprinted file
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+logger = logging.getLogger('circuit.assets')
+
+# Original name (e.g. css/main.css) -> fingerprinted name (e.g. css/main.1a2b3c4d5e.css), filled by build()
+manifest = {}
+
+def _write(path, data):
+    # Write through a temporary file so another worker building at the same time never serves half a file
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'wb') as output:
+        output.write(data)
+    os.replace(temporary, path)
+
+def build(static_dir=STATIC_DIR, dist_dir=DIST_DIR):
+    '''Fingerprint and compress the static files into `dist_dir`. Returns the manifest.'''
+    built = {}
+    for folder, subfolders, files in os.walk(static_dir):
+        if os.path.abspath(folder) == os.path.abspath(dist_dir):
+            subfolders[:] = []
+            continue
+        for name in sorted(files):
+            stem, extension = os.path.splitext(name)
+            if extension not in EXTENSIONS:
+                continue
+            source = os.path.join(folder, name)
+            with open(source, 'rb') as original:
+                data = original.read()
+
+            relative = os.path.relpath(source, static_dir).replace(os.sep, '/')
+            fingerprinted = f'{relative[:-len(name)]}{stem}.{hashlib.sha256(data).hexdigest()[:10]}{extension}'
+            built[relative] = fingerprinted
+
+            target = os.path.join(dist_dir, fingerprinted)
+            if os.path.exists(target):
+                continue  # Same name, same content
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            _write(target + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+            if brotli is not None:
+                _write(target + '.br', brotli.compress(data, quality=11))
+            _write(target, data)  # Last, its presence means the variants are there too
+
+    _write(os.path.join(dist_dir, 'manifest.json'), json.dumps(built, indent=2, sort_keys=True).encode())
+    manifest.clear()
+    manifest.update(built)
+    return manifest
+
+def load(dist_dir=DIST_DIR):
+    '''Use the manifest written by an earlier build, e.g. when the static folder is read-only at run time.'''
+    try:
+        with open(os.path.join(dist_dir, 'manifest.json')) as built:
+            manifest.update(json.load(built))
+    except (OSError, ValueError) as error:
+        logger.warning('No asset manifest, static files are served unversioned: %s', error)
+    return manifest
+
+def asset_url(filename):
+    '''URL of a static file. Fingerprinted files are served by the assets route, anything else as a plain static file.'''
+    fingerprinted = manifest.get(filename)
+    if fingerprinted is None:
+        return url_for('static', filename=filename)
+    return url_for('asset', filename=fingerprinted)
+
+def send(filename, accept_encodings, dist_dir=DIST_DIR):
+    '''Send a fingerprinted file, precompressed in the best encoding the client accepts.'''
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    encoding = None
+    for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if accept_encodings[candidate] and os.path.exists(os.path.join(dist_dir, filename + suffix)):
+            encoding = candidate
+            filename += suffix
+            break
+
+    response = send_from_directory(dist_dir, filename, mimetype=mimetype)
+    if encoding:
+        response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    return response
+
+if __name__ == '__main__':
+    # Build ahead of time, e.g. in a deploy step, and start the app with ASSETS_BUILD=0
+    print(json.dumps(build(), indent=2))
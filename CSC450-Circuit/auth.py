@@ -0,0 +1,50 @@
+from functools import wraps
+from flask import g, session, request, redirect, jsonify
+import db
+
+# Request-scoped identity and authorization
+# load_identity runs before every request and resolves the logged-in user and, for project routes, their role
+# in the project with a single query. Routes declare what they need with the decorators below instead of
+# calling db.get_user / db.is_member / db.is_admin themselves
+
+def load_identity():
+    '''Resolve the session's user and their role in the requested project onto g. Registered with before_request.'''
+    g.user = None
+    g.role = None
+    g.project_id = None
+
+    if request.endpoint in ('static', 'asset') or not session.get('user_id'):
+        return
+
+    # Project routes carry the project in the URL or, for the form posts, in a project_id field
+    project_id = (request.view_args or {}).get('project_id')
+    if project_id is None and request.method == 'POST':
+        project_id = request.form.get('project_id', type=int)
+    g.project_id = project_id
+
+    g.user, g.role = db.get_identity(session.get('user_id'), project_id)
+
+def _deny(api, status, location):
+    # JSON endpoints answer with an error status, pages redirect like they always have
+    if api:
+        return jsonify(error='Not logged in' if status == 401 else 'Forbidden'), status
+    return redirect(location)
+
+def _requirement(check):
+    # Build a decorator usable both bare (@require_member) and with options (@require_member(api=True))
+    def decorator(view=None, *, api=False):
+        def wrap(view):
+            @wraps(view)
+            def wrapped(*args, **kwargs):
+                if g.user is None:
+                    return _deny(api, 401, '/')
+                if not check():
+                    return _deny(api, 403, '/dashboard')
+                return view(*args, **kwargs)
+            return wrapped
+        return wrap(view) if view is not None else wrap
+    return decorator
+
+require_login = _requirement(lambda: True)
+require_member = _requirement(lambda: g.role is not None)
+require_admin = _requirement(lambda: g.role == 'admin')
@@ -0,0 +1,96 @@
+import argparse
+import json
+import os
+import sqlite3
+import time
+import common
+import archive
+import db
+
+# Hot table and database size before and after moving old messages into the archive (archive.py), and how long a
+# history page takes to load from the Message table against one that falls through to the archive
+# The project gets --messages messages, one every --spacing minutes going back from now, and everything older than
+# --days days is archived. Pages are timed at the newest messages (always hot) and at the oldest (archived afterwards),
+# and so is a search for one of the oldest messages
+# Usage: python benchmarks/bench_archive.py [--messages 200000] [--spacing 2] [--days 30] [--pages 200]
+
+def add_history(project_id, user_id, messages, spacing):
+    conn = sqlite3.connect(db.db_path)
+    conn.executemany("INSERT INTO Message (content, sender_id, project_id, timestamp) VALUES (?, ?, ?, datetime('now', ?))",
+                     [(f'Message {i} about the sprint, the build and who is reviewing what this week', user_id,
+                       project_id, f'-{(messages - i) * spacing} minutes') for i in range(messages)])
+    conn.commit()
+    conn.close()
+
+def measure_pages(project_id, before, pages):
+    samples = []
+    for _ in range(pages):
+        start = time.perf_counter()
+        messages, _ = db.get_message_page(project_id, before)
+        samples.append((time.perf_counter() - start) * 1000)
+    assert len(messages) == db.MESSAGE_PAGE_SIZE
+    return {'p50_ms': round(common.percentile(samples, 50), 3), 'p99_ms': round(common.percentile(samples, 99), 3)}
+
+def measure_search(project_id, pages):
+    samples = []
+    for _ in range(pages):
+        start = time.perf_counter()
+        hits, _ = db.search_messages(project_id, '17')
+        samples.append((time.perf_counter() - start) * 1000)
+    assert hits and hits[0]['message'].content.startswith('Message 17 ')
+    return {'p50_ms': round(common.percentile(samples, 50), 3), 'p99_ms': round(common.percentile(samples, 99), 3)}
+
+def measure(project_id, old_cursor, pages):
+    conn = sqlite3.connect(db.db_path)
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    hot_rows = conn.execute('SELECT COUNT(*) FROM Message').fetchone()[0]
+    conn.close()
+    archive_dir = archive.directory(db.db_path)
+    archive_bytes = sum(os.path.getsize(os.path.join(folder, name))
+                        for folder, _, names in os.walk(archive_dir) for name in names)
+    return {
+        'message_rows': hot_rows,
+        'database_bytes': os.path.getsize(db.db_path),
+        'archive_bytes': archive_bytes,
+        'newest_page': measure_pages(project_id, None, pages),
+        'oldest_page': measure_pages(project_id, old_cursor, pages),
+        'search_oldest': measure_search(project_id, pages),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure message archival.')
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--spacing', type=float, default=2, help='minutes between messages')
+    parser.add_argument('--days', type=float, default=30, help='archive messages older than this')
+    parser.add_argument('--pages', type=int, default=200)
+    args = parser.parse_args()
+
+    path, project_id, user_id = common.setup_database(tasks=0, messages=0)
+    add_history(project_id, user_id, args.messages, args.spacing)
+    db.init_pool(path)
+
+    # Cursor just past the oldest page of history
+    conn = sqlite3.connect(path)
+    old_cursor = conn.execute('''
+        SELECT timestamp, message_id FROM Message WHERE project_id = ?
+        ORDER BY timestamp, message_id LIMIT 1 OFFSET ?
+    ''', (project_id, db.MESSAGE_PAGE_SIZE)).fetchone()
+    conn.close()
+
+    before = measure(project_id, old_cursor, args.pages)
+    start = time.perf_counter()
+    moved = archive.archive_all(args.days)
+    archive_seconds = time.perf_counter() - start
+    db.writer.close()
+    db.pool.close()
+    conn = sqlite3.connect(path)
+    conn.execute('VACUUM')
+    conn.close()
+    db.init_pool(path)
+    after = measure(project_id, old_cursor, args.pages)
+
+    print(json.dumps({'messages': args.messages, 'archived': sum(moved.values()),
+                      'archive_seconds': round(archive_seconds, 2), 'before': before, 'after': after}, indent=2))
+
+if __name__ == '__main__':
+    main()
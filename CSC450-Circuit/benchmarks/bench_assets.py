@@ -0,0 +1,44 @@
+import json
+import time
+import common
+import assets
+from app import app
+
+# Bytes sent for every stylesheet and script, uncompressed and precompressed, and the time to serve one through the
+# plain static route and through the fingerprinted assets route
+# A repeat visit costs one conditional request per file on the static route and none at all on the assets route,
+# whose responses browsers cache as immutable
+# Usage: python benchmarks/bench_assets.py
+
+REQUESTS = 200
+
+def measure(client, url, headers):
+    samples = []
+    for _ in range(REQUESTS):
+        start = time.perf_counter()
+        client.get(url, headers=headers).close()
+        samples.append((time.perf_counter() - start) * 1000)
+    return round(common.percentile(samples, 50), 3)
+
+def main():
+    client = app.test_client()
+    files = {}
+    for original, fingerprinted in sorted(assets.manifest.items()):
+        url = f'/assets/{fingerprinted}'
+        files[original] = {
+            encoding or 'identity': len(client.get(url, headers={'Accept-Encoding': encoding or 'identity'}).data)
+            for encoding in (None, 'gzip', 'br') if encoding != 'br' or assets.brotli is not None
+        }
+
+    totals = {encoding: sum(sizes[encoding] for sizes in files.values()) for encoding in next(iter(files.values()))}
+    original, fingerprinted = next(iter(sorted(assets.manifest.items())))
+    print(json.dumps({
+        'files': files,
+        'total_bytes': totals,
+        'static_route_p50_ms': measure(client, f'/static/{original}', {}),
+        'assets_route_gzip_p50_ms': measure(client, f'/assets/{fingerprinted}', {'Accept-Encoding': 'gzip'}),
+        'brotli_available': assets.brotli is not None,
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
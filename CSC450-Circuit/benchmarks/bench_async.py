@@ -0,0 +1,159 @@
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import common
+
+# Concurrent-connection capacity of the sync (WSGI) and async (ASGI, asgi.py) serving modes
+# --idle clients sit in a long-poll loop on one project, the way open browser tabs do. While they wait, --requests
+# short task board requests are sent and timed. Then one event is published and the time until every idle client has
+# received it is measured. The sync mode is the WSGI app on --threads server threads, one per connection like a
+# threaded WSGI server, with further connections queued. Each mode runs in its own process
+# Usage: python benchmarks/bench_async.py [--idle 1000] [--requests 200] [--threads 64] [--timeout 2]
+
+MODES = ['sync', 'async']
+
+def wsgi_caller(app, threads):
+    '''Call the WSGI app on a pool of server threads. Returns an async function giving (status, body).'''
+    from werkzeug.test import EnvironBuilder
+    server = ThreadPoolExecutor(threads, thread_name_prefix='server')
+
+    def handle(path, query, cookie):
+        environ = EnvironBuilder(path=path, query_string=query, headers={'Cookie': cookie}).get_environ()
+        status = []
+        body = app(environ, lambda status_line, headers, exc_info=None: status.append(int(status_line[:3])))
+        try:
+            data = b''.join(body)
+        finally:
+            body.close()
+        return status[0], data
+
+    async def call(path, query, cookie):
+        return await asyncio.get_running_loop().run_in_executor(server, handle, path, query, cookie)
+    return call
+
+def asgi_caller(application):
+    '''Call the ASGI app on this event loop. Returns an async function giving (status, body).'''
+    async def call(path, query, cookie):
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode(), 'root_path': '',
+                 'headers': [(b'cookie', cookie.encode())], 'http_version': '1.1', 'scheme': 'http',
+                 'server': ('localhost', 80), 'client': ('127.0.0.1', 0)}
+        sent = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+
+        async def receive():
+            if sent:
+                return sent.pop()
+            await asyncio.Future()  # The client never hangs up
+
+        status, chunks = [], []
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                status.append(message['status'])
+            else:
+                chunks.append(message.get('body', b''))
+        await application(scope, receive, send)
+        return status[0], b''.join(chunks)
+    return call
+
+async def measure(call, project_id, cookie, idle, requests, timeout):
+    from events import broker
+    poll = f'/project/{project_id}/poll'
+    published = []
+    delivered = []
+
+    async def idle_client():
+        after = broker.last_event_id(project_id)
+        while True:
+            status, body = await call(poll, f'after={after}', cookie)
+            page = json.loads(body)
+            if page['events'] and published:
+                delivered.append((time.perf_counter() - published[0]) * 1000)
+                return
+            after = page['last_event_id']
+
+    peak_threads = threading.active_count()
+    clients = [asyncio.ensure_future(idle_client()) for _ in range(idle)]
+    await asyncio.sleep(0.5)  # Let the clients connect and start waiting
+
+    async def short_request():
+        start = time.perf_counter()
+        status, _ = await call(f'/project/{project_id}/tasks', '', cookie)
+        return (time.perf_counter() - start) * 1000, status
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[short_request() for _ in range(requests)])
+    elapsed = time.perf_counter() - start
+    latencies = [latency for latency, status in results if status == 200]
+    peak_threads = max(peak_threads, threading.active_count())
+
+    published.append(time.perf_counter())
+    broker.publish(project_id, 'message', {'content': 'Ping'})
+    done, pending = await asyncio.wait(clients, timeout=timeout * 3)
+    for client in pending:
+        client.cancel()
+
+    return {
+        'short_requests_ok': len(latencies),
+        'short_p50_ms': round(common.percentile(latencies, 50), 2) if latencies else None,
+        'short_p99_ms': round(common.percentile(latencies, 99), 2) if latencies else None,
+        'short_throughput_rps': round(len(latencies) / elapsed, 1),
+        'idle_clients_delivered': len(delivered),
+        'delivery_p50_ms': round(common.percentile(delivered, 50), 2) if delivered else None,
+        'delivery_max_ms': round(max(delivered), 2) if delivered else None,
+        'peak_threads': max(peak_threads, threading.active_count()),
+    }
+
+def run_mode(mode, path, project_id, user_id, args):
+    '''Measure one mode in this process.'''
+    os.environ['EVENT_TIMEOUT'] = str(args.timeout)
+    os.environ['PURGE_IN_BACKGROUND'] = '0'
+    import app as application
+    import db
+    db.init_pool(path)
+
+    client = application.app.test_client()
+    common.login(client, user_id)
+    cookie = f"session={client.get_cookie('session').value}"
+
+    if mode == 'sync':
+        call = wsgi_caller(application.app, args.threads)
+    else:
+        import asgi
+        call = asgi_caller(asgi.application)
+    return asyncio.run(measure(call, project_id, cookie, args.idle, args.requests, args.timeout))
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the sync and async serving modes under many idle connections.')
+    parser.add_argument('--idle', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=64, help='server threads in the sync mode')
+    parser.add_argument('--timeout', type=float, default=2, help='EVENT_TIMEOUT, seconds an idle long-poll waits')
+    parser.add_argument('--mode', choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument('--target', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        path, project_id, user_id = args.target.rsplit(':', 2)
+        print(json.dumps(run_mode(args.mode, path, int(project_id), int(user_id), args)))
+        return
+
+    path, project_id, user_id = common.setup_database()
+    results = {}
+    for mode in MODES:
+        output = subprocess.run([sys.executable, __file__, '--mode', mode, '--target', f'{path}:{project_id}:{user_id}',
+                                 '--idle', str(args.idle), '--requests', str(args.requests),
+                                 '--threads', str(args.threads), '--timeout', str(args.timeout)],
+                                capture_output=True, text=True, check=True).stdout
+        results[mode] = json.loads(output.strip().splitlines()[-1])
+
+    print(json.dumps({'idle': args.idle, 'requests': args.requests, 'sync_threads': args.threads,
+                      'event_timeout': args.timeout, 'results': results}, indent=2))
+
+if __name__ == '__main__':
+    main()
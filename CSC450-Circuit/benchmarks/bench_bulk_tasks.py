@@ -0,0 +1,71 @@
+import json
+import time
+import common
+import db
+
+# Compares creating tasks the old way (add_task, then a username lookup and an assignment per member, each in its own
+# transaction) with db.add_tasks, which resolves all usernames in one query and commits everything once
+# Usage: python benchmarks/bench_bulk_tasks.py [repeats]
+
+def count_commits(pool):
+    '''Count the transactions committed through the pool's connections. Writes are committed by db.writer instead.'''
+    counter = {'commits': 0}
+    connect = pool._connect
+
+    def traced_connect():
+        conn = connect()
+        conn.set_trace_callback(lambda statement: statement == 'COMMIT' and counter.update(commits=counter['commits'] + 1))
+        return conn
+
+    pool._connect = traced_connect
+    return counter
+
+def one_by_one(project_id, tasks):
+    '''The previous add_task route: every call borrows a connection and commits on its own.'''
+    for task_title, task_description, task_status, usernames in tasks:
+        task_id = db.add_task(task_title, task_description, task_status, project_id)
+        for username in usernames:
+            user = db.get_user_by_username(username)
+            if user:
+                db.assign_task_to_user(task_id, user.user_id)
+
+def bulk(project_id, tasks):
+    db.add_tasks(project_id, tasks)
+
+def run(create, project_id, tasks, repeats, counter):
+    '''Create the tasks `repeats` times and return commits and latency per batch.'''
+    commits = lambda: counter['commits'] + db.writer.batches
+    start_commits = commits()
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        create(project_id, tasks)
+        samples.append((time.perf_counter() - start) * 1000)
+    return {
+        'commits_per_batch': (commits() - start_commits) / repeats,
+        'p50_ms': round(common.percentile(samples, 50), 3),
+        'p99_ms': round(common.percentile(samples, 99), 3),
+    }
+
+def main(repeats=20):
+    path, project_id, user_id = common.setup_database(tasks=0, messages=0, members=10)
+    db.init_pool(path)
+    counter = count_commits(db.pool)
+
+    members = [f'user{i}' for i in range(10)]
+    cases = {
+        'one_task_10_assignees': [('Task', 'Description', 'todo', members)],
+        'backlog_200_tasks_3_assignees': [(f'Task {i}', 'Description', 'todo', members[i % 8:i % 8 + 3]) for i in range(200)],
+    }
+
+    results = {}
+    for name, tasks in cases.items():
+        results[name] = {
+            'before': run(one_by_one, project_id, tasks, repeats, counter),
+            'after': run(bulk, project_id, tasks, repeats, counter),
+        }
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    import sys
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
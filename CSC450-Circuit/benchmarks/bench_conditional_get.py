@@ -0,0 +1,56 @@
+import json
+import time
+import common
+import cache
+import metrics
+from app import app
+
+# Full responses against 304 Not Modified answers for a reloaded project page, dashboard and task board poll
+# Also counts the SQL statements behind each, a revalidation must not run the task, message or member queries
+# The page cache is turned off so the full responses show what a reload cost without conditional requests
+# Usage: python benchmarks/bench_conditional_get.py [tasks] [messages]
+
+REQUESTS = 50
+
+def statements():
+    return sum(count for count, _ in metrics.registry.queries.values())
+
+def measure(client, path, headers=None):
+    samples = []
+    size = 0
+    before = statements()
+    for _ in range(REQUESTS):
+        start = time.perf_counter()
+        response = client.get(path, headers=headers)
+        size = len(response.get_data())
+        samples.append((time.perf_counter() - start) * 1000)
+    return {
+        'status': response.status_code,
+        'bytes': size,
+        'queries': (statements() - before) // REQUESTS,
+        'p50_ms': round(common.percentile(samples, 50), 3),
+    }
+
+def main(tasks=1000, messages=2000):
+    path, project_id, user_id = common.setup_database(tasks=tasks, messages=messages)
+    cache.cache = cache.MemoryCache(max_bytes=0)
+    client = app.test_client()
+    common.login(client, user_id)
+
+    results = {}
+    board = client.get(f'/project/{project_id}/tasks').get_json()
+    for name, path in [('project', f'/project/{project_id}'), ('dashboard', '/dashboard'),
+                       ('task_poll', f'/project/{project_id}/tasks?since={board["version"]}')]:
+        etag = client.get(path).headers['ETag']
+        results[name] = {'full': measure(client, path), 'not_modified': measure(client, path, {'If-None-Match': etag})}
+
+    # A write must change the tag
+    etag = client.get(f'/project/{project_id}').headers['ETag']
+    client.post('/project/send_message', data={'project_id': project_id, 'message': 'Changed'})
+    assert client.get(f'/project/{project_id}', headers={'If-None-Match': etag}).status_code == 200, 'Stale 304'
+
+    print(json.dumps({'tasks': tasks, 'messages': messages, 'results': results}, indent=2))
+
+if __name__ == '__main__':
+    import sys
+    main(*(int(arg) for arg in sys.argv[1:3]))
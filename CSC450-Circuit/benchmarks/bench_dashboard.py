@@ -0,0 +1,85 @@
+import argparse
+import json
+import sqlite3
+import time
+import common
+import create_db
+import db
+
+# Dashboard read: counting every project's tasks, members and messages on each load against reading the Project_Summary
+# rows the triggers maintain (db.get_dashboard), for one user who is a member of --projects projects
+# Also reports what the triggers add to the writes they count: chat messages and status changes timed with the
+# triggers in place and again after dropping them
+# Usage: python benchmarks/bench_dashboard.py [--projects 50] [--tasks 200] [--messages 2000] [--loads 200] [--writes 1000]
+
+def aggregate_dashboard(user_id):
+    '''The same data counted from the tables on every load.
+
+    Unread messages are counted after a last-read message ID, which costs the same as a real per-member cursor would.
+    '''
+    task_counts = ', '.join(f"(SELECT COUNT(*) FROM Task WHERE project_id = Project.project_id AND task_status = '{status}')"
+                            for status, _ in create_db.SUMMARY_STATUS_COLUMNS)
+    with db.connect() as conn:
+        return conn.execute(f'''
+            SELECT Project.project_id, project_name, Project.version, {task_counts},
+                (SELECT COUNT(*) FROM Project_User AS Members WHERE Members.project_id = Project.project_id),
+                (SELECT COUNT(*) FROM Message WHERE project_id = Project.project_id AND message_id > ?),
+                (SELECT MAX(timestamp) FROM Message WHERE project_id = Project.project_id)
+            FROM Project_User
+            JOIN Project ON Project.project_id = Project_User.project_id
+            WHERE Project_User.user_id = ? AND Project.deleted_at IS NULL
+        ''', (0, user_id)).fetchall()
+
+def time_loads(load, user_id, loads):
+    samples = []
+    for _ in range(loads):
+        start = time.perf_counter()
+        load(user_id)
+        samples.append((time.perf_counter() - start) * 1000)
+    return {'p50_ms': round(common.percentile(samples, 50), 3), 'p99_ms': round(common.percentile(samples, 99), 3)}
+
+def time_writes(project_id, user_id, task_ids, writes):
+    start = time.perf_counter()
+    for i in range(writes):
+        db.add_message(f'Message {i}', user_id, project_id)
+        db.change_task_status(task_ids[i % len(task_ids)], create_db.SUMMARY_STATUS_COLUMNS[i % 5][0])
+    return round((time.perf_counter() - start) * 1e6 / (writes * 2), 1)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare counting the dashboard on every load with the summary table.')
+    parser.add_argument('--projects', type=int, default=50)
+    parser.add_argument('--tasks', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--loads', type=int, default=200)
+    parser.add_argument('--writes', type=int, default=1000)
+    args = parser.parse_args()
+
+    for _ in range(args.projects):
+        path, project_id, user_id = common.setup_database(tasks=args.tasks, messages=args.messages)
+    db.init_pool(path)
+    assert not db.verify_project_summaries()
+
+    results = {
+        'aggregate_per_load': time_loads(aggregate_dashboard, user_id, args.loads),
+        'summary_table': time_loads(db.get_dashboard, user_id, args.loads),
+    }
+
+    start = time.perf_counter()
+    db.verify_project_summaries()
+    results['verify_ms'] = round((time.perf_counter() - start) * 1000, 1)
+
+    with db.connect() as conn:
+        task_ids = [row[0] for row in conn.execute('SELECT task_id FROM Task WHERE project_id = ?', (project_id,))]
+    results['write_us_with_triggers'] = time_writes(project_id, user_id, task_ids, args.writes)
+    db.writer.close()
+    conn = sqlite3.connect(path)
+    for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'project_summary_%'").fetchall():
+        conn.execute(f'DROP TRIGGER {name}')
+    conn.close()
+    results['write_us_without_triggers'] = time_writes(project_id, user_id, task_ids, args.writes)
+
+    print(json.dumps({'projects': args.projects, 'tasks_per_project': args.tasks,
+                      'messages_per_project': args.messages, 'results': results}, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import json
+import threading
+import time
+import common
+import db
+import purge
+
+# Measures how long chat writes in another project stall while a large project is deleted
+# Before: the old delete_project, every child row removed in one transaction
+# After: soft delete, then purge.purge_project() removing rows in small batches with the lock released in between
+# Usage: python benchmarks/bench_delete_project.py [messages]
+
+def hard_delete(project_id):
+    '''The previous delete_project: one transaction holding the write lock until every row is gone.'''
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM Task_User WHERE task_id IN (SELECT task_id FROM Task WHERE project_id = ?)', (project_id,))
+        cursor.execute('DELETE FROM Task_Deleted WHERE project_id = ?', (project_id,))
+        cursor.execute('DELETE FROM Task WHERE project_id = ?', (project_id,))
+        cursor.execute('DELETE FROM Message WHERE project_id = ?', (project_id,))
+        cursor.execute('DELETE FROM Project_User WHERE project_id = ?', (project_id,))
+        cursor.execute('DELETE FROM Project WHERE project_id = ?', (project_id,))
+        conn.commit()
+
+def soft_delete(project_id):
+    db.delete_project(project_id)
+    purge.purge_project(project_id)
+
+def run(delete, messages):
+    '''Delete a freshly built large project while another project's members keep chatting.'''
+    _, big_project, _ = common.setup_database(tasks=messages // 10, messages=messages)
+    _, chat_project, user_id = common.setup_database(tasks=0, messages=0)
+
+    samples = []
+    stop = threading.Event()
+
+    def chat():
+        while not stop.is_set():
+            start = time.perf_counter()
+            db.add_message('Still here', user_id, chat_project)
+            samples.append((time.perf_counter() - start) * 1000)
+            time.sleep(0.001)
+
+    writer = threading.Thread(target=chat)
+    writer.start()
+    time.sleep(0.1)
+    start = time.perf_counter()
+    delete(big_project)
+    total = (time.perf_counter() - start) * 1000
+    stop.set()
+    writer.join()
+
+    return {
+        'delete_ms': round(total, 1),
+        'chat_writes': len(samples),
+        'chat_p50_ms': round(common.percentile(samples, 50), 3),
+        'chat_max_ms': round(max(samples), 3),
+    }
+
+def main(messages=200000):
+    db.init_pool(db.db_path)
+    before = run(hard_delete, messages)
+    after = run(soft_delete, messages)
+    print(json.dumps({'messages': messages, 'before': before, 'after': after}, indent=2))
+
+if __name__ == '__main__':
+    import sys
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
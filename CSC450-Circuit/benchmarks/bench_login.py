@@ -0,0 +1,85 @@
+import json
+import threading
+import time
+from werkzeug.security import generate_password_hash
+import common
+import db
+import passwords
+from app import app
+
+# Login burst benchmark: many clients log in at once while another client keeps loading its dashboard
+# Compares hashing inline on the request thread with the bounded hashing pool in passwords.py
+# Reports login throughput, login latency, how many logins were rejected as busy and dashboard latency during the burst
+# Usage: python benchmarks/bench_login.py [concurrent_logins] [logins_per_client]
+
+class InlineHasher(passwords.Hasher):
+    '''The old behaviour: hash directly on the request thread with no limit.'''
+
+    def _run(self, function, *args):
+        return function(*args)
+
+def burst(clients, logins, dashboard_client):
+    '''Run the login burst and return its measurements.'''
+    login_samples = []
+    dashboard_samples = []
+    rejected = [0]
+    done = threading.Event()
+
+    def log_in():
+        client = app.test_client()
+        for _ in range(logins):
+            start = time.perf_counter()
+            response = client.post('/login', data={'username': 'user0', 'password': 'password'})
+            login_samples.append((time.perf_counter() - start) * 1000)
+            if response.status_code == 503:
+                rejected[0] += 1
+
+    def load_dashboard():
+        while not done.is_set():
+            start = time.perf_counter()
+            dashboard_client.get('/dashboard')
+            dashboard_samples.append((time.perf_counter() - start) * 1000)
+
+    threads = [threading.Thread(target=log_in) for _ in range(clients)]
+    watcher = threading.Thread(target=load_dashboard)
+    start = time.perf_counter()
+    watcher.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    done.set()
+    watcher.join()
+
+    return {
+        'logins_per_second': round((len(login_samples) - rejected[0]) / elapsed, 1),
+        'login_p50_ms': round(common.percentile(login_samples, 50), 1),
+        'login_p99_ms': round(common.percentile(login_samples, 99), 1),
+        'rejected': rejected[0],
+        'dashboard_p50_ms': round(common.percentile(dashboard_samples, 50), 1),
+        'dashboard_p99_ms': round(common.percentile(dashboard_samples, 99), 1),
+    }
+
+def main(clients=32, logins=5):
+    path, project_id, user_id = common.setup_database(tasks=0, messages=0)
+
+    # Store a hash made with the configured method so logins don't trigger a rehash
+    with app.app_context():
+        with db.connect() as conn:
+            conn.execute('UPDATE User SET password = ?', (generate_password_hash('password', passwords.HASH_METHOD),))
+            conn.commit()
+
+    dashboard_client = app.test_client()
+    common.login(dashboard_client, user_id)
+
+    results = {'clients': clients, 'logins_per_client': logins, 'method': passwords.HASH_METHOD}
+    db.hasher = InlineHasher()
+    results['inline'] = burst(clients, logins, dashboard_client)
+    db.hasher = passwords.Hasher()
+    results['pooled'] = burst(clients, logins, dashboard_client)
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    import sys
+    main(*(int(arg) for arg in sys.argv[1:3]))
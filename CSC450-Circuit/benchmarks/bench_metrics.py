@@ -0,0 +1,43 @@
+import json
+import time
+import common
+import db
+import metrics
+from app import app
+
+# Overhead of the query and request instrumentation: the project page and a burst of small queries with metrics
+# turned off and on
+# Usage: python benchmarks/bench_metrics.py [requests]
+
+def page_latency(client, project_id, requests):
+    client.get(f'/project/{project_id}')  # Warm up templates and caches
+    samples = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        client.get(f'/project/{project_id}')
+        samples.append((time.perf_counter() - start) * 1000)
+    return {'p50_ms': round(common.percentile(samples, 50), 3), 'p99_ms': round(common.percentile(samples, 99), 3)}
+
+def query_cost(project_id, queries=20000):
+    '''Microseconds per small query outside a request.'''
+    start = time.perf_counter()
+    for _ in range(queries):
+        db.get_project_name(project_id)
+    return round((time.perf_counter() - start) / queries * 1e6, 2)
+
+def run(enabled, client, project_id, requests):
+    metrics.ENABLED = enabled
+    db.init_pool(db.db_path)  # Reopen the connections with the matching factory
+    return {'project_page': page_latency(client, project_id, requests), 'query_us': query_cost(project_id)}
+
+def main(requests=300):
+    path, project_id, user_id = common.setup_database(tasks=200, messages=1000)
+    client = app.test_client()
+    common.login(client, user_id)
+
+    results = {'off': run(False, client, project_id, requests), 'on': run(True, client, project_id, requests)}
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    import sys
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 300)
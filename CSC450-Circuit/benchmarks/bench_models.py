@@ -0,0 +1,71 @@
+import json
+import tracemalloc
+import common
+import models
+
+# Measures memory of 100k messages and tasks with the old dict-backed models against the slotted models,
+# and peak memory of serializing them through to_dict + json.dumps against stream_json
+# Usage: python benchmarks/bench_models.py [count]
+
+class DictTask:
+    '''The task model as it was before __slots__.'''
+    def __init__(self, task_id, task_title, task_description, task_status):
+        self.task_id = task_id
+        self.task_title = task_title
+        self.task_description = task_description
+        self.task_status = task_status
+
+    def to_dict(self):
+        return {"task_id": self.task_id, "task_title": self.task_title,
+                "task_description": self.task_description, "task_status": self.task_status}
+
+class DictMessage:
+    '''The message model as it was before __slots__, which stored the formatted date and time eagerly.'''
+    def __init__(self, message_id, content, user_id, project_id, date_time):
+        self.message_id = message_id
+        self.content = content
+        self.user_id = user_id
+        self.project_id = project_id
+        self.date_time = date_time
+        self.date, self.time = models.localize(date_time)
+
+    def to_dict(self):
+        return {"message_id": self.message_id, "content": self.content, "user_id": self.user_id, "project_id": self.project_id,
+                "date_time": self.date_time, "date": self.date, "time": self.time}
+
+def measure(build):
+    '''Return (result, bytes allocated) for a function building objects.'''
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+def peak(serialize):
+    '''Return the peak bytes allocated while serializing.'''
+    tracemalloc.start()
+    serialize()
+    size = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return size
+
+def main(count=100000):
+    # Share the row values between both runs so only the model objects are measured
+    contents = [f'Message {i}' for i in range(count)]
+    timestamps = [f'2024-01-01 10:{i % 60:02d}:00' for i in range(count)]
+    titles = [f'Task {i}' for i in range(count)]
+
+    results = {'count': count}
+    old_messages, results['dict_messages_bytes'] = measure(lambda: [DictMessage(i, contents[i], 1, 1, timestamps[i]) for i in range(count)])
+    new_messages, results['slotted_messages_bytes'] = measure(lambda: [models.Message(i, contents[i], 1, 1, timestamps[i]) for i in range(count)])
+    old_tasks, results['dict_tasks_bytes'] = measure(lambda: [DictTask(i, titles[i], '', 'todo') for i in range(count)])
+    new_tasks, results['slotted_tasks_bytes'] = measure(lambda: [models.Task(i, titles[i], '', 'todo') for i in range(count)])
+
+    results['to_dict_json_peak_bytes'] = peak(lambda: json.dumps([message.to_dict() for message in old_messages]))
+    results['stream_json_peak_bytes'] = peak(lambda: sum(len(chunk) for chunk in models.stream_json(new_messages)))
+
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    import sys
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
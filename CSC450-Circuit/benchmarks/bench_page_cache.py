@@ -0,0 +1,54 @@
+import json
+import os
+import tempfile
+import time
+import common
+import cache
+from app import app
+
+# Project page and dashboard latency with the page cache off, in memory and in a shared SQLite file
+# Every read is repeated without writes in between, so after the first request each one is a hit. A message is then
+# sent to check that the write makes the next read rebuild the page
+# Usage: python benchmarks/bench_page_cache.py
+
+SIZES = [(10, 20), (1000, 2000)]  # (tasks, messages)
+REQUESTS = 50
+
+def measure(client, path):
+    samples = []
+    for _ in range(REQUESTS):
+        start = time.perf_counter()
+        client.get(path).get_data()  # Read the whole streamed page
+        samples.append((time.perf_counter() - start) * 1000)
+    return round(common.percentile(samples, 50), 3)
+
+def main():
+    backends = {
+        'off': lambda: cache.MemoryCache(max_bytes=0),
+        'memory': lambda: cache.MemoryCache(),
+        'sqlite': lambda: cache.SQLiteCache(os.path.join(tempfile.mkdtemp(prefix='circuit-cache-'), 'cache.db')),
+    }
+    results = []
+    for tasks, messages in SIZES:
+        path, project_id, user_id = common.setup_database(tasks=tasks, messages=messages)
+        client = app.test_client()
+        common.login(client, user_id)
+
+        result = {'tasks': tasks, 'messages': messages}
+        for name, backend in backends.items():
+            cache.cache = backend()
+            result[name] = {
+                'project_p50_ms': measure(client, f'/project/{project_id}'),
+                'dashboard_p50_ms': measure(client, '/dashboard'),
+                'hits': cache.cache.hits,
+                'misses': cache.cache.misses,
+            }
+
+            client.post('/project/send_message', data={'project_id': project_id, 'message': f'After {name}'})
+            assert f'After {name}' in client.get(f'/project/{project_id}').get_data(as_text=True), 'Stale page served'
+        results.append(result)
+
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+import common
+import cache
+import db
+
+os.environ['PURGE_IN_BACKGROUND'] = '0'  # The purger's reads would count as the page's connects
+from app import app
+
+# Compares connects-per-request and latency of /project/<id> with one connection per query
+# (the old behaviour) against the pooled, request-scoped connection
+# The page cache is off and no conditional headers are sent, so every request builds the page from the database
+# Usage: python benchmarks/bench_pool.py [requests]
+
+def unpooled():
+    '''Recreate the old behaviour: open and close a connection around every query.'''
+    counter = {'connects': 0}
+
+    @contextmanager
+    def connect():
+        counter['connects'] += 1
+        conn = sqlite3.connect(db.db_path)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    return connect, lambda: counter['connects']
+
+def run(client, project_id, requests, connects):
+    '''Request the project page repeatedly and return connects per request and latency percentiles.'''
+    client.get(f'/project/{project_id}')  # Warm up templates and the pool
+    start_connects = connects()
+    samples = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        response = client.get(f'/project/{project_id}')
+        response.get_data()  # The page is streamed, time it until the last byte
+        samples.append((time.perf_counter() - start) * 1000)
+        assert response.status_code == 200
+    return {
+        'connects_per_request': (connects() - start_connects) / requests,
+        'p50_ms': round(common.percentile(samples, 50), 3),
+        'p99_ms': round(common.percentile(samples, 99), 3),
+    }
+
+def main(requests=200):
+    path, project_id, user_id = common.setup_database()
+    cache.cache = cache.MemoryCache(max_bytes=0)
+    client = app.test_client()
+    common.login(client, user_id)
+
+    pooled_connect = db.connect
+    db.connect, count = unpooled()
+    before = run(client, project_id, requests, count)
+
+    db.connect = pooled_connect
+    after = run(client, project_id, requests, lambda: db.pool.connects)
+
+    print(json.dumps({'before': before, 'after': after}, indent=2))
+
+if __name__ == '__main__':
+    import sys
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -0,0 +1,47 @@
+import json
+import time
+import common
+import db
+from app import app
+
+# Counts the SQL statements db.load_project_view runs as a project grows and times the project page
+# The query count must stay the same at every size, otherwise an N+1 query has crept back in
+# Usage: python benchmarks/bench_project_view.py
+
+SIZES = [(10, 20), (100, 200), (1000, 2000)]  # (tasks, messages)
+
+def count_queries(project_id, user_id):
+    '''Run load_project_view once and return the number of statements it executed.'''
+    statements = []
+    with app.app_context():
+        with db.connect() as conn:
+            conn.set_trace_callback(statements.append)
+            db.load_project_view(project_id, user_id)
+            conn.set_trace_callback(None)
+    return len(statements)
+
+def main():
+    results = []
+    for tasks, messages in SIZES:
+        path, project_id, user_id = common.setup_database(tasks=tasks, messages=messages)
+        client = app.test_client()
+        common.login(client, user_id)
+
+        samples = []
+        for _ in range(20):
+            start = time.perf_counter()
+            client.get(f'/project/{project_id}').get_data()  # Read the whole streamed page
+            samples.append((time.perf_counter() - start) * 1000)
+
+        results.append({
+            'tasks': tasks,
+            'messages': messages,
+            'queries': count_queries(project_id, user_id),
+            'p50_ms': round(common.percentile(samples, 50), 3),
+        })
+
+    print(json.dumps(results, indent=2))
+    assert len({result['queries'] for result in results}) == 1, 'Query count grows with project size'
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+import itertools
+import json
+import random
+import sqlite3
+import time
+import common
+import db
+import search
+
+# Search latency over a large chat history: db.search_messages against ranking every match with bm25() and against a
+# LIKE '%word%' scan. Messages are spread over several projects with one project holding half of them, and words follow a skewed
+# distribution so both common and rare terms are measured
+# Usage: python benchmarks/bench_search.py [messages] [queries]
+
+WORDS = [f'word{i}' for i in range(5000)]
+CUM_WEIGHTS = list(itertools.accumulate(1 / (i + 1) for i in range(len(WORDS))))
+
+def fill(path, project_ids, user_id, messages):
+    '''Insert the generated messages directly, the FTS triggers index them as they go.'''
+    rng = random.Random(42)
+    conn = sqlite3.connect(path)
+    # The first project gets about half of all messages
+    project_weights = list(itertools.accumulate([len(project_ids)] + [1] * (len(project_ids) - 1)))
+    batch = []
+    for i in range(messages):
+        content = ' '.join(rng.choices(WORDS, cum_weights=CUM_WEIGHTS, k=rng.randint(4, 20)))
+        batch.append((content, user_id, rng.choices(project_ids, cum_weights=project_weights)[0]))
+        if len(batch) == 10000:
+            conn.executemany('INSERT INTO Message (content, sender_id, project_id) VALUES (?, ?, ?)', batch)
+            batch = []
+    conn.executemany('INSERT INTO Message (content, sender_id, project_id) VALUES (?, ?, ?)', batch)
+    conn.commit()
+    conn.close()
+
+def like_search(project_id, text, limit=20):
+    '''What a search without the index would have to do.'''
+    with db.connect() as conn:
+        return conn.execute('''
+            SELECT message_id, content FROM Message
+            WHERE project_id = ? AND content LIKE ?
+            ORDER BY timestamp DESC LIMIT ?
+        ''', (project_id, f'%{text}%', limit)).fetchall()
+
+def bm25_search(project_id, text, limit=20):
+    '''Ranking every match in SQL, which has to visit all postings of each term.'''
+    terms = search.parse(text)
+    with db.connect() as conn:
+        return conn.execute('''
+            SELECT rowid FROM Message_fts WHERE Message_fts MATCH ? ORDER BY rank LIMIT ?
+        ''', (search.match_expression(terms, project_id, ['content']), limit)).fetchall()
+
+def measure(search, project_id, text, queries):
+    samples = []
+    for _ in range(queries):
+        start = time.perf_counter()
+        search(project_id, text)
+        samples.append((time.perf_counter() - start) * 1000)
+    return {'p50_ms': round(common.percentile(samples, 50), 3), 'p99_ms': round(common.percentile(samples, 99), 3)}
+
+def main(messages=1000000, queries=50):
+    project_ids = []
+    for _ in range(10):
+        path, project_id, user_id = common.setup_database(tasks=0, messages=0)
+        project_ids.append(project_id)
+
+    start = time.perf_counter()
+    fill(path, project_ids, user_id, messages)
+    build_s = time.perf_counter() - start
+    db.init_pool(path)
+
+    big, small = project_ids[0], project_ids[-1]
+    cases = {
+        'common_word_big_project': (big, 'word1'),
+        'rare_word_big_project': (big, 'word4321'),
+        'two_words_big_project': (big, 'word3 word17'),
+        'prefix_big_project': (big, 'word12*'),
+        'common_word_small_project': (small, 'word1'),
+    }
+    results = {}
+    for name, (project_id, text) in cases.items():
+        results[name] = {
+            'fts': measure(lambda p, t: db.search_messages(p, t), project_id, text, queries),
+            'bm25_all_matches': measure(bm25_search, project_id, text, max(1, queries // 10)),
+            'like': measure(like_search, project_id, text.split()[0].rstrip('*'), max(1, queries // 10)),
+        }
+
+    print(json.dumps({'messages': messages, 'insert_and_index_s': round(build_s, 1), 'results': results}, indent=2))
+
+if __name__ == '__main__':
+    import sys
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000, int(sys.argv[2]) if len(sys.argv) > 2 else 50)
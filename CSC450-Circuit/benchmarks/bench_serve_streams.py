@@ -0,0 +1,114 @@
+import argparse
+import http.client
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from urllib.parse import urlencode
+import common
+
+# Page requests to the production server (serve.py) while project tabs keep event streams and long polls open
+# --streams SSE connections and --polls long polls are opened and held, then --requests dashboard requests are sent one
+# after another, each on a new connection, and timed. A request not answered within --timeout seconds counts as
+# failed. Finally the server is sent SIGTERM with the streams still open and the time until it has exited is reported
+# Usage: python benchmarks/bench_serve_streams.py [--streams 50] [--polls 20] [--requests 200] [--workers 1] [--threads 2]
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+def wait_until_listening(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('serve.py did not start listening')
+
+def login(port):
+    '''Log in as the benchmark user and return the session cookie.'''
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    conn.request('POST', '/login', urlencode({'username': 'user0', 'password': 'password'}),
+                 {'Content-Type': 'application/x-www-form-urlencoded'})
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return response.getheader('Set-Cookie').split(';', 1)[0]
+
+def open_waiting(port, path, cookie):
+    '''Send a request that waits for events and return its open connection.'''
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    conn.request('GET', path, headers={'Cookie': cookie})
+    return conn
+
+def main():
+    parser = argparse.ArgumentParser(description='Time page requests while event streams are held open.')
+    parser.add_argument('--streams', type=int, default=50)
+    parser.add_argument('--polls', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=2)
+    parser.add_argument('--timeout', type=float, default=5, help='seconds a page request may take')
+    args = parser.parse_args()
+
+    path, project_id, user_id = common.setup_database()
+    port = free_port()
+    env = dict(os.environ, PORT=str(port), WORKERS=str(args.workers), THREADS=str(args.threads),
+               EVENT_TIMEOUT='30', GRACEFUL_TIMEOUT='30', MAX_REQUESTS='0')
+    server = subprocess.Popen([sys.executable, os.path.join(common.ROOT, 'serve.py')], env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_listening(port)
+        cookie = login(port)
+
+        held = [open_waiting(port, f'/project/{project_id}/events', cookie) for _ in range(args.streams)]
+        held += [open_waiting(port, f'/project/{project_id}/poll?after=0', cookie) for _ in range(args.polls)]
+        for conn in held[:args.streams]:
+            conn.getresponse()  # The stream has started, its headers are sent before the first wait
+        time.sleep(0.5)  # Let the long polls reach their wait
+
+        samples, failed = [], 0
+        for _ in range(args.requests):
+            start = time.perf_counter()
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=args.timeout)
+                conn.request('GET', '/dashboard', headers={'Cookie': cookie})
+                response = conn.getresponse()
+                response.read()
+                conn.close()
+                assert response.status == 200
+            except (OSError, AssertionError):
+                failed += 1
+                continue
+            samples.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        server.send_signal(signal.SIGTERM)
+        server.wait(60)
+        stop_seconds = time.perf_counter() - start
+        for conn in held:
+            conn.close()
+    finally:
+        if server.poll() is None:
+            server.kill()
+
+    print(json.dumps({
+        'workers': args.workers,
+        'threads': args.threads,
+        'streams_open': args.streams,
+        'polls_open': args.polls,
+        'requests_ok': len(samples),
+        'requests_failed': failed,
+        'p50_ms': round(common.percentile(samples, 50), 2) if samples else None,
+        'p99_ms': round(common.percentile(samples, 99), 2) if samples else None,
+        'stop_seconds': round(stop_seconds, 2),
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
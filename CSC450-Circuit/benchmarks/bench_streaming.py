@@ -0,0 +1,116 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+import common
+
+# Time to first byte, total time and peak memory of a cold project page render for a project with a long history
+# and a large task board, in three modes:
+#   loaded    - everything read into lists first and rendered into one string, how the page used to be built
+#   buffered  - STREAM_PAGES=0, the task board is read lazily but the page is still rendered into one string
+#   streamed  - STREAM_PAGES=1, the page is sent in chunks as it renders
+# Each mode runs in its own process so its peak RSS can be compared. The page cache is off, so every request renders
+# the page from the database
+# Usage: python benchmarks/bench_streaming.py [--tasks 5000] [--messages 50000] [--requests 20]
+
+MODES = ['loaded', 'buffered', 'streamed']
+
+def request_page(client, path):
+    '''Request a page and read it chunk by chunk. Returns (ms to the first chunk, ms to the end, bytes).'''
+    start = time.perf_counter()
+    response = client.get(path, buffered=False)
+    assert response.status_code == 200, f'{path} answered {response.status}'
+    chunks = iter(response.response)
+    first = next(chunks)
+    ttfb = time.perf_counter() - start
+    size = len(first) + sum(len(chunk) for chunk in chunks)
+    response.close()
+    return ttfb * 1000, (time.perf_counter() - start) * 1000, size
+
+def current_rss_kb():
+    '''Resident set size of this process right now. ru_maxrss only gives the peak so far.'''
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+def run_mode(mode, path, project_id, user_id, requests):
+    '''Measure one mode in this process.'''
+    os.environ['STREAM_PAGES'] = '0' if mode != 'streamed' else '1'
+    os.environ['PURGE_IN_BACKGROUND'] = '0'  # Nothing to purge, and no thread holding a connection across init_pool
+    import app as application
+    import cache
+    import db
+    import models
+    from flask import render_template
+
+    db.init_pool(path)
+    cache.cache = cache.MemoryCache(max_bytes=0)
+
+    page = f'/project/{project_id}'
+    if mode == 'loaded':
+        # The page as it was built before streaming: the whole view in lists, then one rendered string
+        page = f'/loaded{page}'
+
+        @application.app.route('/loaded/project/<int:project_id>')
+        def loaded(project_id):
+            view = db.load_project_view(project_id, user_id)
+            return render_template('project.html', isAdmin=view['role'] == 'admin', username=view['username'],
+                                   projects=view['projects'], project_id=project_id, project_name=view['project_name'],
+                                   tasks=[models.dumps(view['tasks'])], members=view['members'],
+                                   message_page=lambda: (view['messages'], view['has_more_messages']),
+                                   last_event_id=0, version=view['version'], timezone=view['timezone'], flush='')
+
+    client = application.app.test_client()
+    common.login(client, user_id)
+    baseline_rss = current_rss_kb()
+
+    samples = [request_page(client, page) for _ in range(requests)]
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    tracemalloc.start()
+    request_page(client, page)
+    _, peak_traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'page_bytes': samples[-1][2],
+        'ttfb_p50_ms': round(common.percentile([sample[0] for sample in samples], 50), 3),
+        'total_p50_ms': round(common.percentile([sample[1] for sample in samples], 50), 3),
+        'peak_rss_growth_kb': max(0, peak_rss - baseline_rss),
+        'peak_python_allocations_kb': peak_traced // 1024,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare streamed and buffered project page renders.')
+    parser.add_argument('--tasks', type=int, default=5000)
+    parser.add_argument('--messages', type=int, default=50000)
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--mode', choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument('--target', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        path, project_id, user_id = args.target.rsplit(':', 2)
+        print(json.dumps(run_mode(args.mode, path, int(project_id), int(user_id), args.requests)))
+        return
+
+    path, project_id, user_id = common.setup_database(tasks=args.tasks, messages=args.messages)
+    results = {}
+    for mode in MODES:
+        output = subprocess.run([sys.executable, __file__, '--mode', mode, '--target', f'{path}:{project_id}:{user_id}',
+                                 '--requests', str(args.requests)], capture_output=True, text=True, check=True).stdout
+        results[mode] = json.loads(output.strip().splitlines()[-1])
+
+    # Every mode must have sent the same whole page, not an error page or a redirect
+    sizes = {result['page_bytes'] for result in results.values()}
+    assert len(sizes) == 1 and min(sizes) > 100 * args.tasks, f'Modes sent different pages: {sizes}'
+
+    print(json.dumps({'tasks': args.tasks, 'messages': args.messages, 'results': results}, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"use strict";
+
+// Build time, DOM size and memory of the task board for a large project, without a browser
+// static/scripts/taskboard.js runs unchanged against a minimal stand-in for the DOM, next to the board as it was built
+// before tasks were indexed and columns virtualized. Opening tasks shows whether the DOM keeps growing
+// Usage: node --expose-gc benchmarks/bench_taskboard.js [tasks] [clicks]
+
+const fs = require("fs");
+const path = require("path");
+const vm = require("vm");
+
+const TASKS = Number(process.argv[2] || 5000);
+const CLICKS = Number(process.argv[3] || 200);
+const STATUSES = ["todo", "designing", "inProgress", "testing", "done"];
+
+// Just enough of the DOM for the task board scripts
+class Element {
+    constructor(tagName) {
+        this.tagName = tagName;
+        this.children = [];
+        this.dataset = {};
+        this.style = {};
+        this.attributes = {};
+        this.listeners = {};
+        this.classes = new Set();
+        this.classList = { add: (...names) => names.forEach(name => this.classes.add(name)), contains: name => this.classes.has(name) };
+        this.textContent = "";
+        this.scrollTop = 0;
+        this.clientHeight = tagName === "ul" ? 600 : 0;
+        this.innerElements = 0;
+    }
+    appendChild(child) {
+        if (child.tagName === "#fragment") {
+            this.children.push(...child.children);
+            child.children = [];
+        } else {
+            this.children.push(child);
+        }
+        return child;
+    }
+    replaceChildren(...nodes) {
+        this.children = [];
+        nodes.forEach(node => this.appendChild(node));
+    }
+    setAttribute(name, value) {
+        this.attributes[name] = String(value);
+    }
+    addEventListener(type, listener) {
+        (this.listeners[type] = this.listeners[type] || []).push(listener);
+    }
+    set innerHTML(html) {
+        this.html = html;
+        this.innerElements = (html.match(/<[a-z]/g) || []).length;  // Elements the browser would create
+    }
+    get size() {
+        return 1 + this.innerElements + this.children.reduce((total, child) => total + child.size, 0);
+    }
+}
+
+let createDocument = tasks => {
+    let elements = {};
+    let body = new Element("body");
+    let add = (tagName, id, parent) => {
+        let element = elements[id] = new Element(tagName);
+        element.id = id;
+        parent.appendChild(element);
+        return element;
+    };
+    let columns = add("div", "columns", body);
+    STATUSES.forEach(status => add("ul", `${status}_list`, columns).classList.add("task_list"));
+    let variables = add("div", "variables", body);
+    variables.dataset.projectId = "1";
+    variables.dataset.tasksUrl = "/project/1/tasks";
+    variables.dataset.version = "1";
+    variables.dataset.tasks = JSON.stringify(tasks);
+    let modal = add("div", "taskModal", body);
+    ["taskModalLabel", "task_modal_description", "task_modal_assignees", "task_modal_status", "task_modal_status_select",
+     "task_modal_change_id", "task_modal_delete_id"].forEach(id => add("span", id, modal));
+
+    return {
+        body,
+        getElementById: id => elements[id] || null,
+        querySelector: selector => selector === "body" ? body : null,
+        querySelectorAll: selector => selector === ".task_list" ? STATUSES.map(status => elements[`${status}_list`]) : [],
+        createElement: tagName => new Element(tagName),
+        createDocumentFragment: () => new Element("#fragment"),
+        addEventListener: () => {},
+    };
+};
+
+// The board before this rewrite: every task scans every column, every click appends a new modal
+let oldBoard = document => () => {
+    let tasks = JSON.parse(document.getElementById("variables").dataset.tasks);
+    let columns = document.querySelectorAll(".task_list");
+    columns.forEach(column => column.replaceChildren());
+    tasks.forEach(task => {
+        let taskItem = document.createElement("li");
+        let anchor = document.createElement("a");
+        anchor.href = "#";
+        anchor.textContent = task["task_title"];
+        anchor.classList.add("taskModal");
+        anchor.setAttribute("data-bs-toggle", "modal");
+        anchor.setAttribute("data-bs-target", "#taskModal");
+        anchor.setAttribute("id", task["task_id"]);
+        anchor.setAttribute("data-description", task["task_description"]);
+        anchor.setAttribute("data-status", task["task_status"]);
+        taskItem.appendChild(anchor);
+        columns.forEach(column => {
+            if (column.id === task["task_status"] + "_list") {
+                column.appendChild(taskItem);
+            }
+        });
+    });
+
+    return taskId => {
+        let assignees = [];
+        for (let i = 0; i < tasks.length; i++) {
+            if (tasks[i]["task_id"] == taskId) {
+                assignees = tasks[i]["assigned_members"];
+            }
+        }
+        let modal = document.createElement("div");
+        modal.innerHTML = `<div><div><div><h5></h5><button></button></div><div><p></p><h5></h5><ul>${assignees.map(a => `<li>${a}</li>`).join("")}</ul>`
+            + `<p><strong></strong></p><h5></h5><form><input><input><select><option><option><option><option><option></select>`
+            + `<button></button></form><form><input><input><button></button></form></div><div><button></button></div></div></div>`;
+        document.querySelector("body").appendChild(modal);
+    };
+};
+
+let newBoard = (document, script) => {
+    let context = vm.createContext({
+        document,
+        window: { innerHeight: 900 },
+        requestAnimationFrame: callback => callback(),
+        bootstrap: { Modal: { getOrCreateInstance: () => ({ show() {} }), getInstance: () => ({ hide() {} }) } },
+        fetch: async () => ({ ok: false }),
+    });
+    return () => {
+        script.runInContext(context);
+        let openTask = vm.runInContext("openTask", context);
+        return taskId => openTask(taskId);
+    };
+};
+
+let heapUsed = () => {
+    if (global.gc) {
+        global.gc();
+    }
+    return process.memoryUsage().heapUsed;
+};
+
+// `prepare` sets up everything that isn't part of building the board and returns a function that builds it
+let measure = (prepare, tasks) => {
+    let document = createDocument(tasks);
+    let build = prepare(document);
+    let before = heapUsed();
+    let start = process.hrtime.bigint();
+    let open = build();
+    let buildMs = Number(process.hrtime.bigint() - start) / 1e6;
+    let nodesAfterBuild = document.body.size;
+    let heapAfterBuild = heapUsed() - before;
+
+    start = process.hrtime.bigint();
+    for (let i = 0; i < CLICKS; i++) {
+        open(tasks[(i * 7919) % tasks.length]["task_id"]);
+    }
+    let clickMs = Number(process.hrtime.bigint() - start) / 1e6 / CLICKS;
+
+    return {
+        build_ms: Number(buildMs.toFixed(2)),
+        dom_nodes_after_build: nodesAfterBuild,
+        heap_after_build_kb: Math.round(heapAfterBuild / 1024),
+        open_task_ms: Number(clickMs.toFixed(3)),
+        dom_nodes_after_clicks: document.body.size,
+        heap_after_clicks_kb: Math.round((heapUsed() - before) / 1024),
+        document,  // Keeps the board alive until it has been measured
+    };
+};
+
+let tasks = [];
+for (let i = 0; i < TASKS; i++) {
+    tasks.push({
+        task_id: i + 1,
+        task_title: `Task ${i} ${"title ".repeat(i % 5)}`,
+        task_description: `Description of task ${i}`,
+        task_status: STATUSES[i % STATUSES.length],
+        assigned_members: [`user${i % 7}`, `user${(i + 3) % 7}`],
+    });
+}
+
+const script = new vm.Script(fs.readFileSync(path.join(__dirname, "..", "static", "scripts", "taskboard.js"), "utf8"));
+let results = {
+    old: measure(oldBoard, tasks),
+    new: measure(document => newBoard(document, script), tasks),
+};
+Object.values(results).forEach(result => delete result.document);
+console.log(JSON.stringify({ tasks: TASKS, clicks: CLICKS, gc: Boolean(global.gc), results }, null, 2));
@@ -0,0 +1,72 @@
+import json
+import random
+import time
+from datetime import datetime, timedelta
+import common
+import models
+
+# Micro-benchmark of message timestamp localization
+# Compares the old eager strptime/pytz conversion in Message.__init__ with lazy and batch conversion
+# Usage: python benchmarks/bench_timestamps.py [messages]
+
+def make_timestamps(count):
+    '''Build a chat-like history: bursts of messages a few seconds apart.'''
+    now = datetime(2024, 1, 1)
+    timestamps = []
+    for _ in range(count):
+        now += timedelta(seconds=random.choice([2, 5, 30, 600]))
+        timestamps.append(now.strftime('%Y-%m-%d %H:%M:%S'))
+    return timestamps
+
+def eager_pytz(timestamps):
+    '''The conversion Message.__init__ used to do for every message.'''
+    from pytz import timezone, utc
+    for date_time in timestamps:
+        dt_object = datetime.strptime(date_time, '%Y-%m-%d %H:%M:%S').replace(tzinfo=utc)
+        local_dt = dt_object.astimezone(timezone('America/New_York'))
+        local_dt.strftime('%m/%d'), local_dt.strftime('%I:%M %p')
+
+def construct_only(timestamps):
+    '''Build messages without reading date/time, e.g. messages that are never displayed.'''
+    for i, date_time in enumerate(timestamps):
+        models.Message(i, '', 1, 1, date_time)
+
+def lazy_read(timestamps):
+    '''Build messages and read date/time one by one.'''
+    models._localize_minute.cache_clear()
+    for i, date_time in enumerate(timestamps):
+        message = models.Message(i, '', 1, 1, date_time)
+        message.date, message.time
+
+def batch(timestamps):
+    '''Build messages and convert them in one batch.'''
+    messages = [models.Message(i, '', 1, 1, date_time) for i, date_time in enumerate(timestamps)]
+    models.localize_messages(messages)
+    for message in messages:
+        message.date, message.time
+
+def timed(function, timestamps, repeat=5):
+    '''Return the best time in milliseconds over a few runs.'''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(timestamps)
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best, 3)
+
+def main(count=10000):
+    timestamps = make_timestamps(count)
+    results = {'messages': count}
+    try:
+        results['eager_pytz_ms'] = timed(eager_pytz, timestamps)
+    except ImportError:
+        results['eager_pytz_ms'] = None  # pytz is no longer a dependency
+    results['construct_only_ms'] = timed(construct_only, timestamps)
+    results['lazy_read_ms'] = timed(lazy_read, timestamps)
+    results['batch_ms'] = timed(batch, timestamps)
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    import sys
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
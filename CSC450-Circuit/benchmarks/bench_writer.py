@@ -0,0 +1,82 @@
+import argparse
+import json
+import sqlite3
+import threading
+import time
+import common
+import db
+
+# Concurrent chat writes, each committed on its own connection the way db.add_message used to, against the single
+# writer that commits whatever is queued together (writer.py)
+# Every thread posts --writes messages as fast as it can. Reported: throughput, latency, failed writes ("database is
+# locked" once a write waits longer than busy_timeout) and the number of transactions committed
+# --synchronous full makes every commit wait for fsync, where batching matters most (try WRITE_MAX_WAIT_MS=1 there)
+# Usage: python benchmarks/bench_writer.py [--threads 32] [--writes 200] [--synchronous normal|full]
+
+def own_transaction(content, user_id, project_id):
+    '''The previous add_message: borrow a connection, write and commit alone.'''
+    with db.connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('UPDATE Project SET version = version + 1 WHERE project_id = ?', (project_id,))
+        cursor.execute('''
+            INSERT INTO Message (content, sender_id, project_id)
+            VALUES (?, ?, ?)
+            RETURNING message_id, timestamp
+        ''', (content, user_id, project_id))
+        cursor.fetchone()
+        conn.commit()
+
+def run(add_message, project_id, user_id, threads, writes):
+    samples = []
+    errors = []
+    barrier = threading.Barrier(threads)
+
+    def chat(number):
+        barrier.wait()
+        for i in range(writes):
+            start = time.perf_counter()
+            try:
+                add_message(f'Message {i} from thread {number}', user_id, project_id)
+            except sqlite3.OperationalError as error:
+                errors.append(str(error))
+                continue
+            samples.append((time.perf_counter() - start) * 1000)
+
+    batches = db.writer.batches
+    workers = [threading.Thread(target=chat, args=(number,)) for number in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    return {
+        'writes_per_second': round(len(samples) / elapsed),
+        'p50_ms': round(common.percentile(samples, 50), 3),
+        'p99_ms': round(common.percentile(samples, 99), 3),
+        'max_ms': round(max(samples), 3),
+        'failed': len(errors),
+        'transactions': len(samples) if add_message is own_transaction else db.writer.batches - batches,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare per-request commits with the single writer.')
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--writes', type=int, default=200)
+    parser.add_argument('--synchronous', choices=['normal', 'full'], default='normal')
+    args = parser.parse_args()
+
+    db.PRAGMAS = tuple(pragma.replace('synchronous = NORMAL', f'synchronous = {args.synchronous.upper()}')
+                       for pragma in db.PRAGMAS)
+    path, project_id, user_id = common.setup_database(tasks=0, messages=0)
+    db.init_pool(path, size=args.threads)
+    results = {
+        'own_transaction': run(own_transaction, project_id, user_id, args.threads, args.writes),
+        'single_writer': run(db.add_message, project_id, user_id, args.threads, args.writes),
+    }
+    print(json.dumps({'threads': args.threads, 'writes_per_thread': args.writes, 'synchronous': args.synchronous,
+                      'results': results, 'largest_batch': db.writer.largest_batch}, indent=2))
+
+if __name__ == '__main__':
+    main()
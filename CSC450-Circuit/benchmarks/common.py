@@ -0,0 +1,57 @@
+import os
+import sys
+import sqlite3
+import tempfile
+from werkzeug.security import generate_password_hash
+
+# Shared helpers for the benchmark scripts in this folder
+# Each benchmark builds its own throwaway database so the real database.db is never touched
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='circuit-bench-'), 'database.db')
+
+import create_db
+import db
+
+def setup_database(tasks=50, assignees=2, messages=200, members=5):
+    '''Add one project to the temporary benchmark database. Returns (path, project_id, user_id).'''
+    path = db.db_path
+    create_db.create_db(path)
+
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    password = generate_password_hash('password', method='pbkdf2:sha256:1')  # Cheap hash, login cost is not measured here
+    cursor.executemany('INSERT OR IGNORE INTO User (username, password) VALUES (?, ?)',
+                       [(f'user{i}', password) for i in range(members)])
+    user_ids = [cursor.execute('SELECT user_id FROM User WHERE username = ?', (f'user{i}',)).fetchone()[0] for i in range(members)]
+    cursor.execute("INSERT INTO Project (project_name) VALUES ('Benchmark')")
+    project_id = cursor.lastrowid
+    cursor.executemany('INSERT INTO Project_User (project_id, user_id, role) VALUES (?, ?, ?)',
+                       [(project_id, user_id, 'admin' if i == 0 else 'Member') for i, user_id in enumerate(user_ids)])
+
+    statuses = ['todo', 'designing', 'inProgress', 'testing', 'done']
+    for i in range(tasks):
+        cursor.execute('INSERT INTO Task (task_title, task_description, task_status, project_id) VALUES (?, ?, ?, ?)',
+                       (f'Task {i}', f'Description for task {i}', statuses[i % len(statuses)], project_id))
+        task_id = cursor.lastrowid
+        cursor.executemany('INSERT INTO Task_User (task_id, user_id) VALUES (?, ?)',
+                           [(task_id, user_ids[(i + j) % members]) for j in range(min(assignees, members))])
+
+    cursor.executemany("INSERT INTO Message (content, sender_id, project_id, timestamp) VALUES (?, ?, ?, datetime('now', ?))",
+                       [(f'Message {i}', user_ids[i % members], project_id, f'-{messages - i} minutes') for i in range(messages)])
+    conn.commit()
+    conn.close()
+
+    return path, project_id, user_ids[0]
+
+def login(client, user_id):
+    '''Log a Flask test client in without going through the password check.'''
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+
+def percentile(samples, p):
+    '''Return the p-th percentile (0-100) of a list of samples.'''
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
@@ -0,0 +1,134 @@
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import time
+
+# Fills a database with synthetic users, projects, members, tasks, assignments and messages
+# Project sizes follow a Zipf-like distribution (--skew), so a few projects are huge and most are small, the way real
+# team tools look. Every user gets the same password so load tests can log in through /login
+# Usage: python benchmarks/generate_data.py [--path database.db] [--users 1000] [--projects 200] ...
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import create_db
+from passwords import hasher
+
+STATUSES = ['todo', 'designing', 'inProgress', 'testing', 'done']
+WORDS = ('deploy release review design meeting bug fix test build api database page login task board chat update '
+         'client server merge branch schedule sprint demo feedback question answer thanks today tomorrow please '
+         'done blocked ready draft ship check issue error slow fast cache index query').split()
+
+def split(total, weights, rng):
+    '''Split `total` items in proportion to `weights`.'''
+    scale = total / sum(weights)
+    sizes = [int(weight * scale) for weight in weights]
+    for index in rng.sample(range(len(sizes)), total - sum(sizes)):  # Hand out the rounding remainder
+        sizes[index] += 1
+    return sizes
+
+def sentence(rng, low, high):
+    '''Random text of `low` to `high` words.'''
+    return ' '.join(rng.choices(WORDS, k=rng.randint(low, high)))
+
+def generate(path, users=1000, projects=200, members=8, tasks=20000, assignees=2, messages=200000, skew=1.1,
+             days=365, password='password', seed=1):
+    '''Add synthetic data to the database at `path`, creating or migrating it first. Returns a summary dictionary.'''
+    rng = random.Random(seed)
+    create_db.create_db(path)
+
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA synchronous = OFF')  # Bulk load, durability doesn't matter here
+    cursor = conn.cursor()
+    start = time.perf_counter()
+
+    # Users all share one real hash, made with the configured method so logins cost what they do in production
+    hashed_password = hasher.hash(password)
+    prefix = f'user{int(time.time())}_'
+    cursor.executemany('INSERT INTO User (username, password) VALUES (?, ?)',
+                       [(f'{prefix}{i}', hashed_password) for i in range(users)])
+    user_ids = [row[0] for row in cursor.execute('SELECT user_id FROM User WHERE username LIKE ?', (prefix + '%',))]
+
+    project_ids = []
+    for i in range(projects):
+        cursor.execute('INSERT INTO Project (project_name) VALUES (?)', (f'Project {i}',))
+        project_ids.append(cursor.lastrowid)
+
+    # Zipf-like project sizes, shuffled so the big projects aren't always the first. A big project has more members,
+    # tasks and messages alike
+    weights = [1 / (rank + 1) ** skew for rank in range(projects)]
+    rng.shuffle(weights)
+    member_counts = [max(1, min(users, size)) for size in split(members * projects, weights, rng)]
+    task_counts = split(tasks, weights, rng)
+    message_counts = split(messages, weights, rng)
+
+    now = time.time()
+    task_total = message_total = assignment_total = 0
+    for project_id, member_count, task_count, message_count in zip(project_ids, member_counts, task_counts,
+                                                                  message_counts):
+        project_members = rng.sample(user_ids, member_count)
+        cursor.executemany('INSERT INTO Project_User (project_id, user_id, role) VALUES (?, ?, ?)',
+                           [(project_id, user_id, 'admin' if i == 0 else 'Member')
+                            for i, user_id in enumerate(project_members)])
+
+        for _ in range(task_count):
+            cursor.execute('INSERT INTO Task (task_title, task_description, task_status, project_id) VALUES (?, ?, ?, ?)',
+                           (sentence(rng, 2, 6).capitalize(), sentence(rng, 5, 30), rng.choice(STATUSES), project_id))
+            chosen = rng.sample(project_members, min(member_count, rng.randint(0, assignees * 2)))
+            cursor.executemany('INSERT INTO Task_User (task_id, user_id) VALUES (?, ?)',
+                               [(cursor.lastrowid, user_id) for user_id in chosen])
+            assignment_total += len(chosen)
+        task_total += task_count
+
+        # Messages arrive in timestamp order, spread over the last `days` days
+        offsets = sorted((rng.random() * days * 86400 for _ in range(message_count)), reverse=True)
+        for batch_start in range(0, message_count, 10000):
+            cursor.executemany('''
+                INSERT INTO Message (content, sender_id, project_id, timestamp)
+                VALUES (?, ?, ?, datetime(?, 'unixepoch'))
+            ''', [(sentence(rng, 3, 25), rng.choice(project_members), project_id, now - offset)
+                  for offset in offsets[batch_start:batch_start + 10000]])
+        message_total += message_count
+
+    conn.commit()
+    conn.execute('ANALYZE')
+    conn.close()
+
+    biggest = max(range(projects), key=lambda index: message_counts[index])
+    return {
+        'path': path,
+        'users': len(user_ids),
+        'projects': len(project_ids),
+        'memberships': sum(member_counts),
+        'tasks': task_total,
+        'assignments': assignment_total,
+        'messages': message_total,
+        'largest_project': {'project_id': project_ids[biggest], 'members': member_counts[biggest],
+                            'tasks': task_counts[biggest], 'messages': message_counts[biggest]},
+        'username_prefix': prefix,
+        'password': password,
+        'seconds': round(time.perf_counter() - start, 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Fill a Circuit database with synthetic data.')
+    parser.add_argument('--path', default=create_db.db_path, help='database file, default DATABASE_PATH or database.db')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--projects', type=int, default=200)
+    parser.add_argument('--members', type=int, default=8, help='average members per project')
+    parser.add_argument('--tasks', type=int, default=20000, help='total tasks')
+    parser.add_argument('--assignees', type=int, default=2, help='average assignees per task')
+    parser.add_argument('--messages', type=int, default=200000, help='total messages')
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent of project sizes, 0 makes them even')
+    parser.add_argument('--days', type=int, default=365, help='days of message history')
+    parser.add_argument('--password', default='password', help='password of every generated user')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print(json.dumps(generate(**vars(args)), indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# Load test that drives the real routes with a weighted mix of page views, chat messages, status changes and logins
+# --mode client runs the app in this process through Flask's test client, one client per virtual user thread
+# --mode http sends real HTTP requests to a running server (--url), which must use the database given with --path
+# Results are printed as JSON, per route and overall, so runs can be saved and compared
+# Usage:
+#   python benchmarks/generate_data.py --path /tmp/load.db
+#   python benchmarks/load_test.py --path /tmp/load.db --users 16 --duration 30
+#   python benchmarks/load_test.py --mode http --url http://127.0.0.1:5000 --path /tmp/load.db --users 64
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DEFAULT_MIX = 'dashboard=30,project=40,send_message=15,change_status=10,login=5'
+STATUSES = ['todo', 'designing', 'inProgress', 'testing', 'done']
+
+# Times a virtual user tries to log in before the run starts
+LOGIN_ATTEMPTS = 20
+
+def percentile(samples, p):
+    '''Return the p-th percentile (0-100) of a list of samples.'''
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def load_targets(path, sample_tasks=200):
+    '''Read who can be logged in as and which projects and tasks they can act on.
+
+    Returns a list of (username, [(project_id, [task_id, ...]), ...]) for every user with at least one project.
+    '''
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    tasks = {}
+    for project_id, task_id in conn.execute('''
+        SELECT project_id, task_id FROM (
+            SELECT project_id, task_id, ROW_NUMBER() OVER (PARTITION BY project_id ORDER BY task_id DESC) AS n FROM Task
+        ) WHERE n <= ?
+    ''', (sample_tasks,)):
+        tasks.setdefault(project_id, []).append(task_id)
+
+    users = {}
+    for username, project_id in conn.execute('''
+        SELECT User.username, Project_User.project_id FROM Project_User
+        JOIN User ON User.user_id = Project_User.user_id
+        JOIN Project ON Project.project_id = Project_User.project_id
+        WHERE Project.deleted_at IS NULL
+    '''):
+        users.setdefault(username, []).append((project_id, tasks.get(project_id, [])))
+    conn.close()
+    return list(users.items())
+
+
+class ClientSession:
+    '''A virtual user talking to the app in this process through Flask's test client.'''
+
+    def __init__(self, app, url=None):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data)
+        response.get_data()  # Streamed pages are only rendered as their body is read
+        response.close()
+        return response.status_code, response.headers.get('Location')
+
+
+class HttpSession:
+    '''A virtual user talking to a running server over HTTP, with its own cookies and no redirect following.'''
+
+    class NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    def __init__(self, app, url):
+        self.url = url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), self.NoRedirect)
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        try:
+            with self.opener.open(urllib.request.Request(self.url + path, body, method=method), timeout=60) as response:
+                response.read()
+                return response.status, response.headers.get('Location')
+        except urllib.error.HTTPError as error:
+            error.read()
+            return error.code, error.headers.get('Location')
+
+
+class VirtualUser:
+    '''Logs in as one user and then performs weighted random actions on their projects.'''
+
+    def __init__(self, session, username, projects, password, rng):
+        self.session = session
+        self.username = username
+        self.projects = projects
+        self.password = password
+        self.rng = rng
+
+    def login(self):
+        status, location = self.session.request('POST', '/login',
+                                                {'username': self.username, 'password': self.password})
+        return status == 302 and (location or '').endswith('/dashboard')
+
+    def dashboard(self):
+        return self.session.request('GET', '/dashboard')[0] == 200
+
+    def project(self):
+        project_id, _ = self.rng.choice(self.projects)
+        return self.session.request('GET', f'/project/{project_id}')[0] == 200
+
+    def send_message(self):
+        project_id, _ = self.rng.choice(self.projects)
+        status, _ = self.session.request('POST', '/project/send_message',
+                                         {'project_id': project_id, 'message': f'Load test message {self.rng.random()}'})
+        return status == 302
+
+    def change_status(self):
+        project_id, tasks = self.rng.choice(self.projects)
+        if not tasks:
+            return self.project()  # Nothing to change in this project, view it instead
+        status, _ = self.session.request('POST', '/project/change_status', {
+            'project_id': project_id, 'task_id': self.rng.choice(tasks), 'task_status': self.rng.choice(STATUSES)})
+        return status == 302
+
+
+def parse_mix(mix):
+    '''Parse "route=weight,..." into parallel lists of action names and weights.'''
+    actions, weights = [], []
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        if not hasattr(VirtualUser, name.strip()):
+            raise SystemExit(f'Unknown action in --mix: {name}')
+        actions.append(name.strip())
+        weights.append(float(weight or 1))
+    return actions, weights
+
+def run(session_class, app, url, targets, users, duration, requests, mix, password, seed):
+    '''Run `users` virtual users until `duration` seconds pass or each made `requests` requests.'''
+    actions, weights = parse_mix(mix)
+    samples = {action: [] for action in actions}
+    errors = {action: 0 for action in actions}
+    failed_logins = []
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(users + 1)
+
+    def virtual_user(index):
+        rng = random.Random(seed + index)
+        username, projects = rng.choice(targets)
+        user = VirtualUser(session_class(app, url), username, projects, password, rng)
+        # Retry the first login like a person would, a burst of logins can be turned away with 503 by design
+        logged_in = False
+        for attempt in range(LOGIN_ATTEMPTS):
+            try:
+                logged_in = user.login()
+            except Exception:
+                pass
+            if logged_in:
+                break
+            time.sleep(rng.uniform(0.1, 0.5))
+        start_barrier.wait()
+        if not logged_in:
+            failed_logins.append(username)  # This virtual user sits the run out
+            return
+
+        deadline = time.monotonic() + duration if duration else None
+        count = 0
+        while (deadline is None or time.monotonic() < deadline) and (not requests or count < requests):
+            action = rng.choices(actions, weights)[0]
+            started = time.perf_counter()
+            try:
+                ok = getattr(user, action)()
+            except Exception:
+                ok = False
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                samples[action].append(elapsed)
+                if not ok:
+                    errors[action] += 1
+            count += 1
+
+    threads = [threading.Thread(target=virtual_user, args=(index,)) for index in range(users)]
+    for thread in threads:
+        thread.start()
+    start_barrier.wait()  # Logins before the clock starts aren't part of the measurement
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    def summarize(values, error_count):
+        if not values:
+            return {'requests': 0, 'errors': error_count}
+        return {
+            'requests': len(values),
+            'errors': error_count,
+            'throughput_rps': round(len(values) / wall, 1),
+            'p50_ms': round(percentile(values, 50), 3),
+            'p95_ms': round(percentile(values, 95), 3),
+            'p99_ms': round(percentile(values, 99), 3),
+            'max_ms': round(max(values), 3),
+        }
+
+    everything = [value for values in samples.values() for value in values]
+    return {
+        'wall_s': round(wall, 2),
+        'total': summarize(everything, sum(errors.values())),
+        'failed_logins': len(failed_logins),
+        'routes': {action: summarize(samples[action], errors[action]) for action in actions},
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the Circuit routes and report latency percentiles as JSON.')
+    parser.add_argument('--mode', choices=['client', 'http'], default='client')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='server to test in http mode')
+    parser.add_argument('--path', default=os.getenv('DATABASE_PATH'), required=not os.getenv('DATABASE_PATH'),
+                        help='database filled by generate_data.py, the one the app under test uses')
+    parser.add_argument('--users', type=int, default=8, help='concurrent virtual users')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to run, 0 to use --requests only')
+    parser.add_argument('--requests', type=int, default=0, help='requests per virtual user, 0 for no limit')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'weighted actions, default {DEFAULT_MIX}')
+    parser.add_argument('--password', default='password', help='password given to generate_data.py')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='also write the JSON report to this file')
+    args = parser.parse_args()
+    if not args.duration and not args.requests:
+        parser.error('set --duration or --requests')
+
+    app = None
+    session_class = HttpSession
+    if args.mode == 'client':
+        os.environ['DATABASE_PATH'] = args.path  # Must be set before the app and db modules are imported
+        from app import app
+        session_class = ClientSession
+
+    targets = load_targets(args.path)
+    if not targets:
+        raise SystemExit('No users with projects in the database, run generate_data.py first')
+
+    report = {
+        'mode': args.mode,
+        'users': args.users,
+        'mix': args.mix,
+        **run(session_class, app, args.url, targets, args.users, args.duration, args.requests, args.mix,
+              args.password, args.seed),
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+if __name__ == '__main__':
+    main()
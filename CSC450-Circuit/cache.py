@@ -0,0 +1,206 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import metrics
+
+# Cache of rendered pages and page data, so reads with no writes in between don't rebuild them
+# Nothing is ever invalidated explicitly. Keys include the project's and the viewer's version numbers, which every
+# mutating db.* function bumps, so a write makes the old entries unreachable and LRU eviction reclaims them
+# MemoryCache keeps entries in this process. SQLiteCache shares them between worker processes on one machine through
+# a small local database, select it with PAGE_CACHE=sqlite. Values are pickled in both, so cached objects are never
+# shared between requests
+
+# Most bytes of pickled values kept, 0 turns caching off
+MAX_BYTES = int(os.getenv('PAGE_CACHE_BYTES', 64 * 1024 * 1024))
+
+# How often SQLiteCache records that an entry was read again. Recording every hit would turn reads into writes
+TOUCH_INTERVAL = 30
+
+
+class MemoryCache:
+    '''Least recently used cache in this process, capped at a total size in bytes.'''
+
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> pickled value, least recently used first
+
+    def get(self, key):
+        '''Return the cached value or None.'''
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return pickle.loads(data)
+
+    def set(self, key, value):
+        '''Store a value, evicting the least recently used entries to stay under the size cap.'''
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteCache:
+    '''Least recently used cache shared by worker processes through a local SQLite file.
+
+    Hits and misses are counted per process. Recency is tracked to within TOUCH_INTERVAL seconds.
+    '''
+
+    def __init__(self, path, max_bytes=MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._touched = {}  # key -> when this process last recorded a read
+
+        conn = self._connection()
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('BEGIN IMMEDIATE')  # Another worker may be setting up the same file
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS Cache (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                used REAL NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_used ON Cache (used)')
+
+        # Running total of the sizes, kept by triggers so a write can check the cap without summing every entry
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS Cache_Size (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                total INTEGER NOT NULL
+            )
+        ''')
+        conn.execute('INSERT OR IGNORE INTO Cache_Size (id, total) SELECT 1, COALESCE(SUM(size), 0) FROM Cache')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS cache_size_insert AFTER INSERT ON Cache BEGIN
+                UPDATE Cache_Size SET total = total + new.size;
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS cache_size_update AFTER UPDATE OF size ON Cache BEGIN
+                UPDATE Cache_Size SET total = total + new.size - old.size;
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS cache_size_delete AFTER DELETE ON Cache BEGIN
+                UPDATE Cache_Size SET total = total - old.size;
+            END
+        ''')
+        conn.commit()
+
+    def _connection(self):
+        # One connection per thread, like the event broker
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA synchronous = OFF')  # Losing cache entries in a crash is harmless
+        return conn
+
+    def get(self, key):
+        '''Return the cached value or None.'''
+        conn = self._connection()
+        row = conn.execute('SELECT value FROM Cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+
+        now = time.time()
+        if now - self._touched.get(key, 0) > TOUCH_INTERVAL:
+            self._touched[key] = now
+            conn.execute('UPDATE Cache SET used = ? WHERE key = ?', (now, key))
+            conn.commit()
+        return pickle.loads(row[0])
+
+    def set(self, key, value):
+        '''Store a value, evicting the least recently used entries to stay under the size cap.'''
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return
+        conn = self._connection()
+        # An upsert and not INSERT OR REPLACE, whose implicit delete would not fire the size trigger
+        conn.execute('''
+            INSERT INTO Cache (key, value, size, used) VALUES (?, ?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET value = excluded.value, size = excluded.size, used = excluded.used
+        ''', (key, data, len(data), time.time()))
+
+        excess = self.size - self.max_bytes
+        if excess > 0:
+            # Walk the entries from least recently used until enough bytes are freed
+            freed, keys = 0, []
+            for old_key, size in conn.execute('SELECT key, size FROM Cache ORDER BY used'):
+                if freed >= excess:
+                    break
+                freed += size
+                keys.append((old_key,))
+            conn.executemany('DELETE FROM Cache WHERE key = ?', keys)
+        conn.commit()
+
+    @property
+    def size(self):
+        return self._connection().execute('SELECT total FROM Cache_Size').fetchone()[0]
+
+    def clear(self):
+        conn = self._connection()
+        conn.execute('DELETE FROM Cache')
+        conn.commit()
+        self._touched.clear()
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM Cache').fetchone()[0]
+
+
+def create_cache():
+    '''Create the cache selected by the PAGE_CACHE environment variable.'''
+    if os.getenv('PAGE_CACHE') == 'sqlite':
+        default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache.db')
+        return SQLiteCache(os.getenv('PAGE_CACHE_PATH', default_path))
+    return MemoryCache()
+
+cache = create_cache()
+
+def get_or_build(key, build):
+    '''Return the cached value for `key`, or call `build()` and cache its result. None results are not cached.'''
+    value = cache.get(key)
+    if value is None:
+        value = build()
+        if value is not None:
+            cache.set(key, value)
+    return value
+
+metrics.registry.register_gauge('circuit_page_cache_hits', 'Page cache lookups that found an entry.',
+                                lambda: cache.hits)
+metrics.registry.register_gauge('circuit_page_cache_misses', 'Page cache lookups that found nothing.',
+                                lambda: cache.misses)
+metrics.registry.register_gauge('circuit_page_cache_bytes', 'Bytes of cached values.', lambda: cache.size)
+metrics.registry.register_gauge('circuit_page_cache_entries', 'Cached entries.', lambda: len(cache))
@@ -1,17 +1,17 @@
 import sqlite3
 import os
+import archive
 
-# Run this script before running app.py to create the database and tables 
-# During deployment, the database will be hosted alongside the source files, so this script will not be needed
+# Creates the database and keeps its schema up to date
+# app.py runs the migrations at startup, but this script can also be run on its own
 
-def create_db():
-    '''Create the SQLite database and tables'''
-    # Connect to the SQLite database
-    conn = sqlite3.connect(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database.db'))
+db_path = os.getenv('DATABASE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database.db'))
 
-    # Create a cursor object to execute SQL commands
-    cursor = conn.cursor()
+# Each migration moves the schema forward by one version. The last applied version is stored in
+# PRAGMA user_version, so running the migrations again against an existing database is a no-op
 
+def create_tables(cursor):
+    '''Version 1: the original tables'''
     # Create the users table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS User (
@@ -77,8 +77,385 @@ def create_db():
         )
     ''')
 
-    # Commit the changes and close the connection
-    conn.commit()
+def add_indexes(cursor):
+    '''Version 2: secondary indexes for the per-project and per-user lookups in db.py'''
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_message_project_timestamp ON Message (project_id, timestamp)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_task_project_status ON Task (project_id, task_status)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_task_user_user ON Task_User (user_id, task_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_project_user_user ON Project_User (user_id, project_id, role)')
+
+def add_versions(cursor):
+    '''Version 3: per-project change counter for syncing the task board with ?since='''
+    cursor.execute('ALTER TABLE Project ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('ALTER TABLE Task ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_task_project_version ON Task (project_id, version)')
+
+    # Tombstones for deleted tasks, so clients learn about deletions too
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Task_Deleted (
+            task_id INTEGER PRIMARY KEY,
+            project_id INTEGER NOT NULL,
+            version INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_task_deleted_project_version ON Task_Deleted (project_id, version)')
+
+def add_user_timezone(cursor):
+    '''Version 4: time zone each user's messages are displayed in, NULL means the default'''
+    cursor.execute('ALTER TABLE User ADD COLUMN timezone TEXT')
+
+def rebuild_table(cursor, table, definition, columns, where=''):
+    '''Recreate a table with a new definition, keeping its rows and its AUTOINCREMENT counter.
+
+    SQLite can't add constraints to an existing table, so the rows are copied into a new one. `where` drops rows that
+    would violate the new constraints.
+    '''
+    sequence = cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (table,)).fetchone()
+    cursor.execute(f'CREATE TABLE {table}_new ({definition})')
+    cursor.execute(f'INSERT INTO {table}_new ({columns}) SELECT {columns} FROM {table} {where}')
+    cursor.execute(f'DROP TABLE {table}')
+    cursor.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+    if sequence:
+        # IDs of deleted rows must not be handed out again, Task_Deleted still refers to them
+        cursor.execute('UPDATE sqlite_sequence SET seq = ? WHERE name = ?', (sequence[0], table))
+
+def add_cascades(cursor):
+    '''Version 5: enforced ON DELETE CASCADE foreign keys, and soft-deleted projects that are purged in the background'''
+    # Runs with foreign key enforcement off (the default for this connection), as the table rebuilds require
+    cursor.execute('ALTER TABLE Project ADD COLUMN deleted_at DATETIME')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_project_deleted ON Project (deleted_at) WHERE deleted_at IS NOT NULL')
+
+    rebuild_table(cursor, 'Project_User', '''
+        project_id INTEGER,
+        user_id INTEGER,
+        role TEXT NOT NULL,
+        FOREIGN KEY (project_id) REFERENCES Project (project_id) ON DELETE CASCADE,
+        FOREIGN KEY (user_id) REFERENCES User (user_id) ON DELETE CASCADE,
+        PRIMARY KEY (project_id, user_id)
+    ''', 'project_id, user_id, role',
+        'WHERE project_id IN (SELECT project_id FROM Project) AND user_id IN (SELECT user_id FROM User)')
+
+    rebuild_table(cursor, 'Task', '''
+        task_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        task_title TEXT NOT NULL,
+        task_description TEXT,
+        task_status TEXT NOT NULL,
+        project_id INTEGER,
+        version INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY (project_id) REFERENCES Project (project_id) ON DELETE CASCADE
+    ''', 'task_id, task_title, task_description, task_status, project_id, version',
+        'WHERE project_id IN (SELECT project_id FROM Project)')
+
+    rebuild_table(cursor, 'Task_User', '''
+        task_id INTEGER,
+        user_id INTEGER,
+        FOREIGN KEY (task_id) REFERENCES Task (task_id) ON DELETE CASCADE,
+        FOREIGN KEY (user_id) REFERENCES User (user_id) ON DELETE CASCADE,
+        PRIMARY KEY (task_id, user_id)
+    ''', 'task_id, user_id',
+        'WHERE task_id IN (SELECT task_id FROM Task) AND user_id IN (SELECT user_id FROM User)')
+
+    rebuild_table(cursor, 'Task_Deleted', '''
+        task_id INTEGER PRIMARY KEY,
+        project_id INTEGER NOT NULL,
+        version INTEGER NOT NULL,
+        FOREIGN KEY (project_id) REFERENCES Project (project_id) ON DELETE CASCADE
+    ''', 'task_id, project_id, version',
+        'WHERE project_id IN (SELECT project_id FROM Project)')
+
+    # Messages outlive their sender's account
+    rebuild_table(cursor, 'Message', '''
+        message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        content TEXT NOT NULL,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        sender_id INTEGER,
+        project_id INTEGER,
+        FOREIGN KEY (sender_id) REFERENCES User (user_id) ON DELETE SET NULL,
+        FOREIGN KEY (project_id) REFERENCES Project (project_id) ON DELETE CASCADE
+    ''', 'message_id, content, timestamp, sender_id, project_id',
+        'WHERE project_id IN (SELECT project_id FROM Project)')
+
+    # Dropping the old tables dropped their indexes
+    add_indexes(cursor)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_task_project_version ON Task (project_id, version)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_task_deleted_project_version ON Task_Deleted (project_id, version)')
+
+    # Cascades from User look up its children by user, Message had no index for that
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_message_sender ON Message (sender_id)')
+
+def add_search(cursor):
+    '''Version 6: FTS5 full-text indexes over messages and tasks, kept in sync with triggers'''
+    # External content tables: the text is only stored once, in Message and Task. project_id is indexed as a token
+    # so a search can be narrowed to one project inside the full-text index itself
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS Message_fts USING fts5(
+            content, project_id,
+            content='Message', content_rowid='message_id', tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS Task_fts USING fts5(
+            task_title, task_description, project_id,
+            content='Task', content_rowid='task_id', tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+
+    # Default ranking for ORDER BY rank: project_id only filters, and a match in a task title counts most
+    cursor.execute("INSERT INTO Message_fts (Message_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)')")
+    cursor.execute("INSERT INTO Task_fts (Task_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0, 0.0)')")
+
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS message_fts_insert AFTER INSERT ON Message BEGIN
+            INSERT INTO Message_fts (rowid, content, project_id) VALUES (new.message_id, new.content, new.project_id);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS message_fts_delete AFTER DELETE ON Message BEGIN
+            INSERT INTO Message_fts (Message_fts, rowid, content, project_id)
+            VALUES ('delete', old.message_id, old.content, old.project_id);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS message_fts_update AFTER UPDATE OF content, project_id ON Message BEGIN
+            INSERT INTO Message_fts (Message_fts, rowid, content, project_id)
+            VALUES ('delete', old.message_id, old.content, old.project_id);
+            INSERT INTO Message_fts (rowid, content, project_id) VALUES (new.message_id, new.content, new.project_id);
+        END
+    ''')
+
+    # Status and version changes are frequent and don't touch the index, so only the searched columns trigger updates
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS task_fts_insert AFTER INSERT ON Task BEGIN
+            INSERT INTO Task_fts (rowid, task_title, task_description, project_id)
+            VALUES (new.task_id, new.task_title, new.task_description, new.project_id);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS task_fts_delete AFTER DELETE ON Task BEGIN
+            INSERT INTO Task_fts (Task_fts, rowid, task_title, task_description, project_id)
+            VALUES ('delete', old.task_id, old.task_title, old.task_description, old.project_id);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS task_fts_update AFTER UPDATE OF task_title, task_description, project_id ON Task BEGIN
+            INSERT INTO Task_fts (Task_fts, rowid, task_title, task_description, project_id)
+            VALUES ('delete', old.task_id, old.task_title, old.task_description, old.project_id);
+            INSERT INTO Task_fts (rowid, task_title, task_description, project_id)
+            VALUES (new.task_id, new.task_title, new.task_description, new.project_id);
+        END
+    ''')
+
+    # Index the rows that existed before this version
+    cursor.execute("INSERT INTO Message_fts (Message_fts) VALUES ('rebuild')")
+    cursor.execute("INSERT INTO Task_fts (Task_fts) VALUES ('rebuild')")
+
+def add_user_versions(cursor):
+    '''Version 7: per-user change counter, bumped when anything on the user's own pages changes'''
+    cursor.execute('ALTER TABLE User ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+
+def add_message_archive(cursor):
+    '''Version 8: index of the message blocks moved into the archive segments by archive.py'''
+    # Each row is one compressed block, located by segment file, byte offset and length
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Message_Archive (
+            block_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            project_id INTEGER NOT NULL,
+            segment INTEGER NOT NULL,
+            block_offset INTEGER NOT NULL,
+            block_length INTEGER NOT NULL,
+            message_count INTEGER NOT NULL,
+            first_timestamp DATETIME NOT NULL,
+            first_id INTEGER NOT NULL,
+            last_timestamp DATETIME NOT NULL,
+            last_id INTEGER NOT NULL,
+            FOREIGN KEY (project_id) REFERENCES Project (project_id) ON DELETE CASCADE
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_message_archive_project_last
+        ON Message_Archive (project_id, last_timestamp, last_id)
+    ''')
+
+# Task board columns and the Project_Summary columns counting their tasks
+SUMMARY_STATUS_COLUMNS = (
+    ('todo', 'todo_tasks'),
+    ('designing', 'designing_tasks'),
+    ('inProgress', 'in_progress_tasks'),
+    ('testing', 'testing_tasks'),
+    ('done', 'done_tasks'),
+)
+
+# Project_Summary rows computed from scratch, for filling the table and checking it (db.verify_project_summaries)
+SUMMARY_SELECT = f'''
+    SELECT project_id,
+        {', '.join(f"(SELECT COUNT(*) FROM Task WHERE project_id = Project.project_id AND task_status = '{status}')"
+                   for status, _ in SUMMARY_STATUS_COLUMNS)},
+        (SELECT COUNT(*) FROM Project_User WHERE project_id = Project.project_id),
+        (SELECT COUNT(*) FROM Message WHERE project_id = Project.project_id)
+            + (SELECT COALESCE(SUM(message_count), 0) FROM Message_Archive WHERE project_id = Project.project_id),
+        COALESCE((SELECT MAX(timestamp) FROM Message WHERE project_id = Project.project_id),
+                 (SELECT MAX(last_timestamp) FROM Message_Archive WHERE project_id = Project.project_id))
+    FROM Project
+'''
+
+def add_project_summary(cursor):
+    '''Version 9: per-project counters for the dashboard, kept up to date with triggers, and per-member read cursors'''
+    # message_count counts every message ever posted, archived ones too, so it only grows. A member's unread count is
+    # message_count - messages_read
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Project_Summary (
+            project_id INTEGER PRIMARY KEY,
+            todo_tasks INTEGER NOT NULL DEFAULT 0,
+            designing_tasks INTEGER NOT NULL DEFAULT 0,
+            in_progress_tasks INTEGER NOT NULL DEFAULT 0,
+            testing_tasks INTEGER NOT NULL DEFAULT 0,
+            done_tasks INTEGER NOT NULL DEFAULT 0,
+            member_count INTEGER NOT NULL DEFAULT 0,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            last_message_at DATETIME,
+            FOREIGN KEY (project_id) REFERENCES Project (project_id) ON DELETE CASCADE
+        )
+    ''')
+    cursor.execute('ALTER TABLE Project_User ADD COLUMN messages_read INTEGER NOT NULL DEFAULT 0')
+
+    def count_tasks(row, sign):
+        # One term per column, (status = 'todo') is 1 for the task's column and 0 for the others
+        return ', '.join(f"{column} = {column} {sign} ({row}.task_status = '{status}')"
+                         for status, column in SUMMARY_STATUS_COLUMNS)
+
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS project_summary_insert AFTER INSERT ON Project BEGIN
+            INSERT INTO Project_Summary (project_id) VALUES (new.project_id);
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS project_summary_task_insert AFTER INSERT ON Task BEGIN
+            UPDATE Project_Summary SET {count_tasks('new', '+')} WHERE project_id = new.project_id;
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS project_summary_task_delete AFTER DELETE ON Task BEGIN
+            UPDATE Project_Summary SET {count_tasks('old', '-')} WHERE project_id = old.project_id;
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS project_summary_task_update AFTER UPDATE OF task_status, project_id ON Task
+        WHEN old.task_status IS NOT new.task_status OR old.project_id IS NOT new.project_id BEGIN
+            UPDATE Project_Summary SET {count_tasks('old', '-')} WHERE project_id = old.project_id;
+            UPDATE Project_Summary SET {count_tasks('new', '+')} WHERE project_id = new.project_id;
+        END
+    ''')
+
+    # New members start with everything read
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS project_summary_member_insert AFTER INSERT ON Project_User BEGIN
+            UPDATE Project_Summary SET member_count = member_count + 1 WHERE project_id = new.project_id;
+            UPDATE Project_User SET messages_read = (
+                SELECT message_count FROM Project_Summary WHERE project_id = new.project_id
+            ) WHERE project_id = new.project_id AND user_id = new.user_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS project_summary_member_delete AFTER DELETE ON Project_User BEGIN
+            UPDATE Project_Summary SET member_count = member_count - 1 WHERE project_id = old.project_id;
+        END
+    ''')
+
+    # Deleting messages, which archiving and purging do, leaves the counters alone. A sender has read their own message
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS project_summary_message_insert AFTER INSERT ON Message BEGIN
+            UPDATE Project_Summary SET message_count = message_count + 1,
+                last_message_at = MAX(COALESCE(last_message_at, new.timestamp), new.timestamp)
+            WHERE project_id = new.project_id;
+            UPDATE Project_User SET messages_read = messages_read + 1
+            WHERE project_id = new.project_id AND user_id = new.sender_id;
+        END
+    ''')
+
+    # Summarize the projects that existed before this version, with every message already read
+    cursor.execute(f'INSERT INTO Project_Summary {SUMMARY_SELECT}')
+    cursor.execute('''
+        UPDATE Project_User SET messages_read = (
+            SELECT message_count FROM Project_Summary WHERE Project_Summary.project_id = Project_User.project_id
+        )
+    ''')
+
+def add_archive_counts(cursor):
+    '''Version 10: number of archived messages per project, so pages only look in the archive of projects that have one'''
+    cursor.execute('ALTER TABLE Project ADD COLUMN archived_messages INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('''
+        UPDATE Project SET archived_messages = (
+            SELECT COALESCE(SUM(message_count), 0) FROM Message_Archive WHERE Message_Archive.project_id = Project.project_id
+        )
+    ''')
+
+def add_archive_search(cursor):
+    '''Version 11: search index of the archived messages, which leave Message_fts with their Message rows'''
+    # Contentless, the text stays compressed in the archive. A rowid is the block ID and the message's position in the
+    # block (archive.search_rowid), so hits are read back from the blocks without a table mapping messages to blocks
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS Message_Archive_fts USING fts5(
+            content, project_id, content='', tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+
+    # Index the blocks archived before this version
+    path = cursor.execute("SELECT file FROM pragma_database_list WHERE name = 'main'").fetchone()[0]
+    blocks = cursor.execute('''
+        SELECT block_id, project_id, segment, block_offset, block_length FROM Message_Archive
+    ''').fetchall()
+    for block_id, project_id, segment, offset, length in blocks:
+        rows = archive.read_block(archive.segment_path(archive.directory(path), project_id, segment), offset, length)
+        cursor.executemany('''
+            INSERT INTO Message_Archive_fts (rowid, content, project_id) VALUES (?, ?, ?)
+        ''', [(archive.search_rowid(block_id, position), row[1], project_id) for position, row in enumerate(rows)])
+
+def add_tombstone_pruning(cursor):
+    '''Version 12: deletion times of task tombstones, so old ones can be pruned, and the versions pruned per project'''
+    # A delta from before pruned_version may have missed a pruned deletion, such clients get the whole board instead
+    cursor.execute('ALTER TABLE Task_Deleted ADD COLUMN deleted_at DATETIME')
+    cursor.execute('UPDATE Task_Deleted SET deleted_at = CURRENT_TIMESTAMP')  # Existing ones are kept a full period
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_task_deleted_at ON Task_Deleted (deleted_at)')
+    cursor.execute('ALTER TABLE Project ADD COLUMN pruned_version INTEGER NOT NULL DEFAULT 0')
+
+MIGRATIONS = [create_tables, add_indexes, add_versions, add_user_timezone, add_cascades, add_search, add_user_versions,
+              add_message_archive, add_project_summary, add_archive_counts, add_archive_search, add_tombstone_pruning]
+
+def migrate(conn):
+    '''Apply every migration newer than the database's user_version. Returns the resulting version.'''
+    conn.isolation_level = None  # Manage transactions explicitly so DDL is covered too
+    cursor = conn.cursor()
+
+    if cursor.execute('PRAGMA user_version').fetchone()[0] >= len(MIGRATIONS):
+        return len(MIGRATIONS)  # Already up to date, skip taking the write lock
+
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        # BEGIN IMMEDIATE takes the write lock, so concurrent workers apply each migration once
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            if cursor.execute('PRAGMA user_version').fetchone()[0] >= version:
+                cursor.execute('ROLLBACK')
+                continue
+            migration(cursor)
+            cursor.execute(f'PRAGMA user_version = {version}')
+            cursor.execute('COMMIT')
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+
+    return len(MIGRATIONS)
+
+def create_db(path=db_path):
+    '''Create the SQLite database or bring an existing one up to the latest schema'''
+    # Connect to the SQLite database
+    conn = sqlite3.connect(path)
+
+    migrate(conn)
+
+    # WAL lets readers continue while a message or task is being written. It is stored in the database file
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA optimize')
+
     conn.close()
 
 if __name__ == '__main__':
@@ -1,73 +1,275 @@
 import sqlite3
-from werkzeug.security import generate_password_hash, check_password_hash
+import queue
+import threading
+from contextlib import contextmanager
+from functools import partial
+from flask import g, has_app_context
+import archive
+import create_db
+import metrics
 import models
+import search
+from passwords import hasher
+from writer import Writer
 import os
 
 # Define various functions to interact with the database
+# Reads use pooled connections. Writes are functions of a cursor run by the single writer thread (writer.py), which
+# commits them in batches. Old messages live in the archive (archive.py) and message reads fall through to it
+# Triggers keep a Project_Summary row of counters per project up to date as tasks, messages and members change, so the
+# dashboard reads them instead of counting (create_db.add_project_summary)
+
+db_path = os.getenv('DATABASE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database.db'))
+
+# Connections are reused through a bounded pool instead of being opened for every query
+POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 8))
+POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
+
+# Number of messages shown when a project page loads, older history is fetched page by page
+MESSAGE_PAGE_SIZE = int(os.getenv('MESSAGE_PAGE_SIZE', 50))
+
+# Number of tasks read at a time when a task board is streamed
+TASK_BATCH_SIZE = 256
+
+# Applied once when a pooled connection is opened
+PRAGMAS = (
+    'PRAGMA busy_timeout = 5000',
+    'PRAGMA synchronous = NORMAL',  # Safe under WAL: a crash can lose the last commits but never corrupts the file
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -8000',
+    'PRAGMA foreign_keys = ON',  # Enforce the ON DELETE CASCADE constraints, SQLite leaves them off by default
+)
+
+def open_connection(path):
+    '''Open a connection and apply the per-connection pragmas.'''
+    conn = sqlite3.connect(path, check_same_thread=False, factory=metrics.connection_factory())
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+class ConnectionPool:
+    '''A bounded pool of reusable SQLite connections.'''
+
+    def __init__(self, path, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.connects = 0  # Number of connections opened over the pool's lifetime
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _connect(self):
+        '''Open a new connection for the pool.'''
+        conn = open_connection(self.path)
+        self.connects += 1
+        return conn
+
+    def acquire(self):
+        '''Borrow a connection, opening a new one while the pool is below its size.'''
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_open = self._created < self.size
+            if can_open:
+                self._created += 1
+        if can_open:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError('Timed out waiting for a pooled database connection')
+
+    def release(self, conn):
+        '''Return a borrowed connection to the pool. A pool that has been closed closes it instead.'''
+        if self._closed:
+            conn.close()
+            return
+        if conn.in_transaction:
+            conn.rollback()  # Never hand out a connection with uncommitted work
+        self._idle.put(conn)
+
+    def close(self):
+        '''Close all idle connections, and the borrowed ones as they are released.'''
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+pool = ConnectionPool(db_path)
+writer = Writer(partial(open_connection, db_path))
+
+metrics.registry.register_gauge('circuit_db_connections_opened', 'Database connections opened by the pool.',
+                                lambda: pool.connects)
+metrics.registry.register_gauge('circuit_write_queue_depth', 'Writes waiting for the writer thread.',
+                                lambda: writer.queued)
+metrics.registry.register_gauge('circuit_write_batches', 'Transactions committed by the writer thread.',
+                                lambda: writer.batches)
+metrics.registry.register_gauge('circuit_write_operations', 'Writes committed by the writer thread.',
+                                lambda: writer.operations)
+metrics.registry.register_gauge('circuit_write_batch_size_max', 'Most writes committed in one transaction.',
+                                lambda: writer.largest_batch)
+
+def init_pool(path=None, size=POOL_SIZE):
+    '''Replace the connection pool and the writer, e.g. to point the app at a different database file.'''
+    global pool, db_path, writer
+    pool.close()
+    writer.close()
+    db_path = path or db_path
+    pool = ConnectionPool(db_path, size)
+    writer = Writer(partial(open_connection, db_path))
+    return pool
+
+@contextmanager
+def connect():
+    '''Yield a database connection.
+
+    Inside a Flask request the connection is borrowed once, stored on `g` and shared by every
+    query in that request. Outside a request (scripts, background jobs) it is returned right away.
+    A connection goes back to the pool it came from, even if init_pool has replaced that pool since.
+    '''
+    if has_app_context():
+        if 'db_conn' not in g:
+            g.db_pool = pool
+            g.db_conn = g.db_pool.acquire()
+        yield g.db_conn
+        return
+
+    owner = pool
+    conn = owner.acquire()
+    try:
+        yield conn
+    finally:
+        owner.release(conn)
 
-db_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database.db')
+def close_connection(exception=None):
+    '''Return the request's connection to the pool. Registered with teardown_appcontext.'''
+    conn = g.pop('db_conn', None)
+    owner = g.pop('db_pool', None)
+    if conn is not None:
+        owner.release(conn)
 
 def register_user(username, password):
-    '''Register a new user with a hashed password.'''
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    '''Register a new user with a hashed password. Raises passwords.HashingBusy if the hashing pool is saturated.'''
+    hashed_password = hasher.hash(password)  # Hash before queueing the write
 
-    hashed_password = generate_password_hash(password)
-    try:
+    def write(cursor):
         cursor.execute('''
             INSERT INTO User (username, password)
             VALUES (?, ?)
         ''', (username, hashed_password))
-        conn.commit()
+
+    try:
+        writer.run(write)
         return True
     except sqlite3.IntegrityError:
         return False  # Username already exists
-    finally:
-        conn.close()
     
 
 def login_user(username, password):
-    '''Authenticate a user by checking the hashed password with the entered username.'''
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    '''Authenticate a user by checking the hashed password with the entered username.
 
-    cursor.execute('''
-        SELECT password, user_id FROM User WHERE username = ?
-    ''', (username,))
-    result = cursor.fetchone()
-    conn.close()
+    Hashes made with outdated parameters are upgraded after a successful login.
+    Raises passwords.HashingBusy if the hashing pool is saturated.
+    '''
+    with connect() as conn:
+        cursor = conn.cursor()
 
-    if result and check_password_hash(result[0], password):
-        return models.User(result[1], username) # Return user object
-    else:
+        cursor.execute('''
+            SELECT password, user_id FROM User WHERE username = ?
+        ''', (username,))
+        result = cursor.fetchone()
+
+    if not (result and hasher.verify(result[0], password)):
         return False
+
+    if hasher.needs_rehash(result[0]):
+        new_hash = hasher.hash(password)
+
+        def write(cursor):
+            # Only replace the hash that was checked, in case the password changed meanwhile
+            cursor.execute('''
+                UPDATE User SET password = ? WHERE user_id = ? AND password = ?
+            ''', (new_hash, result[1], result[0]))
+
+        writer.run(write)
+
+    return models.User(result[1], username) # Return user object
     
 def get_user(user_id):
     '''Fetch a user object by their ID.'''
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    with connect() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute('''
-        SELECT username FROM User WHERE user_id = ?
-    ''', (user_id,))
-    result = cursor.fetchone()
-    conn.close()
+        cursor.execute('''
+            SELECT username, timezone FROM User WHERE user_id = ?
+        ''', (user_id,))
+        result = cursor.fetchone()
 
     if result:
-        return models.User(user_id, result[0])  # Return user object
+        return models.User(user_id, result[0], result[1])  # Return user object
     else:
         return None
     
+def get_identity(user_id, project_id=None):
+    '''Fetch a user and their role in a project in one query.
+
+    Returns (user, role). The role is None if the user is not a member of the project, and both are None if the user
+    doesn't exist.
+    '''
+    with connect() as conn:
+        cursor = conn.cursor()
+
+        # Members of a deleted project have no role in it, which hides it from every project route
+        cursor.execute('''
+            SELECT User.username, User.timezone, User.version, Member.role FROM User
+            LEFT JOIN (
+                SELECT Project_User.user_id, Project_User.role FROM Project_User
+                JOIN Project ON Project.project_id = Project_User.project_id
+                WHERE Project_User.project_id = ? AND Project.deleted_at IS NULL
+            ) AS Member ON Member.user_id = User.user_id
+            WHERE User.user_id = ?
+        ''', (project_id, user_id))
+        result = cursor.fetchone()
+
+    if result:
+        return models.User(user_id, result[0], result[1], result[2]), result[3]
+    else:
+        return None, None
+
+def set_user_timezone(user_id, timezone):
+    '''Set the time zone a user's messages are displayed in.'''
+    def write(cursor):
+        cursor.execute('''
+            UPDATE User SET timezone = ?, version = version + 1 WHERE user_id = ?
+        ''', (timezone, user_id))
+
+    writer.run(write)
+
 def get_user_by_username(username):
     '''Fetch a user object by their username.'''
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    with connect() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute('''
-        SELECT user_id FROM User WHERE username = ?
-    ''', (username,))
-    result = cursor.fetchone()
-    conn.close()
+        cursor.execute('''
+            SELECT user_id FROM User WHERE username = ?
+        ''', (username,))
+        result = cursor.fetchone()
 
     if result:
         return models.User(result[0], username)  # Return user object
@@ -76,29 +278,52 @@ def get_user_by_username(username):
     
 def get_user_projects(user_id):
     '''Fetch all projects associated with a user.'''
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = models.Project.from_row
 
-    cursor.execute('''
-        SELECT Project.project_id, project_name FROM Project
-        JOIN Project_User ON Project.project_id = Project_User.project_id
-        WHERE Project_User.user_id = ?
-    ''', (user_id,))
-    projects = cursor.fetchall()
-    conn.close()
-
-    return [models.Project(project[0], project[1]) for project in projects]  # Return list of project objects
+        cursor.execute('''
+            SELECT Project.project_id, project_name FROM Project
+            JOIN Project_User ON Project.project_id = Project_User.project_id
+            WHERE Project_User.user_id = ? AND Project.deleted_at IS NULL
+        ''', (user_id,))
+        projects = cursor.fetchall()
+
+    return projects  # Return list of project objects
+
+# Project_Summary columns in the order of models.TASK_STATUSES, then the member count
+SUMMARY_COLUMNS = ', '.join([f'Project_Summary.{column}' for _, column in create_db.SUMMARY_STATUS_COLUMNS]
+                            + ['Project_Summary.member_count'])
+
+def get_dashboard(user_id):
+    '''Fetch the summary of every project of a user, with their unread message counts, in one query.'''
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = models.ProjectSummary.from_row
+
+        cursor.execute(f'''
+            SELECT Project.project_id, project_name, Project.version, {SUMMARY_COLUMNS},
+                Project_Summary.message_count - Project_User.messages_read, Project_Summary.last_message_at, User.timezone
+            FROM Project_User
+            JOIN Project ON Project.project_id = Project_User.project_id
+            JOIN Project_Summary ON Project_Summary.project_id = Project_User.project_id
+            JOIN User ON User.user_id = Project_User.user_id
+            WHERE Project_User.user_id = ? AND Project.deleted_at IS NULL
+            ORDER BY Project_Summary.last_message_at IS NULL, Project_Summary.last_message_at DESC, Project.project_id
+        ''', (user_id,))
+        projects = cursor.fetchall()
+
+    return projects  # Return list of project summary objects
 
 def get_project_name(project_id):
     '''Fetch the name of a project by its ID.'''
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    with connect() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute('''
-        SELECT project_name FROM Project WHERE project_id = ?
-    ''', (project_id,))
-    result = cursor.fetchone()
-    conn.close()
+        cursor.execute('''
+            SELECT project_name FROM Project WHERE project_id = ? AND deleted_at IS NULL
+        ''', (project_id,))
+        result = cursor.fetchone()
 
     if result:
         return result[0]  # Return project name
@@ -107,91 +332,625 @@ def get_project_name(project_id):
 
 def get_project_users(project_id):
     '''Fetch all users associated with a project.'''
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = models.User.from_row
 
-    cursor.execute('''
-        SELECT User.user_id, username FROM User
-        JOIN Project_User ON User.user_id = Project_User.user_id
-        WHERE Project_User.project_id = ?
-    ''', (project_id,))
-    users = cursor.fetchall()
-    conn.close()
+        cursor.execute('''
+            SELECT User.user_id, username FROM User
+            JOIN Project_User ON User.user_id = Project_User.user_id
+            WHERE Project_User.project_id = ?
+        ''', (project_id,))
+        users = cursor.fetchall()
 
-    return [models.User(user[0], user[1]) for user in users]  # Return list of user objects
+    return users  # Return list of user objects
 
 def get_project_tasks(project_id):
     '''Fetch all tasks associated with a project.'''
-    conn = sqlite3.connect(db_path)
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = models.Task.from_row
+
+        cursor.execute('''
+            SELECT task_id, task_title, task_description, task_status FROM Task
+            WHERE project_id = ?
+        ''', (project_id,))
+        tasks = cursor.fetchall()
+
+    return tasks  # Return list of task objects
+
+def _select_messages(conn, project_id, limit=-1, before=None, archived=None):
+    '''Fetch up to `limit` messages older than the `before` cursor as Message objects, oldest first.
+
+    `before` is a (timestamp, message_id) pair. Messages carry their sender's username.
+    The newest messages are selected in SQL through the (project_id, timestamp) index, so the cost depends on the
+    page size and not on the length of the history. A limit of -1 fetches everything. When the Message table runs out,
+    the rest comes from the archive, if `archived` says the project has one. None looks it up when needed.
+    '''
+    cursor = conn.cursor()
+    cursor.row_factory = models.Message.from_row
+
+    if before:
+        cursor.execute('''
+            SELECT message_id, content, sender_id, project_id, timestamp, User.username FROM Message
+            LEFT JOIN User ON User.user_id = Message.sender_id
+            WHERE project_id = ? AND (timestamp, message_id) < (?, ?)
+            ORDER BY timestamp DESC, message_id DESC
+            LIMIT ?
+        ''', (project_id, before[0], before[1], limit))
+    else:
+        cursor.execute('''
+            SELECT message_id, content, sender_id, project_id, timestamp, User.username FROM Message
+            LEFT JOIN User ON User.user_id = Message.sender_id
+            WHERE project_id = ?
+            ORDER BY timestamp DESC, message_id DESC
+            LIMIT ?
+        ''', (project_id, limit))
+    messages = cursor.fetchall()
+    if (limit < 0 or len(messages) < limit) and archived is None:
+        count = conn.execute('SELECT archived_messages FROM Project WHERE project_id = ?', (project_id,)).fetchone()
+        archived = count and count[0]
+    if (limit < 0 or len(messages) < limit) and archived:
+        # Everything older than the last hot message has been archived
+        oldest = (messages[-1].date_time, messages[-1].message_id) if messages else before
+        messages += _select_archived_messages(conn, project_id, limit - len(messages) if limit >= 0 else -1, oldest)
+    messages.reverse()
+    return messages
+
+def _select_archived_messages(conn, project_id, limit=-1, before=None):
+    '''Fetch up to `limit` archived messages older than the `before` cursor as Message objects, newest first.
+
+    Blocks are read newest first until the limit is reached, only those with a message older than the cursor.
+    '''
     cursor = conn.cursor()
 
+    if before:
+        cursor.execute('''
+            SELECT segment, block_offset, block_length FROM Message_Archive
+            WHERE project_id = ? AND (first_timestamp, first_id) < (?, ?)
+            ORDER BY last_timestamp DESC, last_id DESC
+        ''', (project_id, before[0], before[1]))
+    else:
+        cursor.execute('''
+            SELECT segment, block_offset, block_length FROM Message_Archive
+            WHERE project_id = ?
+            ORDER BY last_timestamp DESC, last_id DESC
+        ''', (project_id,))
+
+    archive_dir = archive.directory(db_path)
+    rows = []
+    while limit < 0 or len(rows) < limit:
+        block = cursor.fetchone()
+        if block is None:
+            break
+        for row in reversed(archive.read_block(archive.segment_path(archive_dir, project_id, block[0]), block[1], block[2])):
+            if before and (row[3], row[0]) >= tuple(before):
+                continue
+            rows.append(row)
+            if len(rows) == limit:
+                break
+    if not rows:
+        return []
+    usernames = _select_usernames(conn, {row[2] for row in rows})
+
+    # Return list of message objects
+    return [models.Message(row[0], row[1], row[2] if row[2] in usernames else None, project_id, row[3], None,
+                           usernames.get(row[2])) for row in rows]
+
+def _select_usernames(conn, user_ids):
+    '''Look the senders of archived messages up at once. Deleted accounts have no name, like a LEFT JOIN on User.'''
+    user_ids = [user_id for user_id in user_ids if user_id is not None]
+    placeholders = ', '.join('?' * len(user_ids))
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT user_id, username FROM User WHERE user_id IN ({placeholders})
+    ''', user_ids)
+    return dict(cursor.fetchall())  # Return {user_id: username}
+
+def get_archivable_projects(cutoff):
+    '''Fetch the IDs of the projects with messages older than the `cutoff` timestamp.'''
+    with connect() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT project_id FROM Project
+            WHERE deleted_at IS NULL AND EXISTS (
+                SELECT 1 FROM Message WHERE Message.project_id = Project.project_id AND timestamp < ?
+            )
+        ''', (cutoff,))
+        projects = cursor.fetchall()
+
+    return [project[0] for project in projects]  # Return list of project IDs
+
+def archive_messages(project_id, cutoff, limit=archive.ARCHIVE_BATCH_SIZE):
+    '''Move up to `limit` of a project's oldest messages sent before `cutoff` into its archive.
+
+    Returns the number of messages moved, 0 once there are none left to archive.
+    '''
+    with connect() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT message_id, content, sender_id, timestamp FROM Message
+            WHERE project_id = ? AND timestamp < ?
+            ORDER BY timestamp, message_id
+            LIMIT ?
+        ''', (project_id, cutoff, limit))
+        rows = cursor.fetchall()
+
+        cursor.execute('''
+            SELECT MAX(segment) FROM Message_Archive WHERE project_id = ?
+        ''', (project_id,))
+        segment = cursor.fetchone()[0] or 0
+
+    if not rows:
+        return 0
+    blocks = archive.append(archive.directory(db_path), project_id, segment, rows)
+
+    def write(cursor):
+        start = 0
+        for segment, offset, length, first, last, count in blocks:
+            cursor.execute('''
+                INSERT INTO Message_Archive (project_id, segment, block_offset, block_length, message_count,
+                    first_timestamp, first_id, last_timestamp, last_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (project_id, segment, offset, length, count, first[3], first[0], last[3], last[0]))
+
+            # The messages leave Message_fts with their rows below, they are searched here from now on
+            block_id = cursor.lastrowid
+            cursor.executemany('''
+                INSERT INTO Message_Archive_fts (rowid, content, project_id) VALUES (?, ?, ?)
+            ''', [(archive.search_rowid(block_id, position), row[1], project_id)
+                  for position, row in enumerate(rows[start:start + count])])
+            start += count
+
+        # Exactly the rows read above, newer messages can't have been sent before the cutoff
+        cursor.execute('''
+            DELETE FROM Message WHERE project_id = ? AND timestamp < ? AND (timestamp, message_id) <= (?, ?)
+        ''', (project_id, cutoff, rows[-1][3], rows[-1][0]))
+        moved = cursor.rowcount
+
+        cursor.execute('''
+            UPDATE Project SET archived_messages = archived_messages + ? WHERE project_id = ?
+        ''', (moved, project_id))
+        return moved
+
+    return writer.run(write)  # Return number of messages moved
+
+def get_project_messages(project_id, limit=-1, before=None):
+    '''Fetch the newest messages of a project older than the optional (timestamp, message_id) cursor, oldest first.'''
+    with connect() as conn:
+        messages = _select_messages(conn, project_id, limit, before)
+
+    return messages  # Return list of message objects
+
+def get_message_page(project_id, before=None, limit=MESSAGE_PAGE_SIZE, timezone=None, archived=None):
+    '''Fetch one page of message history localized to `timezone`. Returns (messages, has_more).
+
+    `archived` is whether the project has archived messages, if the caller already knows.
+    '''
+    with connect() as conn:
+        # Fetch one extra row to know whether there is anything older
+        messages = _select_messages(conn, project_id, limit + 1, before, archived)
+
+    has_more = len(messages) > limit
+    if has_more:
+        messages = messages[1:]
+    models.localize_messages(messages, timezone)  # Convert all timestamps in one batch
+    return messages, has_more
+
+def search_messages(project_id, text, limit=20, offset=0, timezone=None):
+    '''Full-text search a project's messages.
+
+    Hits are ranked within windows of the newest search.SEARCH_WINDOW matches, so the cost does not grow with the size
+    of the history. Returns up to `limit` hits as dictionaries with the message and its content highlighted as HTML,
+    and the offset of the next page or None. Archived messages follow the hot ones, they are all older.
+    '''
+    terms = search.parse(text)
+    match = search.match_expression(terms, project_id, ['content'])
+    if match is None:
+        return [], None
+
+    window_start = offset - offset % search.SEARCH_WINDOW
+    with connect() as conn:
+        cursor = conn.cursor()
+
+        # Newest first lets FTS5 stop after the window instead of visiting every match.
+        # One extra row tells whether an older window follows
+        cursor.execute('''
+            SELECT Message.message_id, Message.content, Message.sender_id, Message.project_id, Message.timestamp,
+                User.username, highlight(Message_fts, 0, ?, ?)
+            FROM Message_fts
+            JOIN Message ON Message.message_id = Message_fts.rowid
+            LEFT JOIN User ON User.user_id = Message.sender_id
+            WHERE Message_fts MATCH ?
+            ORDER BY Message_fts.rowid DESC
+            LIMIT ? OFFSET ?
+        ''', (search.HIGHLIGHT_START, search.HIGHLIGHT_END, match, search.SEARCH_WINDOW + 1, window_start))
+        rows = cursor.fetchall()
+        if len(rows) <= search.SEARCH_WINDOW:
+            rows += _search_archived_messages(conn, project_id, terms, match, window_start, len(rows),
+                                              search.SEARCH_WINDOW + 1 - len(rows))
+
+    older = len(rows) > search.SEARCH_WINDOW
+    ranked = search.rank(rows[:search.SEARCH_WINDOW], terms, lambda row: row[1], lambda row: row[6])
+    page = ranked[offset - window_start:offset - window_start + limit]
+
+    if offset - window_start + limit < len(ranked):
+        next_offset = offset + limit
+    elif older:
+        next_offset = window_start + search.SEARCH_WINDOW
+    else:
+        next_offset = None
+
+    messages = [models.Message.from_row(cursor, row[:6]) for row in page]
+    models.localize_messages(messages, timezone)
+    hits = [{'message': message, 'highlight': search.mark(row[6])} for message, row in zip(messages, page)]
+    return hits, next_offset  # Return list of hits and the offset of the next page
+
+def _search_archived_messages(conn, project_id, terms, match, window_start, hot_hits, limit):
+    '''Fetch the archived hits that continue a window of hot hits, in the same row shape, newest first.
+
+    `hot_hits` hot messages matched from `window_start` on. If the window starts past all of them, they are counted to
+    know how many archived hits to skip.
+    '''
+    cursor = conn.cursor()
     cursor.execute('''
-        SELECT task_id, task_title, task_description, task_status FROM Task
-        WHERE project_id = ?
+        SELECT archived_messages FROM Project WHERE project_id = ?
     ''', (project_id,))
-    tasks = cursor.fetchall()
-    conn.close()
+    archived = cursor.fetchone()
+    if not archived or not archived[0]:
+        return []
 
-    return [models.Task(task[0], task[1], task[2], task[3]) for task in tasks]  # Return list of task objects
+    skip = 0
+    if not hot_hits and window_start:
+        cursor.execute('''
+            SELECT COUNT(*) FROM Message_fts WHERE Message_fts MATCH ?
+        ''', (match,))
+        skip = window_start - cursor.fetchone()[0]
 
-def get_project_messages(project_id):
-    '''Fetch all messages associated with a project.'''
-    conn = sqlite3.connect(db_path)
+    # Block IDs grow as messages are archived oldest first, so rowid order is newest first here too
+    cursor.execute('''
+        SELECT rowid FROM Message_Archive_fts WHERE Message_Archive_fts MATCH ?
+        ORDER BY rowid DESC
+        LIMIT ? OFFSET ?
+    ''', (match, limit, skip))
+    hits = [divmod(row[0], archive.BLOCK_POSITIONS) for row in cursor.fetchall()]
+    if not hits:
+        return []
+
+    block_ids = sorted({block_id for block_id, _ in hits})
+    placeholders = ', '.join('?' * len(block_ids))
+    cursor.execute(f'''
+        SELECT block_id, segment, block_offset, block_length FROM Message_Archive WHERE block_id IN ({placeholders})
+    ''', block_ids)
+    archive_dir = archive.directory(db_path)
+    blocks = {block[0]: archive.read_block(archive.segment_path(archive_dir, project_id, block[1]), block[2], block[3])
+              for block in cursor.fetchall()}
+
+    messages = [blocks[block_id][position] for block_id, position in hits if block_id in blocks]
+    usernames = _select_usernames(conn, {message[2] for message in messages})
+    # Return list of rows like the hot hits, with the content highlighted here as FTS5 has none to highlight
+    return [(message[0], message[1], message[2] if message[2] in usernames else None, project_id, message[3],
+             usernames.get(message[2]), search.highlight(message[1], terms)) for message in messages]
+
+def search_tasks(project_id, text, limit=20, offset=0):
+    '''Full-text search the titles and descriptions of a project's tasks, best matches first.
+
+    Returns up to `limit` hits as dictionaries with the task, its highlighted title and a highlighted snippet of its
+    description, and the offset of the next page or None.
+    '''
+    match = search.match_expression(search.parse(text), project_id, ['task_title', 'task_description'])
+    if match is None:
+        return [], None
+
+    with connect() as conn:
+        cursor = conn.cursor()
+
+        # A project has few enough tasks for bm25() to rank all of them
+        cursor.execute('''
+            SELECT Task.task_id, Task.task_title, Task.task_description, Task.task_status,
+                highlight(Task_fts, 0, ?1, ?2), snippet(Task_fts, 1, ?1, ?2, '…', 24)
+            FROM Task_fts
+            JOIN Task ON Task.task_id = Task_fts.rowid
+            WHERE Task_fts MATCH ?3
+            ORDER BY rank
+            LIMIT ?4 OFFSET ?5
+        ''', (search.HIGHLIGHT_START, search.HIGHLIGHT_END, match, limit + 1, offset))
+        rows = cursor.fetchall()
+
+    hits = [{
+        'task': models.Task(row[0], row[1], row[2], row[3]),
+        'highlight': search.mark(row[4]),
+        'snippet': search.mark(row[5]),
+    } for row in rows[:limit]]
+    return hits, offset + limit if len(rows) > limit else None  # Return list of hits and the offset of the next page
+
+def _select_project_header(conn, project_id, user_id):
+    '''Fetch the viewer, the project and the sidebar, everything on the project page above the task board.'''
     cursor = conn.cursor()
 
+    # The viewer, the project and their role, which also checks membership
     cursor.execute('''
-        SELECT message_id, content, sender_id, timestamp FROM Message
-        WHERE project_id = ?
-    ''', (project_id,))
-    messages = cursor.fetchall()
-    conn.close()
+        SELECT User.username, Project.project_name, Project_User.role, Project.version, User.timezone,
+            Project_Summary.message_count, Project_User.messages_read, Project.archived_messages FROM Project_User
+        JOIN User ON User.user_id = Project_User.user_id
+        JOIN Project ON Project.project_id = Project_User.project_id
+        JOIN Project_Summary ON Project_Summary.project_id = Project_User.project_id
+        WHERE Project_User.project_id = ? AND Project_User.user_id = ? AND Project.deleted_at IS NULL
+    ''', (project_id, user_id))
+    viewer = cursor.fetchone()
+    if not viewer:
+        return None
 
-    return [models.Message(message[0], message[1], message[2], project_id, message[3]) for message in messages]  # Return list of message objects
+    # Sidebar project list
+    cursor = conn.cursor()
+    cursor.row_factory = models.Project.from_row
+    cursor.execute('''
+        SELECT Project.project_id, project_name FROM Project
+        JOIN Project_User ON Project.project_id = Project_User.project_id
+        WHERE Project_User.user_id = ? AND Project.deleted_at IS NULL
+    ''', (user_id,))
+    projects = cursor.fetchall()
+
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT username FROM User
+        JOIN Project_User ON User.user_id = Project_User.user_id
+        WHERE Project_User.project_id = ?
+    ''', (project_id,))
+    members = [member[0] for member in cursor.fetchall()]
+
+    return {
+        'username': viewer[0],
+        'project_name': viewer[1],
+        'role': viewer[2],
+        'version': viewer[3],
+        'timezone': viewer[4],
+        'message_count': viewer[5],
+        'messages_read': viewer[6],
+        'archived_messages': viewer[7],
+        'projects': projects,
+        'members': members,
+    }
+
+def load_project_header(project_id, user_id):
+    '''Fetch the viewer, project name, role, version, sidebar projects and members for a project page.
+
+    The task board and messages are left out, a streamed page reads them with iter_project_tasks and get_message_page
+    as it reaches them. Returns None if the project does not exist or the user is not a member of it.
+    '''
+    with connect() as conn:
+        view = _select_project_header(conn, project_id, user_id)
+
+    return view  # Return the page data dictionary, or None
+
+def load_project_view(project_id, user_id):
+    '''Fetch everything the project page needs in a fixed number of queries.
+
+    Returns None if the project does not exist or the user is not a member of it.
+    '''
+    with connect() as conn:
+        view = _select_project_header(conn, project_id, user_id)
+        if not view:
+            return None
+
+        tasks = _select_tasks(conn, project_id)
+
+        # Newest page of messages with their sender's username, oldest first. One extra row tells whether there is older history
+        messages = _select_messages(conn, project_id, MESSAGE_PAGE_SIZE + 1, archived=view['archived_messages'])
+
+    has_more_messages = len(messages) > MESSAGE_PAGE_SIZE
+    if has_more_messages:
+        messages = messages[1:]
+    models.localize_messages(messages, view['timezone'])  # Convert all timestamps in one batch
+
+    view.update(tasks=tasks, messages=messages, has_more_messages=has_more_messages)
+    return view
 
 def add_project(project_name, user_id):
     '''Add a new project and assign the creator as an admin.'''
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    def write(cursor):
+        cursor.execute('''
+            INSERT INTO Project (project_name)
+            VALUES (?)
+        ''', (project_name,))
+
+        new_id = cursor.lastrowid  # Get the ID of the new project
+        cursor.execute('''
+            INSERT INTO Project_User (project_id, user_id, role)
+            VALUES (?, ?, ?)
+        ''', (new_id, user_id, 'admin'))
+        _bump_user_version(cursor, user_id)
+        return new_id
 
+    return writer.run(write)  # Return the project ID of the new project
+
+def _bump_version(cursor, project_id):
+    '''Increment a project's change counter and return the new value.
+
+    Tasks changed in the same transaction are stamped with it so clients can ask for everything after the version they have.
+    '''
     cursor.execute('''
-        INSERT INTO Project (project_name)
-        VALUES (?)
-    ''', (project_name,))
+        UPDATE Project SET version = version + 1 WHERE project_id = ?
+        RETURNING version
+    ''', (project_id,))
+    result = cursor.fetchone()
+    return result[0] if result else 0
 
-    new_id = cursor.lastrowid  # Get the ID of the new project
+def _bump_user_version(cursor, user_id):
+    '''Increment a user's change counter, for changes to their project list or settings.'''
     cursor.execute('''
-        INSERT INTO Project_User (project_id, user_id, role)
-        VALUES (?, ?, ?)
-    ''', (new_id, user_id, 'admin'))
-    conn.commit()
-    conn.close()
+        UPDATE User SET version = version + 1 WHERE user_id = ?
+    ''', (user_id,))
 
-    return new_id  # Return the project ID of the new project
+def get_project_version(project_id):
+    '''Fetch a project's change counter, or None if the project doesn't exist.'''
+    with connect() as conn:
+        cursor = conn.cursor()
 
-def add_task(task_title, task_description, task_status, project_id):
-    '''Add a new task to a project.'''
-    conn = sqlite3.connect(db_path)
+        cursor.execute('''
+            SELECT version FROM Project WHERE project_id = ? AND deleted_at IS NULL
+        ''', (project_id,))
+        result = cursor.fetchone()
+
+    return result[0] if result else None  # Return the project's version
+
+def _bump_task_version(cursor, task_id):
+    '''Increment the change counter of a task's project and stamp the task with it. Returns the new version.'''
+    cursor.execute('''
+        UPDATE Project SET version = version + 1
+        WHERE project_id = (SELECT project_id FROM Task WHERE task_id = ?)
+        RETURNING version
+    ''', (task_id,))
+    result = cursor.fetchone()
+    if not result:
+        return 0
+
+    cursor.execute('''
+        UPDATE Task SET version = ? WHERE task_id = ?
+    ''', (result[0], task_id))
+    return result[0]
+
+def _query_tasks(conn, project_id, since=None):
+    '''Start reading a project's tasks, or only those changed after version `since`, with their assignees.'''
     cursor = conn.cursor()
+    cursor.row_factory = models.Task.from_row
 
+    # Assignees are aggregated into a JSON array so the whole board is a single query
     cursor.execute('''
-        INSERT INTO Task (task_title, task_description, task_status, project_id)
-        VALUES (?, ?, ?, ?)
-    ''', (task_title, task_description, task_status, project_id))
-    conn.commit()
-    conn.close()
+        SELECT task_id, task_title, task_description, task_status,
+            (SELECT json_group_array(User.username) FROM Task_User
+             JOIN User ON User.user_id = Task_User.user_id
+             WHERE Task_User.task_id = Task.task_id)
+        FROM Task WHERE project_id = ? AND version > ?
+    ''', (project_id, since if since is not None else -1))
+    return cursor
+
+def _select_tasks(conn, project_id, since=None):
+    '''Fetch a project's tasks, or only those changed after version `since`, with their assignees.'''
+    return _query_tasks(conn, project_id, since).fetchall()
+
+def iter_project_tasks(project_id, batch_size=TASK_BATCH_SIZE):
+    '''Yield a project's tasks with their assignees as the rows are read, without building the whole list.'''
+    with connect() as conn:
+        cursor = _query_tasks(conn, project_id)
+        while True:
+            tasks = cursor.fetchmany(batch_size)
+            if not tasks:
+                break
+            yield from tasks
+
+def get_task_board(project_id, since=None):
+    '''Fetch the task board of a project, or only the changes after version `since`.
+
+    Returns a dictionary with the current version, the changed tasks, the IDs of tasks deleted since then and whether
+    the tasks are the whole board. It is whole without `since`, or when tombstones the delta needs have been pruned.
+    '''
+    with connect() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT version, pruned_version FROM Project WHERE project_id = ? AND deleted_at IS NULL
+        ''', (project_id,))
+        result = cursor.fetchone()
+        if not result:
+            return None
+        if since is not None and since < result[1]:
+            since = None  # A deletion after `since` may have been forgotten
+
+        tasks = _select_tasks(conn, project_id, since)
+
+        deleted = []
+        if since is not None:
+            cursor.execute('''
+                SELECT task_id FROM Task_Deleted WHERE project_id = ? AND version > ?
+            ''', (project_id, since))
+            deleted = [task[0] for task in cursor.fetchall()]
+
+    return {'version': result[0], 'tasks': tasks, 'deleted': deleted, 'full': since is None}
+
+def get_task_project(task_id):
+    '''Fetch the ID of the project a task belongs to.'''
+    with connect() as conn:
+        cursor = conn.cursor()
 
-    return cursor.lastrowid  # Return the task ID of the new task
+        cursor.execute('''
+            SELECT project_id FROM Task WHERE task_id = ?
+        ''', (task_id,))
+        result = cursor.fetchone()
+
+    if result:
+        return result[0]
+    else:
+        return None
+
+def add_task(task_title, task_description, task_status, project_id):
+    '''Add a new task to a project.'''
+    def write(cursor):
+        version = _bump_version(cursor, project_id)
+        cursor.execute('''
+            INSERT INTO Task (task_title, task_description, task_status, project_id, version)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (task_title, task_description, task_status, project_id, version))
+        return cursor.lastrowid
+
+    return writer.run(write)  # Return the task ID of the new task
+
+def add_tasks(project_id, tasks):
+    '''Add many tasks to a project and assign them in a single transaction.
+
+    `tasks` is an iterable of (task_title, task_description, task_status, usernames) tuples. Usernames that are not
+    members of the project are ignored. Returns the new project version and the created task objects.
+    '''
+    tasks = list(tasks)
+    usernames = {username for task in tasks for username in task[3]}
+
+    # Nothing is kept if any insert fails, the writer rolls the whole operation back and a task is never left
+    # half-assigned
+    def write(cursor):
+        # Resolve every assignee with one query, limited to the project's members. Inside the transaction, so a member
+        # removed meanwhile is not assigned
+        members = {}
+        if usernames:
+            placeholders = ', '.join('?' * len(usernames))
+            cursor.execute(f'''
+                SELECT User.username, User.user_id FROM User
+                JOIN Project_User ON User.user_id = Project_User.user_id
+                WHERE Project_User.project_id = ? AND User.username IN ({placeholders})
+            ''', (project_id, *usernames))
+            members = dict(cursor.fetchall())
+
+        # All tasks share one version so a client syncing from before the import gets them together
+        version = _bump_version(cursor, project_id)
+        created = []
+        assignments = []
+        for task_title, task_description, task_status, task_members in tasks:
+            cursor.execute('''
+                INSERT INTO Task (task_title, task_description, task_status, project_id, version)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (task_title, task_description, task_status, project_id, version))
+            assigned_members = [username for username in dict.fromkeys(task_members) if username in members]
+            assignments.extend((cursor.lastrowid, members[username]) for username in assigned_members)
+            created.append(models.Task(cursor.lastrowid, task_title, task_description, task_status, assigned_members))
+
+        cursor.executemany('''
+            INSERT INTO Task_User (task_id, user_id)
+            VALUES (?, ?)
+        ''', assignments)
+        return version, created
+
+    return writer.run(write)  # Return the new version and list of task objects
 
 def get_task(task_id):
     '''Fetch a task object by its ID.'''
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    with connect() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute('''
-        SELECT task_title, task_description, task_status FROM Task WHERE task_id = ?
-    ''', (task_id,))
-    result = cursor.fetchone()
-    conn.close()
+        cursor.execute('''
+            SELECT task_title, task_description, task_status FROM Task WHERE task_id = ?
+        ''', (task_id,))
+        result = cursor.fetchone()
 
     if result:
         return models.Task(task_id, result[0], result[1], result[2])  # Return task object
@@ -200,169 +959,343 @@ def get_task(task_id):
 
 def assign_task_to_user(task_id, user_id):
     '''Assign a task to a user.'''
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    def write(cursor):
+        cursor.execute('''
+            INSERT INTO Task_User (task_id, user_id)
+            VALUES (?, ?)
+        ''', (task_id, user_id))
+        _bump_task_version(cursor, task_id)
 
-    cursor.execute('''
-        INSERT INTO Task_User (task_id, user_id)
-        VALUES (?, ?)
-    ''', (task_id, user_id))
-    conn.commit()
-    conn.close()
+    writer.run(write)
 
 def get_task_assignees(task_id):
     '''Fetch all users assigned to a task.'''
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    with connect() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute('''
-        SELECT User.user_id, username FROM User
-        JOIN Task_User ON User.user_id = Task_User.user_id
-        WHERE Task_User.task_id = ?
-    ''', (task_id,))
-    users = cursor.fetchall()
-    conn.close()
+        cursor.execute('''
+            SELECT User.user_id, username FROM User
+            JOIN Task_User ON User.user_id = Task_User.user_id
+            WHERE Task_User.task_id = ?
+        ''', (task_id,))
+        users = cursor.fetchall()
 
     return [user[1] for user in users]  # Return list of username strings
 
 def change_task_status(task_id, new_status):
     '''Change the status of a task.'''
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    def write(cursor):
+        version = _bump_task_version(cursor, task_id)
+        cursor.execute('''
+            UPDATE Task SET task_status = ? WHERE task_id = ?
+        ''', (new_status, task_id))
+        return version
 
-    cursor.execute('''
-        UPDATE Task SET task_status = ? WHERE task_id = ?
-    ''', (new_status, task_id))
-    conn.commit()
-    conn.close()
+    return writer.run(write)  # Return the project's new version
 
 def delete_task(task_id):
     '''Delete a task by its ID.'''
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    def write(cursor):
+        # Leave a tombstone so clients syncing with `since` learn about the deletion
+        version = _bump_task_version(cursor, task_id)
+        cursor.execute('''
+            INSERT OR REPLACE INTO Task_Deleted (task_id, project_id, version, deleted_at)
+            SELECT task_id, project_id, ?, CURRENT_TIMESTAMP FROM Task WHERE task_id = ?
+        ''', (version, task_id))
 
-    # Delete all associations with users
-    cursor.execute('''
-        DELETE FROM Task_User WHERE task_id = ?
-    ''', (task_id,))
+        # Delete all associations with users
+        cursor.execute('''
+            DELETE FROM Task_User WHERE task_id = ?
+        ''', (task_id,))
 
-    cursor.execute('''
-        DELETE FROM Task WHERE task_id = ?
-    ''', (task_id,))
-    conn.commit()
-    conn.close()
+        cursor.execute('''
+            DELETE FROM Task WHERE task_id = ?
+        ''', (task_id,))
+        return version
+
+    return writer.run(write)  # Return the project's new version
 
 def add_message(content, user_id, project_id):
     '''Add a message to a project.'''
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    def write(cursor):
+        _bump_version(cursor, project_id)  # The project page shows the newest messages
+        cursor.execute('''
+            INSERT INTO Message (content, sender_id, project_id)
+            VALUES (?, ?, ?)
+            RETURNING message_id, timestamp
+        ''', (content, user_id, project_id))
+        return cursor.fetchone()
+
+    result = writer.run(write)
+    return models.Message(result[0], content, user_id, project_id, result[1])  # Return the new message object
+
+def mark_project_read(project_id, user_id, message_count=None):
+    '''Move a member's read cursor up to the project's first `message_count` messages, or all of them.'''
+    def write(cursor):
+        cursor.execute('''
+            UPDATE Project_User SET messages_read = COALESCE(?, (
+                SELECT message_count FROM Project_Summary WHERE project_id = ?
+            ))
+            WHERE project_id = ? AND user_id = ? AND messages_read < COALESCE(?, (
+                SELECT message_count FROM Project_Summary WHERE project_id = ?
+            ))
+        ''', (message_count, project_id, project_id, user_id, message_count, project_id))
 
-    cursor.execute('''
-        INSERT INTO Message (content, sender_id, project_id)
-        VALUES (?, ?, ?)
-    ''', (content, user_id, project_id))
-    conn.commit()
-    conn.close()
+    writer.run(write)
 
 def get_messages(project_id):
     '''Fetch all messages associated with a project.'''
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    with connect() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute('''
-        SELECT message_id, content, sender_id, timestamp FROM Message
-        WHERE project_id = ?
-    ''', (project_id,))
-    messages = cursor.fetchall()
-    conn.close()
+        cursor.execute('''
+            SELECT message_id, content, sender_id, timestamp FROM Message
+            WHERE project_id = ?
+        ''', (project_id,))
+        messages = cursor.fetchall()
+        archived = _select_archived_messages(conn, project_id)
 
-    return [models.Message(message[0], message[1], message[2], project_id, message[3]) for message in messages]  # Return list of message objects
+    archived.reverse()
+    return archived + [models.Message(message[0], message[1], message[2], project_id, message[3]) for message in messages]  # Return list of message objects
 
 def is_admin(user_id, project_id):
     '''Check if a user is an admin of a project.'''
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    with connect() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute('''
-        SELECT role FROM Project_User WHERE user_id = ? AND project_id = ?
-    ''', (user_id, project_id))
-    result = cursor.fetchone()
-    conn.close()
+        cursor.execute('''
+            SELECT role FROM Project_User
+            JOIN Project ON Project.project_id = Project_User.project_id
+            WHERE user_id = ? AND Project_User.project_id = ? AND Project.deleted_at IS NULL
+        ''', (user_id, project_id))
+        result = cursor.fetchone()
 
     return result and result[0] == 'admin'  # Return True if user is admin, False otherwise
 
 def add_member_to_project(project_id, user_id, role):
     '''Add a member to a project with a specified role.'''
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    def write(cursor):
+        cursor.execute('''
+            INSERT INTO Project_User (project_id, user_id, role)
+            VALUES (?, ?, ?)
+        ''', (project_id, user_id, role))
+        _bump_version(cursor, project_id)
+        _bump_user_version(cursor, user_id)
 
-    cursor.execute('''
-        INSERT INTO Project_User (project_id, user_id, role)
-        VALUES (?, ?, ?)
-    ''', (project_id, user_id, role))
-    conn.commit()
-    conn.close()
+    writer.run(write)
 
 def is_member(user_id, project_id):
     '''Check if a user is a member of a project.'''
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    with connect() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute('''
-        SELECT * FROM Project_User WHERE user_id = ? AND project_id = ?
-    ''', (user_id, project_id))
-    result = cursor.fetchone()
-    conn.close()
+        cursor.execute('''
+            SELECT * FROM Project_User
+            JOIN Project ON Project.project_id = Project_User.project_id
+            WHERE user_id = ? AND Project_User.project_id = ? AND Project.deleted_at IS NULL
+        ''', (user_id, project_id))
+        result = cursor.fetchone()
 
     return result is not None  # Return True if user is a member, False otherwise
 
 def remove_member_from_project(project_id, user_id):
     '''Remove a member from a project.'''
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    def write(cursor):
+        # Tasks that lose an assignee change, so stamp them with a new version
+        version = _bump_version(cursor, project_id)
+        cursor.execute('''
+            UPDATE Task SET version = ?
+            WHERE project_id = ? AND task_id IN (SELECT task_id FROM Task_User WHERE user_id = ?)
+        ''', (version, project_id, user_id))
 
-    # Delete all task assignments for the user in the project
-    cursor.execute('''
-        DELETE FROM Task_User WHERE user_id = ? AND task_id IN (SELECT task_id FROM Task WHERE project_id = ?)
-    ''', (user_id, project_id))
+        # Delete all task assignments for the user in the project
+        cursor.execute('''
+            DELETE FROM Task_User WHERE user_id = ? AND task_id IN (SELECT task_id FROM Task WHERE project_id = ?)
+        ''', (user_id, project_id))
 
-    # Delete the user from the project
-    cursor.execute('''
-        DELETE FROM Project_User WHERE project_id = ? AND user_id = ?
-    ''', (project_id, user_id))
-    conn.commit()
-    conn.close()
+        # Delete the user from the project
+        cursor.execute('''
+            DELETE FROM Project_User WHERE project_id = ? AND user_id = ?
+        ''', (project_id, user_id))
+        _bump_user_version(cursor, user_id)
+
+    writer.run(write)
 
 def delete_project(project_id):
-    '''Delete a project and all its associated data.'''
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    '''Delete a project.
 
-    # Delete all associations with tasks and users
-    cursor.execute('''
-        DELETE FROM Task_User WHERE task_id IN (SELECT task_id FROM Task WHERE project_id = ?)
-    ''', (project_id,))
+    The project is only marked as deleted, which hides it right away. Its rows are removed later in small batches by
+    purge_project(), so deleting a large project never holds the write lock for long.
+    '''
+    def write(cursor):
+        cursor.execute('''
+            UPDATE Project SET deleted_at = CURRENT_TIMESTAMP, version = version + 1
+            WHERE project_id = ? AND deleted_at IS NULL
+        ''', (project_id,))
 
-    # Delete all tasks associated with the project
-    cursor.execute('''
-        DELETE FROM Task WHERE project_id = ?
-    ''', (project_id,))
+        # The project disappears from every member's project list
+        cursor.execute('''
+            UPDATE User SET version = version + 1
+            WHERE user_id IN (SELECT user_id FROM Project_User WHERE project_id = ?)
+        ''', (project_id,))
 
-    # Delete all messages associated with the project
-    cursor.execute('''
-        DELETE FROM Message WHERE project_id = ?
-    ''', (project_id,))
+    writer.run(write)
 
-    # Delete all associations with users
-    cursor.execute('''
-        DELETE FROM Project_User WHERE project_id = ?
-    ''', (project_id,))
+def get_deleted_projects():
+    '''Fetch the IDs of projects waiting to be purged.'''
+    with connect() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute('''
-        DELETE FROM Project WHERE project_id = ?
-    ''', (project_id,))
+        cursor.execute('''
+            SELECT project_id FROM Project WHERE deleted_at IS NOT NULL ORDER BY deleted_at
+        ''')
+        projects = cursor.fetchall()
 
-    conn.commit()
-    conn.close()
+    return [project[0] for project in projects]  # Return list of project IDs
 
-    
+def prune_task_tombstones(cutoff, limit):
+    '''Delete up to `limit` tombstones of tasks deleted before the `cutoff` timestamp.
+
+    Each project remembers the newest version it pruned, so get_task_board answers older deltas with the whole board.
+    Returns the number of tombstones deleted, 0 once none are left that old.
+    '''
+    def write(cursor):
+        cursor.execute('''
+            SELECT task_id, project_id, version FROM Task_Deleted WHERE deleted_at < ? LIMIT ?
+        ''', (cutoff, limit))
+        tombstones = cursor.fetchall()
+
+        pruned = {}
+        for _, project_id, version in tombstones:
+            pruned[project_id] = max(pruned.get(project_id, 0), version)
+        cursor.executemany('''
+            UPDATE Project SET pruned_version = MAX(pruned_version, ?) WHERE project_id = ?
+        ''', [(version, project_id) for project_id, version in pruned.items()])
+        cursor.executemany('''
+            DELETE FROM Task_Deleted WHERE task_id = ?
+        ''', [(tombstone[0],) for tombstone in tombstones])
+        return len(tombstones)
+
+    return writer.run(write)  # Return number of tombstones deleted
+
+# Child tables of a project, emptied one batch at a time before the project row itself is deleted.
+# Deleting a task cascades to its assignments. Archived blocks go first, through _purge_archive_blocks
+PURGE_TABLES = (
+    ('Message', 'message_id'),
+    ('Task', 'task_id'),
+    ('Task_Deleted', 'task_id'),
+)
+
+def _purge_archive_blocks(cursor, project_id, batch_size):
+    '''Delete blocks of up to about `batch_size` archived messages and their search entries. Returns the block count.
+
+    A contentless index only drops a row given the text it indexed, which is read back from the block. Entries of a
+    block whose segment is missing are left behind, block IDs are never reused so search skips them.
+    '''
+    cursor.execute('''
+        SELECT block_id, segment, block_offset, block_length FROM Message_Archive WHERE project_id = ? LIMIT ?
+    ''', (project_id, max(1, batch_size // archive.ARCHIVE_BLOCK_SIZE)))
+    blocks = cursor.fetchall()
+
+    archive_dir = archive.directory(db_path)
+    for block_id, segment, offset, length in blocks:
+        try:
+            rows = archive.read_block(archive.segment_path(archive_dir, project_id, segment), offset, length)
+        except FileNotFoundError:
+            rows = []
+        cursor.executemany('''
+            INSERT INTO Message_Archive_fts (Message_Archive_fts, rowid, content, project_id) VALUES ('delete', ?, ?, ?)
+        ''', [(archive.search_rowid(block_id, position), row[1], project_id) for position, row in enumerate(rows)])
+        cursor.execute('''
+            DELETE FROM Message_Archive WHERE block_id = ?
+        ''', (block_id,))
+    return len(blocks)
+
+def purge_project_batch(project_id, batch_size):
+    '''Delete up to `batch_size` rows of a soft-deleted project in one short transaction.
+
+    Returns the number of rows deleted, 0 once the project is completely gone.
+    '''
+    def write(cursor):
+        deleted = _purge_archive_blocks(cursor, project_id, batch_size)
+        if deleted:
+            return deleted
+
+        for table, key in PURGE_TABLES:
+            cursor.execute(f'''
+                DELETE FROM {table} WHERE {key} IN (
+                    SELECT {key} FROM {table} WHERE project_id = ? LIMIT ?
+                )
+            ''', (project_id, batch_size))
+            if cursor.rowcount:
+                return cursor.rowcount
+
+        # Only the project and its memberships are left, the memberships go with it
+        cursor.execute('''
+            DELETE FROM Project WHERE project_id = ? AND deleted_at IS NOT NULL
+        ''', (project_id,))
+        return cursor.rowcount
+
+    return writer.run(write)  # Return number of rows deleted
+
+def verify_project_summaries():
+    '''Compare every Project_Summary row with counts taken from the tables themselves.
+
+    Returns a list of (project_id, column, stored value, expected value) for everything that drifted. Read cursors past
+    the end of their project's messages are reported as the column "messages_read of user <user_id>".
+    '''
+    columns = ['project_id', *(column for _, column in create_db.SUMMARY_STATUS_COLUMNS), 'member_count', 'message_count',
+               'last_message_at']
+    with connect() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute(f'''
+            SELECT {', '.join(columns)} FROM Project_Summary ORDER BY project_id
+        ''')
+        stored = {row[0]: row for row in cursor.fetchall()}
+        cursor.execute(create_db.SUMMARY_SELECT)
+        expected = {row[0]: row for row in cursor.fetchall()}
+
+        cursor.execute('''
+            SELECT Project_User.project_id, user_id, messages_read, message_count FROM Project_User
+            JOIN Project_Summary ON Project_Summary.project_id = Project_User.project_id
+            WHERE messages_read > message_count
+        ''')
+        ahead = cursor.fetchall()
+
+    drift = []
+    for project_id in sorted(stored.keys() | expected.keys()):
+        row, want = stored.get(project_id), expected.get(project_id)
+        for index, column in enumerate(columns[1:], start=1):
+            value = row[index] if row else None
+            if value != (want[index] if want else None):
+                drift.append((project_id, column, value, want[index] if want else None))
+    drift += [(project_id, f'messages_read of user {user_id}', read, count) for project_id, user_id, read, count in ahead]
+
+    return drift  # Return list of differences
+
+def rebuild_project_summaries(project_ids=None):
+    '''Recompute the Project_Summary rows of some projects, or all of them, from the tables. Returns the number rebuilt.'''
+    def write(cursor):
+        if project_ids is None:
+            cursor.execute('DELETE FROM Project_Summary')
+            cursor.execute(f'INSERT INTO Project_Summary {create_db.SUMMARY_SELECT}')
+        else:
+            placeholders = ', '.join('?' * len(project_ids))
+            cursor.execute(f'DELETE FROM Project_Summary WHERE project_id IN ({placeholders})', project_ids)
+            cursor.execute(f'INSERT INTO Project_Summary {create_db.SUMMARY_SELECT} WHERE project_id IN ({placeholders})',
+                           project_ids)
+        rebuilt = cursor.rowcount
+
+        # A cursor can't be past the last message
+        cursor.execute('''
+            UPDATE Project_User SET messages_read = (
+                SELECT message_count FROM Project_Summary WHERE Project_Summary.project_id = Project_User.project_id
+            )
+            WHERE messages_read > (
+                SELECT message_count FROM Project_Summary WHERE Project_Summary.project_id = Project_User.project_id
+            )
+        ''')
+        return rebuilt
+
+    return writer.run(write)  # Return number of rows rebuilt
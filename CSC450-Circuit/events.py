@@ -0,0 +1,190 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import deque, namedtuple
+
+# Publish/subscribe fan-out of project events (new messages, task changes) to connected members
+# Routes publish after a write commits, and the /events (SSE) and /poll (long-poll) endpoints wait on the broker
+# InProcessBroker only reaches clients connected to the same process. SQLiteBroker shares events between
+# worker processes on one machine through a small local database, select it with EVENT_BROKER=sqlite
+# wait() blocks the calling thread, wait_async() is the same wait for the async server (asgi.py) and only holds a
+# coroutine while the project is quiet
+
+Event = namedtuple('Event', ['event_id', 'project_id', 'event_type', 'data'])
+
+# Number of recent events kept per project so reconnecting clients can catch up
+BACKLOG = int(os.getenv('EVENT_BACKLOG', 200))
+
+def format_sse(event):
+    '''Format an event as a Server-Sent Events frame.'''
+    return f'id: {event.event_id}\nevent: {event.event_type}\ndata: {json.dumps(event.data)}\n\n'
+
+def to_dict(event):
+    '''Convert an event to a dictionary for the long-poll JSON response.'''
+    return {'id': event.event_id, 'type': event.event_type, 'data': event.data}
+
+
+class InProcessBroker:
+    '''Deliver events to subscribers waiting in this process.'''
+
+    def __init__(self, backlog=BACKLOG):
+        self.backlog = backlog
+        self._lock = threading.Lock()
+        self._events = {}  # project_id -> deque of recent events
+        self._conditions = {}  # project_id -> condition waiters block on
+        self._futures = {}  # project_id -> set of (event loop, future) for coroutines waiting in wait_async
+        self._last_id = 0
+        self.epoch = f'{os.getpid()}-{time.time_ns()}'  # Event IDs start over with every broker
+
+    def _condition(self, project_id):
+        condition = self._conditions.get(project_id)
+        if condition is None:
+            condition = self._conditions[project_id] = threading.Condition(self._lock)
+        return condition
+
+    def publish(self, project_id, event_type, data):
+        '''Record an event and wake everyone waiting on the project.'''
+        project_id = int(project_id)
+        with self._lock:
+            self._last_id += 1
+            event = Event(self._last_id, project_id, event_type, data)
+            if project_id not in self._events:
+                self._events[project_id] = deque(maxlen=self.backlog)
+            self._events[project_id].append(event)
+            self._condition(project_id).notify_all()
+            for loop, future in self._futures.pop(project_id, ()):
+                loop.call_soon_threadsafe(_wake, future)
+        return event
+
+    def last_event_id(self, project_id):
+        '''Return the ID a new subscriber should start after.'''
+        with self._lock:
+            return self._last_id
+
+    def wait(self, project_id, after, timeout):
+        '''Block until the project has events newer than `after` or the timeout passes. Returns the new events.'''
+        project_id = int(project_id)
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            condition = self._condition(project_id)
+            while True:
+                events = [event for event in self._events.get(project_id, ()) if event.event_id > after]
+                remaining = deadline - time.monotonic()
+                if events or remaining <= 0:
+                    return events
+                condition.wait(remaining)
+
+    async def wait_async(self, project_id, after, timeout, executor=None):
+        '''Like wait(), without blocking a thread. Returns the new events.'''
+        project_id = int(project_id)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            with self._lock:
+                events = [event for event in self._events.get(project_id, ()) if event.event_id > after]
+                remaining = deadline - loop.time()
+                if events or remaining <= 0:
+                    return events
+                waiter = (loop, loop.create_future())
+                self._futures.setdefault(project_id, set()).add(waiter)
+            try:
+                await asyncio.wait_for(waiter[1], remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self._lock:
+                    waiters = self._futures.get(project_id)
+                    if waiters is not None:
+                        waiters.discard(waiter)
+                        if not waiters:
+                            del self._futures[project_id]
+
+
+class SQLiteBroker:
+    '''Share events between worker processes through a local SQLite file that subscribers poll.'''
+
+    def __init__(self, path, backlog=BACKLOG, poll_interval=0.25):
+        self.path = path
+        self.backlog = backlog
+        self.poll_interval = poll_interval
+        self.epoch = os.path.abspath(path)  # Event IDs last as long as the file
+        self._local = threading.local()
+
+        conn = self._connection()
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS Event (
+                event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                project_id INTEGER NOT NULL,
+                event_type TEXT NOT NULL,
+                data TEXT NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_event_project ON Event (project_id, event_id)')
+        conn.commit()
+
+    def _connection(self):
+        # One connection per thread, subscribers poll from their own request thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA synchronous = NORMAL')
+        return conn
+
+    def publish(self, project_id, event_type, data):
+        '''Store an event and trim the project's backlog.'''
+        conn = self._connection()
+        cursor = conn.execute('INSERT INTO Event (project_id, event_type, data) VALUES (?, ?, ?)',
+                              (project_id, event_type, json.dumps(data)))
+        event_id = cursor.lastrowid
+        conn.execute('DELETE FROM Event WHERE project_id = ? AND event_id <= ?', (project_id, event_id - self.backlog))
+        conn.commit()
+        return Event(event_id, int(project_id), event_type, data)
+
+    def last_event_id(self, project_id):
+        '''Return the ID a new subscriber should start after.'''
+        result = self._connection().execute('SELECT MAX(event_id) FROM Event WHERE project_id = ?', (project_id,)).fetchone()
+        return result[0] or 0
+
+    def wait(self, project_id, after, timeout):
+        '''Poll until the project has events newer than `after` or the timeout passes. Returns the new events.'''
+        deadline = time.monotonic() + timeout
+        conn = self._connection()
+        while True:
+            rows = conn.execute('''
+                SELECT event_id, project_id, event_type, data FROM Event
+                WHERE project_id = ? AND event_id > ?
+                ORDER BY event_id
+            ''', (project_id, after)).fetchall()
+            if rows or time.monotonic() >= deadline:
+                return [Event(row[0], row[1], row[2], json.loads(row[3])) for row in rows]
+            time.sleep(min(self.poll_interval, max(0, deadline - time.monotonic())))
+
+    async def wait_async(self, project_id, after, timeout, executor=None):
+        '''Like wait(), sleeping on the event loop between polls. Each poll runs on `executor`.'''
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            events = await loop.run_in_executor(executor, self.wait, project_id, after, 0)
+            remaining = deadline - loop.time()
+            if events or remaining <= 0:
+                return events
+            await asyncio.sleep(min(self.poll_interval, remaining))
+
+
+def _wake(future):
+    # Runs on the waiter's event loop. The wait may already have timed out
+    if not future.done():
+        future.set_result(None)
+
+def create_broker():
+    '''Create the broker selected by the EVENT_BROKER environment variable.'''
+    if os.getenv('EVENT_BROKER') == 'sqlite':
+        default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'events.db')
+        return SQLiteBroker(os.getenv('EVENT_BROKER_PATH', default_path))
+    return InProcessBroker()
+
+broker = create_broker()
@@ -0,0 +1,307 @@
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from functools import lru_cache, wraps
+from flask import g, has_request_context, request
+
+# Query and request instrumentation, exposed in the Prometheus text format by the /metrics route
+# db.py opens its connections with InstrumentedConnection, whose cursors time every statement (including fetching
+# its rows) under a normalized form of its SQL. Inside a request the numbers are collected on `g` and merged into the
+# process-wide totals once, when the request ends, so a query costs two clock reads and a dictionary update
+# Every request's time is split into phases: db (SQL, including the row factories that build models), model (localizing
+# timestamps and serializing models), template (Jinja) and other (everything else)
+# Queries and requests slower than the configured thresholds are logged
+
+ENABLED = os.getenv('METRICS_ENABLED', '1') == '1'
+
+# Thresholds for the slow query and slow request log, in milliseconds
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 100))
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', 500))
+
+# Upper bounds of the request duration histogram, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+logger = logging.getLogger('circuit.metrics')
+
+_WHITESPACE = re.compile(r'\s+')
+_PLACEHOLDER_LIST = re.compile(r'\?(?:\s*,\s*\?)+')
+
+@lru_cache(maxsize=1024)
+def normalize(sql):
+    '''Collapse whitespace and variable-length placeholder lists so the same query always has the same text.'''
+    return _PLACEHOLDER_LIST.sub('?, ...', _WHITESPACE.sub(' ', sql).strip())
+
+
+class Registry:
+    '''Process-wide counters, merged from finished requests and from queries run outside requests.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queries = {}  # normalized SQL -> [count, seconds]
+        self.requests = {}  # (endpoint, method, status) -> count
+        self.histograms = {}  # endpoint -> [bucket counts..., +Inf count, sum]
+        self.phases = {}  # (endpoint, phase) -> seconds
+        self.slow_queries = 0
+        self.slow_requests = 0
+        self.gauges = []  # (name, help, function returning the current value)
+
+    def add_queries(self, queries):
+        with self._lock:
+            for sql, (count, seconds) in queries.items():
+                totals = self.queries.get(sql)
+                if totals is None:
+                    self.queries[sql] = [count, seconds]
+                else:
+                    totals[0] += count
+                    totals[1] += seconds
+
+    def add_request(self, endpoint, method, status, seconds, phases, queries):
+        self.add_queries(queries)
+        with self._lock:
+            key = (endpoint, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+            histogram = self.histograms.get(endpoint)
+            if histogram is None:
+                histogram = self.histograms[endpoint] = [0] * (len(BUCKETS) + 2)
+            for index, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[index] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+
+            for phase, phase_seconds in phases.items():
+                self.phases[(endpoint, phase)] = self.phases.get((endpoint, phase), 0) + phase_seconds
+
+    def add_slow(self, kind):
+        '''Count a slow query or a slow request.'''
+        with self._lock:
+            setattr(self, kind, getattr(self, kind) + 1)
+
+    def register_gauge(self, name, help_text, function):
+        '''Report the value of `function()` as a gauge on every scrape.'''
+        self.gauges.append((name, help_text, function))
+
+    def render(self):
+        '''Format every metric in the Prometheus text exposition format.'''
+        with self._lock:
+            queries = {sql: list(totals) for sql, totals in self.queries.items()}
+            requests = dict(self.requests)
+            histograms = {endpoint: list(counts) for endpoint, counts in self.histograms.items()}
+            phases = dict(self.phases)
+            slow_queries, slow_requests = self.slow_queries, self.slow_requests
+
+        lines = [
+            '# HELP circuit_requests_total Requests handled, by endpoint, method and status.',
+            '# TYPE circuit_requests_total counter',
+        ]
+        for (endpoint, method, status), count in sorted(requests.items()):
+            lines.append(f'circuit_requests_total{{endpoint="{_label(endpoint)}",method="{method}",status="{status}"}} {count}')
+
+        lines += [
+            '# HELP circuit_request_duration_seconds Request duration, by endpoint.',
+            '# TYPE circuit_request_duration_seconds histogram',
+        ]
+        for endpoint, counts in sorted(histograms.items()):
+            label = _label(endpoint)
+            for bound, count in zip(BUCKETS, counts):
+                lines.append(f'circuit_request_duration_seconds_bucket{{endpoint="{label}",le="{bound}"}} {count}')
+            lines.append(f'circuit_request_duration_seconds_bucket{{endpoint="{label}",le="+Inf"}} {counts[-2]}')
+            lines.append(f'circuit_request_duration_seconds_sum{{endpoint="{label}"}} {counts[-1]:.6f}')
+            lines.append(f'circuit_request_duration_seconds_count{{endpoint="{label}"}} {counts[-2]}')
+
+        lines += [
+            '# HELP circuit_request_phase_seconds_total Time spent in each phase of a request, by endpoint.',
+            '# TYPE circuit_request_phase_seconds_total counter',
+        ]
+        for (endpoint, phase), seconds in sorted(phases.items()):
+            lines.append(f'circuit_request_phase_seconds_total{{endpoint="{_label(endpoint)}",phase="{phase}"}} {seconds:.6f}')
+
+        lines += [
+            '# HELP circuit_queries_total SQL statements executed, by normalized statement.',
+            '# TYPE circuit_queries_total counter',
+        ]
+        for sql, (count, _) in sorted(queries.items()):
+            lines.append(f'circuit_queries_total{{query="{_label(sql)}"}} {count}')
+        lines += [
+            '# HELP circuit_query_seconds_total Time spent executing and fetching SQL statements, by normalized statement.',
+            '# TYPE circuit_query_seconds_total counter',
+        ]
+        for sql, (_, seconds) in sorted(queries.items()):
+            lines.append(f'circuit_query_seconds_total{{query="{_label(sql)}"}} {seconds:.6f}')
+
+        lines += [
+            '# HELP circuit_slow_queries_total Statements slower than SLOW_QUERY_MS.',
+            '# TYPE circuit_slow_queries_total counter',
+            f'circuit_slow_queries_total {slow_queries}',
+            '# HELP circuit_slow_requests_total Requests slower than SLOW_REQUEST_MS.',
+            '# TYPE circuit_slow_requests_total counter',
+            f'circuit_slow_requests_total {slow_requests}',
+        ]
+        for name, help_text, function in self.gauges:
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge', f'{name} {function()}']
+
+        return '\n'.join(lines) + '\n'
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+registry = Registry()
+
+
+class RequestMetrics:
+    '''Numbers collected while one request is handled, stored on `g`.'''
+    __slots__ = ('start', 'queries', 'query_count', 'db', 'model', 'template', 'phase', 'template_start')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = {}  # normalized SQL -> [count, seconds]
+        self.query_count = 0
+        self.db = self.model = self.template = 0.0
+        self.phase = None  # Set while a model phase runs, so nested timers don't count twice
+        self.template_start = None
+
+def _current():
+    if has_request_context():
+        return g.get('metrics')
+    return None
+
+def record_query(sql, seconds, counted=True):
+    '''Add one statement's time to the current request, or straight to the registry outside a request.'''
+    sql = normalize(sql)
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        registry.add_slow('slow_queries')
+        logger.warning('Slow query (%.1f ms): %s', seconds * 1000, sql)
+
+    current = _current()
+    if current is None:
+        registry.add_queries({sql: (1 if counted else 0, seconds)})
+        return
+    totals = current.queries.get(sql)
+    if totals is None:
+        totals = current.queries[sql] = [0, 0.0]
+    if counted:
+        totals[0] += 1
+        current.query_count += 1
+    totals[1] += seconds
+    current.db += seconds
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    '''Cursor that times its statements. Fetching rows counts towards the statement that produced them.'''
+
+    _sql = None
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._sql = sql
+            record_query(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._sql = sql
+            record_query(sql, time.perf_counter() - start)
+
+    def _fetch(self, fetch, *args):
+        start = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            if self._sql is not None:
+                record_query(self._sql, time.perf_counter() - start, counted=False)
+
+    def fetchone(self):
+        return self._fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._fetch(super().fetchmany, size if size is not None else self.arraysize)
+
+    def fetchall(self):
+        return self._fetch(super().fetchall)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    '''Connection whose cursors are InstrumentedCursors and whose commits are timed too.'''
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            record_query('COMMIT', time.perf_counter() - start)
+
+def connection_factory():
+    '''The sqlite3.connect factory db.py should use.'''
+    return InstrumentedConnection if ENABLED else sqlite3.Connection
+
+def timed(phase):
+    '''Decorator that counts a function's time towards a request phase, e.g. @timed('model').'''
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            current = _current()
+            if current is None or current.phase is not None:
+                return function(*args, **kwargs)
+            current.phase = phase
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                setattr(current, phase, getattr(current, phase) + time.perf_counter() - start)
+                current.phase = None
+        return wrapper
+    return decorator
+
+def start_request():
+    '''Start timing a request. Registered with before_request ahead of everything else.'''
+    if ENABLED:
+        g.metrics = RequestMetrics()
+
+def template_started(sender, template, context, **extra):
+    '''before_render_template signal handler.'''
+    current = _current()
+    if current is not None:
+        current.template_start = time.perf_counter()
+
+def template_finished(sender, template, context, **extra):
+    '''template_rendered signal handler.'''
+    current = _current()
+    if current is not None and current.template_start is not None:
+        current.template += time.perf_counter() - current.template_start
+        current.template_start = None
+
+def finish_request(response):
+    '''Record the request's totals and log it if it was slow. Registered with after_request.
+
+    A streamed response is timed up to the point its body starts, queries made while it streams count on their own.
+    '''
+    current = g.pop('metrics', None)
+    if current is None:
+        return response
+
+    seconds = time.perf_counter() - current.start
+    endpoint = request.endpoint or 'unknown'
+    phases = {'db': current.db, 'model': current.model, 'template': current.template}
+    phases['other'] = max(0.0, seconds - sum(phases.values()))
+    registry.add_request(endpoint, request.method, response.status_code, seconds, phases, current.queries)
+
+    if seconds * 1000 >= SLOW_REQUEST_MS:
+        registry.add_slow('slow_requests')
+        slowest = sorted(current.queries.items(), key=lambda item: item[1][1], reverse=True)[:3]
+        logger.warning('Slow request (%.1f ms) %s %s: %d queries, %s; slowest: %s',
+                       seconds * 1000, request.method, request.path, current.query_count,
+                       ', '.join(f'{phase} {phase_seconds * 1000:.1f} ms' for phase, phase_seconds in phases.items()),
+                       '; '.join(f'{totals[1] * 1000:.1f} ms x{totals[0]} {sql}' for sql, totals in slowest))
+    return response
@@ -1,77 +1,236 @@
-from datetime import datetime
-from pytz import timezone, utc
+from datetime import datetime, timezone
+from functools import lru_cache
+import json
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+import os
+import metrics
 
 # Defines the class models used throughout the application
-# All classes have a to_dict method, allowing them to be easily serialized to JSON for the javascript frontend
+# Models use __slots__ to keep large lists of tasks and messages small, and can be built straight from
+# sqlite3 rows by using from_row as a cursor's row_factory
+# All classes have a to_dict method and a to_json method that writes JSON directly without an intermediate dictionary
 
-class User:
-    def __init__(self, user_id, username):
+# Columns of the task board, in order
+TASK_STATUSES = ('todo', 'designing', 'inProgress', 'testing', 'done')
+
+# Time zone messages are shown in for users who haven't chosen one
+DEFAULT_TIMEZONE = os.getenv('DEFAULT_TIMEZONE', 'America/New_York')
+
+@lru_cache(maxsize=None)
+def get_timezone(name):
+    '''Return the cached tzinfo for a time zone name, falling back to the default for unknown names.'''
+    try:
+        return ZoneInfo(name or DEFAULT_TIMEZONE)
+    except (ZoneInfoNotFoundError, ValueError):
+        return ZoneInfo(DEFAULT_TIMEZONE)
+
+def is_valid_timezone(name):
+    '''Check whether a name is a known IANA time zone such as America/New_York.'''
+    try:
+        ZoneInfo(name)
+        return True
+    except (ZoneInfoNotFoundError, ValueError):
+        return False
+
+def _format_minute(minute, tz):
+    # Convert a UTC "YYYY-MM-DD HH:MM" string to the (date, time) strings shown next to a message
+    local_dt = datetime.fromisoformat(minute).replace(tzinfo=timezone.utc).astimezone(tz)
+    return local_dt.strftime("%m/%d"), local_dt.strftime("%I:%M %p")
+
+@lru_cache(maxsize=4096)
+def _localize_minute(minute, tz_name):
+    return _format_minute(minute, get_timezone(tz_name))
+
+def localize(date_time, tz_name=DEFAULT_TIMEZONE):
+    '''Convert one UTC database timestamp to a local (date, time) pair. Conversions are cached per minute and zone.'''
+    return _localize_minute(date_time[:16], tz_name)
+
+@metrics.timed('model')
+def format_timestamps(timestamps, tz_name=DEFAULT_TIMEZONE):
+    '''Convert a batch of UTC database timestamps to local (date, time) pairs.
+
+    Only the minute is displayed, so each distinct minute is converted once and reused for the rest of the batch.
+    '''
+    tz = get_timezone(tz_name)
+    formatted = {}
+    result = []
+    for date_time in timestamps:
+        minute = date_time[:16]
+        local = formatted.get(minute)
+        if local is None:
+            local = formatted[minute] = _format_minute(minute, tz)
+        result.append(local)
+    return result
+
+_encode = json.JSONEncoder().encode
+
+class Model:
+    '''Base class of the models. `fields` lists the attributes that are serialized, in order.'''
+    __slots__ = ()
+    fields = ()
+
+    @classmethod
+    def from_row(cls, cursor, row):
+        '''Row factory building a model from a row whose columns are in constructor order.'''
+        return cls(*row)
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.fields}
+
+    def to_json(self):
+        return '{' + ','.join(f'"{field}":{_encode(getattr(self, field))}' for field in self.fields) + '}'
+
+
+class User(Model):
+    __slots__ = ('user_id', 'username', 'timezone', 'version', 'projects')
+    fields = ('user_id', 'username', 'timezone')
+
+    def __init__(self, user_id, username, timezone=None, version=0):
         self.user_id = user_id
         self.username = username
-        self.projects = []
+        self.timezone = timezone or DEFAULT_TIMEZONE
+        self.version = version  # Change counter of the user's own pages, not serialized
+        self.projects = ()  # Filled in by callers that need it, not serialized
 
-    def to_dict(self):
-        return {
-            "user_id": self.user_id,
-            "username": self.username,
-            "projects": [project.to_dict() for project in self.projects]
-        }
 
+class Project(Model):
+    __slots__ = ('project_id', 'project_name', 'tasks', 'users')
+    fields = ('project_id', 'project_name')
 
-class Project:
     def __init__(self, project_id, project_name):
         self.project_id = project_id
         self.project_name = project_name
-        self.tasks = []
-        self.users = []
+        self.tasks = ()  # Filled in by callers that need it, not serialized
+        self.users = ()
 
-    def to_dict(self):
-        return {
-            "project_id": self.project_id,
-            "project_name": self.project_name,
-            "tasks": [task.to_dict() for task in self.tasks],
-            "users": [user.to_dict() for user in self.users]
-        }
+
+class ProjectSummary(Model):
+    __slots__ = ('project_id', 'project_name', 'version', 'task_counts', 'member_count', 'unread_count',
+                 'last_message_at', 'timezone')
+    fields = ('project_id', 'project_name', 'task_counts', 'member_count', 'unread_count', 'last_message_at')
+
+    def __init__(self, project_id, project_name, version, task_counts, member_count, unread_count, last_message_at,
+                 timezone=None):
+        self.project_id = project_id
+        self.project_name = project_name
+        self.version = version  # Change counter of the project, not serialized
+        self.task_counts = task_counts  # Status -> number of tasks, for every status
+        self.member_count = member_count
+        self.unread_count = unread_count
+        self.last_message_at = last_message_at  # UTC, None before the first message
+        self.timezone = timezone or DEFAULT_TIMEZONE  # Time zone of the user viewing the dashboard
+
+    @classmethod
+    def from_row(cls, cursor, row):
+        '''Row factory for (project_id, project_name, version, a count per status, member_count, unread_count,
+        last_message_at, timezone) rows.'''
+        statuses = len(TASK_STATUSES)
+        return cls(row[0], row[1], row[2], dict(zip(TASK_STATUSES, row[3:3 + statuses])), *row[3 + statuses:])
+
+    @property
+    def last_message(self):
+        '''Local (date, time) of the newest message, or None.'''
+        return localize(self.last_message_at, self.timezone) if self.last_message_at else None
 
 
-class Task:
-    def __init__(self, task_id, task_title, task_description, task_status):
+class Task(Model):
+    __slots__ = ('task_id', 'task_title', 'task_description', 'task_status', 'assigned_members')
+    fields = ('task_id', 'task_title', 'task_description', 'task_status', 'assigned_members')
+
+    def __init__(self, task_id, task_title, task_description, task_status, assigned_members=None):
         self.task_id = task_id
         self.task_title = task_title
         self.task_description = task_description
         self.task_status = task_status
+        self.assigned_members = assigned_members  # List of usernames, None when not loaded
 
-    def to_dict(self):
-        return {
-            "task_id": self.task_id,
-            "task_title": self.task_title,
-            "task_description": self.task_description,
-            "task_status": self.task_status
-        }
-    
-class Message:
-    def __init__(self, message_id, content, user_id, project_id, date_time):
+    @classmethod
+    def from_row(cls, cursor, row):
+        '''Row factory for (task_id, task_title, task_description, task_status[, assignees as a JSON array]) rows.'''
+        assigned_members = json.loads(row[4]) if len(row) > 4 else None
+        return cls(row[0], row[1], row[2], row[3], assigned_members)
+
+
+class Message(Model):
+    __slots__ = ('message_id', 'content', 'user_id', 'project_id', 'date_time', 'timezone', 'sender_name', 'local')
+    fields = ('message_id', 'content', 'user_id', 'project_id', 'date_time', 'date', 'time', 'sender_name')
+
+    def __init__(self, message_id, content, user_id, project_id, date_time, timezone=None, sender_name=None):
         self.message_id = message_id
         self.content = content
         self.user_id = user_id
         self.project_id = project_id
-        self.date_time = date_time
+        self.date_time = date_time  # UTC, as stored in the database
+        self.timezone = timezone or DEFAULT_TIMEZONE  # Time zone of the user viewing the message
+        self.sender_name = sender_name
+        self.local = None  # Local (date, time), converted the first time date or time is read
 
-        # Convert UTC to Eastern Time
-        dt_object = datetime.strptime(date_time, "%Y-%m-%d %H:%M:%S")
-        dt_object = dt_object.replace(tzinfo=utc)
-        local_dt = dt_object.astimezone(timezone('America/New_York'))
-        
-        self.date = local_dt.strftime("%m/%d")
-        self.time = local_dt.strftime("%I:%M %p")
+    @classmethod
+    def from_row(cls, cursor, row):
+        '''Row factory for (message_id, content, sender_id, project_id, timestamp[, sender username]) rows.'''
+        return cls(row[0], row[1], row[2], row[3], row[4], None, row[5] if len(row) > 5 else None)
 
-    def to_dict(self):
-        return {
-            "message_id": self.message_id,
-            "content": self.content,
-            "user_id": self.user_id,
-            "project_id": self.project_id,
-            "date_time": self.date_time,
-            "date": self.date,
-            "time": self.time
-        }
\ No newline at end of file
+    def to_event(self):
+        '''The message as pushed to every viewer of a project, with only the UTC timestamp. Pages localize it.'''
+        return {field: getattr(self, field) for field in self.fields if field not in ('date', 'time')}
+
+    @property
+    def date(self):
+        if self.local is None:
+            self.local = localize(self.date_time, self.timezone)
+        return self.local[0]
+
+    @property
+    def time(self):
+        if self.local is None:
+            self.local = localize(self.date_time, self.timezone)
+        return self.local[1]
+
+
+@metrics.timed('model')
+def localize_messages(messages, timezone=None):
+    '''Convert the timestamps of a batch of messages at once, optionally switching them to `timezone` first.'''
+    by_timezone = {}
+    for message in messages:
+        if timezone:
+            message.timezone = timezone
+        by_timezone.setdefault(message.timezone, []).append(message)
+
+    for tz_name, batch in by_timezone.items():
+        for message, local in zip(batch, format_timestamps([message.date_time for message in batch], tz_name)):
+            message.local = local
+
+# Number of list items serialized into each chunk by stream_json
+JSON_CHUNK_SIZE = 256
+
+def stream_json(value):
+    '''Serialize models, lists or generators of models and dictionaries containing them as chunks of JSON text.
+
+    Models are written with to_json, so large lists are never copied into dictionaries first.
+    '''
+    if isinstance(value, Model):
+        yield value.to_json()
+    elif isinstance(value, dict):
+        yield '{'
+        for index, (key, item) in enumerate(value.items()):
+            yield (',' if index else '') + _encode(str(key)) + ':'
+            yield from stream_json(item)
+        yield '}'
+    elif isinstance(value, (list, tuple)) or hasattr(value, '__next__'):
+        chunk = ['[']
+        for index, item in enumerate(value):
+            if index:
+                chunk.append(',')
+            chunk.append(item.to_json() if isinstance(item, Model) else ''.join(stream_json(item)))
+            if len(chunk) >= JSON_CHUNK_SIZE * 2:
+                yield ''.join(chunk)
+                chunk = []
+        chunk.append(']')
+        yield ''.join(chunk)
+    else:
+        yield _encode(value)
+
+@metrics.timed('model')
+def dumps(value):
+    '''Serialize models, or lists and dictionaries containing them, to a JSON string.'''
+    return ''.join(stream_json(value))
@@ -0,0 +1,64 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# Password hashing on a dedicated, bounded thread pool
+# Hashes are deliberately slow, so a burst of logins could otherwise tie up every request thread at once
+# At most HASH_WORKERS hashes run together and at most HASH_QUEUE more wait, anything beyond that is rejected
+# straight away with HashingBusy instead of queueing behind the burst. A hash not done within HASH_TIMEOUT seconds
+# raises HashingBusy as well
+
+# Any werkzeug method string, e.g. scrypt:32768:8:1 or pbkdf2:sha256:600000
+HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', os.cpu_count() or 2))
+HASH_QUEUE = int(os.getenv('PASSWORD_HASH_QUEUE', HASH_WORKERS * 4))
+HASH_TIMEOUT = float(os.getenv('PASSWORD_HASH_TIMEOUT', 10))
+
+
+class HashingBusy(Exception):
+    '''Raised when the hashing pool is saturated or too slow and the request should be retried later.'''
+
+
+class Hasher:
+    '''Runs password hashing and verification on a bounded executor.'''
+
+    def __init__(self, method=HASH_METHOD, workers=HASH_WORKERS, max_queued=HASH_QUEUE, timeout=HASH_TIMEOUT):
+        self.method = method
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='password-hash')
+        self._slots = threading.BoundedSemaphore(workers + max_queued)
+        self._prefix = None
+
+    def _run(self, function, *args):
+        # Take a slot without waiting so a saturated pool fails fast
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            future = self._executor.submit(function, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda future: self._slots.release())
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            raise HashingBusy() from None  # The hash finishes in the background and frees its slot then
+
+    def hash(self, password):
+        '''Hash a password with the configured method.'''
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, hashed_password, password):
+        '''Check a password against a stored hash.'''
+        return self._run(check_password_hash, hashed_password, password)
+
+    def needs_rehash(self, hashed_password):
+        '''Check whether a stored hash was made with different parameters than the configured method.'''
+        if self._prefix is None:
+            # werkzeug fills in defaults (e.g. the pbkdf2 iteration count), so take the prefix from a real hash, made on
+            # the pool like any other instead of on the request thread
+            self._prefix = self.hash('').split('$', 1)[0]
+        return hashed_password.split('$', 1)[0] != self._prefix
+
+hasher = Hasher()
@@ -0,0 +1,95 @@
+import logging
+import os
+import threading
+import time
+import archive
+import db
+
+# Removes the rows of soft-deleted projects in small batches
+# db.delete_project() only hides a project. The purger then deletes its messages and tasks a batch at a time, each in
+# its own transaction, and pauses in between so chat and task writes waiting for the write lock get their turn
+# It also prunes the tombstones of tasks deleted more than TASK_TOMBSTONE_DAYS ago. Task boards that last synced
+# before then get the whole board on their next sync instead of a delta
+# app.py runs it in a background thread, serve.py only in its first worker. `python purge.py` purges everything
+# right away
+
+# Rows deleted per transaction
+PURGE_BATCH_SIZE = int(os.getenv('PURGE_BATCH_SIZE', 500))
+
+# Seconds to wait between batches, and between checks for newly deleted projects
+PURGE_PAUSE = float(os.getenv('PURGE_PAUSE', 0.05))
+PURGE_INTERVAL = float(os.getenv('PURGE_INTERVAL', 60))
+
+# Days tombstones of deleted tasks are kept for task board deltas
+TASK_TOMBSTONE_DAYS = float(os.getenv('TASK_TOMBSTONE_DAYS', 30))
+
+logger = logging.getLogger('circuit.purge')
+
+def purge_project(project_id, batch_size=PURGE_BATCH_SIZE, pause=PURGE_PAUSE):
+    '''Delete a soft-deleted project batch by batch. Returns the number of batches it took.'''
+    batches = 0
+    while True:
+        deleted = db.purge_project_batch(project_id, batch_size)
+        batches += 1
+        if not deleted:
+            archive.remove_project(archive.directory(db.db_path), project_id)
+            return batches
+        time.sleep(pause)
+
+def purge_all(batch_size=PURGE_BATCH_SIZE, pause=PURGE_PAUSE):
+    '''Purge every soft-deleted project. Returns the IDs of the purged projects.'''
+    project_ids = db.get_deleted_projects()
+    for project_id in project_ids:
+        purge_project(project_id, batch_size, pause)
+    return project_ids
+
+
+def prune_tombstones(days=TASK_TOMBSTONE_DAYS, batch_size=PURGE_BATCH_SIZE, pause=PURGE_PAUSE):
+    '''Prune the tombstones of tasks deleted more than `days` days ago. Returns the number pruned.'''
+    cutoff = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - days * 86400))
+    pruned = 0
+    while True:
+        deleted = db.prune_task_tombstones(cutoff, batch_size)
+        pruned += deleted
+        if deleted < batch_size:
+            return pruned
+        time.sleep(pause)
+
+
+class Purger:
+    '''Background thread that purges deleted projects, woken early when a project is deleted.'''
+
+    def __init__(self, interval=PURGE_INTERVAL):
+        self.interval = interval
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        '''Start the purge thread if it isn't running yet.'''
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='purger', daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        '''Purge now instead of at the next interval.'''
+        self._wake.set()
+
+    def _run(self):
+        # The first pass picks up projects left over from before a restart
+        while True:
+            try:
+                purge_all()
+                prune_tombstones()
+            except Exception:
+                # Keep running, the rows left over are picked up on the next pass
+                logger.exception('Project purge failed')
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+purger = Purger()
+
+if __name__ == '__main__':
+    import create_db
+    create_db.create_db(db.db_path)
+    print(f'Purged projects: {purge_all()}')
+    print(f'Pruned task tombstones: {prune_tombstones()}')
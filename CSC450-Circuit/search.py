@@ -0,0 +1,106 @@
+import os
+import re
+import unicodedata
+from functools import lru_cache
+from markupsafe import escape
+
+# Turns search box text into FTS5 queries, ranks message hits and turns highlighted hits into safe HTML
+#
+# Tasks are ranked by FTS5's bm25() in SQL. For messages that doesn't scale: bm25() counts every document containing
+# each term across the whole index, so a common word costs a full pass over its postings on every search. Messages are
+# instead ranked in Python among the newest SEARCH_WINDOW matches, which FTS5 finds without reading further back.
+# Every candidate contains every term, so the term frequency and length parts of BM25 are enough to order them
+
+# Number of newest matching messages ranked together. Paging past them moves on to the next, older window
+SEARCH_WINDOW = int(os.getenv('SEARCH_WINDOW', 500))
+
+# Marks placed around matched terms by highlight() and snippet(). They are control characters that can't be typed in
+# the search box, so they survive HTML escaping and are then swapped for <mark> tags
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
+
+# BM25 parameters, the same defaults FTS5 uses
+K1 = 1.2
+B = 0.75
+
+MARKED = re.compile(f'{HIGHLIGHT_START}(.*?){HIGHLIGHT_END}', re.S)
+
+# Runs of letters and digits, the tokens of FTS5's unicode61 tokenizer
+TOKEN = re.compile(r'[^\W_]+')
+
+@lru_cache(maxsize=4096)
+def fold(text):
+    '''Lowercase text and strip its accents.'''
+    decomposed = unicodedata.normalize('NFKD', text.casefold())
+    return ''.join(char for char in decomposed if not unicodedata.combining(char))
+
+def parse(text):
+    '''Split search box text into (word, is_prefix) terms. A trailing * asks for a prefix match.'''
+    terms = []
+    for word in text.split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*')
+        if word:
+            terms.append((word, prefix))
+    return terms
+
+def match_expression(terms, project_id, columns):
+    '''Build an FTS5 MATCH expression that requires all terms in `columns`, limited to one project.
+
+    Every word is quoted so FTS5 operators and punctuation typed by the user are searched for literally.
+    Returns None if there are no terms.
+    '''
+    if not terms:
+        return None
+    phrases = ['"' + word.replace('"', '""') + '"' + ('*' if prefix else '') for word, prefix in terms]
+    return f'project_id : "{int(project_id)}" AND {{{" ".join(columns)}}} : ({" ".join(phrases)})'
+
+def rank(candidates, terms, content, highlighted):
+    '''Order candidate rows best match first by BM25 term frequency and length scoring, newest first on ties.
+
+    `content` returns a row's text and `highlighted` the same text with every matched token marked.
+    '''
+    words = [(fold(word), prefix) for word, prefix in terms]
+    lengths = [len(content(row).split()) or 1 for row in candidates]  # Words, close enough to FTS5's token count
+    average = sum(lengths) / len(lengths) if lengths else 1
+
+    scored = []
+    for row, length in zip(candidates, lengths):
+        # Count how often each term matched, from the tokens FTS5 marked. Neighbouring matches may share one mark
+        frequencies = [0] * len(words)
+        for marked in MARKED.findall(highlighted(row)):
+            for token in fold(marked).split():
+                for index, (word, prefix) in enumerate(words):
+                    if token == word or (prefix and token.startswith(word)):
+                        frequencies[index] += 1
+        norm = K1 * (1 - B + B * length / average)
+        scored.append((sum(tf * (K1 + 1) / (tf + norm) for tf in frequencies), row))
+
+    scored.sort(key=lambda item: item[0], reverse=True)  # Stable, candidates arrive newest first
+    return [row for _, row in scored]
+
+def highlight(text, terms):
+    '''Mark every token of `text` matching one of `terms`, like FTS5's highlight() for rows it has no content of.
+
+    A word made of several tokens marks each of them wherever it appears, which is close enough for ranking.
+    '''
+    tokens = set()
+    for word, prefix in terms:
+        parts = [fold(part) for part in TOKEN.findall(word)]
+        tokens.update((part, False) for part in parts[:-1])
+        if parts:
+            tokens.add((parts[-1], prefix))
+
+    def mark_token(match):
+        token = fold(match.group())
+        if any(token == part or (prefix and token.startswith(part)) for part, prefix in tokens):
+            return HIGHLIGHT_START + match.group() + HIGHLIGHT_END
+        return match.group()
+
+    return TOKEN.sub(mark_token, text)
+
+def mark(text):
+    '''Escape highlighted text for HTML and wrap the matched terms in <mark> tags.'''
+    if text is None:
+        return None
+    return str(escape(text)).replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_END, '</mark>')
@@ -0,0 +1,333 @@
+import logging
+import os
+import random
+import resource
+import signal
+import socket
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+from werkzeug.exceptions import HTTPException
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+# Production entry point: a pre-forking server for the Flask app
+# The master process imports the app once (schema migration, asset build, compiled templates) and opens the listening
+# socket, then forks WORKERS worker processes that share both. Each worker warms its own connection pool and answers
+# up to THREADS requests at a time. Event streams and long polls spend their time waiting, so they give their slot
+# back and keep a thread of their own outside that limit. Otherwise a few open project tabs per worker would use up
+# every slot. They are cut off when the worker stops, and browsers reconnect to another worker
+#   SIGHUP          graceful reload: the master re-executes itself with the same socket and preloads the new code, starts
+#                   a new set of workers and then lets the old ones finish their requests and exit
+#   SIGTERM/SIGINT  graceful stop, workers still busy after GRACEFUL_TIMEOUT seconds are killed
+# A worker is replaced after MAX_REQUESTS requests (plus some jitter, so they don't all restart at once) to cap memory
+# growth. Events have to reach members connected to other workers, so EVENT_BROKER defaults to sqlite here. Metrics
+# stay per process, /metrics reports the worker that answers it. It is meant to run behind a reverse proxy, so
+# PROXY_HOPS defaults to 1 and /metrics needs METRICS_TOKEN
+# Only the first worker, and whichever worker replaces it, purges deleted projects. A project deleted through another
+# worker is purged on the purger's next PURGE_INTERVAL pass
+# Usage: WORKERS=4 THREADS=8 PORT=8000 python serve.py
+
+HOST = os.getenv('HOST', '127.0.0.1')
+PORT = int(os.getenv('PORT', 8000))
+WORKERS = int(os.getenv('WORKERS', os.cpu_count() or 1))
+THREADS = int(os.getenv('THREADS', 8))  # Same as the default DB_POOL_SIZE, more threads would queue for connections
+
+# Requests a worker answers before it is replaced, 0 to keep workers forever
+MAX_REQUESTS = int(os.getenv('MAX_REQUESTS', 10000))
+MAX_REQUESTS_JITTER = int(os.getenv('MAX_REQUESTS_JITTER', MAX_REQUESTS // 10))
+
+# Seconds a stopping worker gets to finish its requests
+GRACEFUL_TIMEOUT = float(os.getenv('GRACEFUL_TIMEOUT', 30))
+
+# Seconds an idle keep-alive connection may hold a worker thread while waiting for its next request
+KEEPALIVE_TIMEOUT = float(os.getenv('KEEPALIVE_TIMEOUT', 5))
+
+# Routes that wait for events, served outside the THREADS limit
+STREAM_ENDPOINTS = frozenset({'project_events', 'poll_events'})
+
+# Set by the master for the process it re-executes into on SIGHUP
+LISTEN_FD_VARIABLE = 'CIRCUIT_LISTEN_FD'
+OLD_WORKERS_VARIABLE = 'CIRCUIT_OLD_WORKERS'
+
+logger = logging.getLogger('circuit.serve')
+
+def rss_kb():
+    '''Resident set size of this process in KB.'''
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # Peak instead of current where /proc is missing
+
+
+class RequestHandler(WSGIRequestHandler):
+    timeout = KEEPALIVE_TIMEOUT
+
+    def run_wsgi(self):
+        if not self.server.is_stream(self.path):
+            return super().run_wsgi()
+        # The connection is closed afterwards, so its thread never goes back to answering pages without a slot
+        self.server.detach(self.connection)
+        try:
+            return super().run_wsgi()
+        finally:
+            self.close_connection = True
+
+
+class WorkerServer(BaseWSGIServer):
+    '''Werkzeug's server answering `threads` requests at a time and stopping itself after `max_requests` requests.'''
+
+    multithread = True
+
+    def __init__(self, app, fd, threads=THREADS, max_requests=0):
+        super().__init__(HOST, PORT, self._count, handler=RequestHandler, fd=fd)
+        self.wsgi_app = app
+        self.max_requests = max_requests
+        self.handled = 0
+        self._routes = app.url_map.bind('')
+        # Every connection takes a slot, a worker with none left stops accepting so the connection goes to another
+        # worker instead
+        self._slots = threading.Semaphore(threads)
+        self._holding = set()  # Threads holding a slot
+        self._streams = set()  # Connections of detached event streams
+        self._lock = threading.Lock()
+        self._stopping = False
+
+    def _count(self, environ, start_response):
+        with self._lock:
+            self.handled += 1
+            if self.handled == self.max_requests:
+                logger.info('Worker %d answered %d requests, replacing it', os.getpid(), self.handled)
+                self.stop()
+        return self.wsgi_app(environ, start_response)
+
+    def is_stream(self, path):
+        '''Check whether a request path goes to one of the STREAM_ENDPOINTS.'''
+        try:
+            endpoint, _ = self._routes.match(urlsplit(path).path)
+        except HTTPException:
+            return False
+        return endpoint in STREAM_ENDPOINTS
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        thread = threading.Thread(target=self._handle, args=(request, client_address), name='request', daemon=True)
+        with self._lock:
+            self._holding.add(thread)
+        thread.start()
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            with self._lock:
+                self._streams.discard(request)
+            self.shutdown_request(request)
+            self._release()
+
+    def _release(self):
+        with self._lock:
+            if threading.current_thread() not in self._holding:
+                return
+            self._holding.discard(threading.current_thread())
+        self._slots.release()
+
+    def detach(self, connection):
+        '''Give back the calling thread's slot for a request that waits for events, and leave it out of drain().'''
+        self._release()
+        with self._lock:
+            self._streams.add(connection)
+
+    def stop(self):
+        '''Stop accepting connections. serve_forever() returns and drain() waits for the requests in progress.'''
+        if not self._stopping:
+            self._stopping = True
+            # shutdown() waits for serve_forever(), so it can't run on the thread serving or in a signal handler
+            threading.Thread(target=self.shutdown, daemon=True).start()
+
+    def drain(self):
+        with self._lock:
+            holding = list(self._holding)
+        for thread in holding:
+            thread.join()
+
+        # Streams never finish. Hanging up makes the browser reconnect, and the process exits under their threads
+        with self._lock:
+            streams = list(self._streams)
+        for connection in streams:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.server_close()
+
+def run_worker(app, listener, index):
+    '''Body of a forked worker process. `index` is its place in the set of workers, kept by its replacements.'''
+    started = time.perf_counter()
+    import db
+    import purge
+
+    # The master handles Ctrl+C and reloads, workers only stop when the master tells them to
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    # Warm this process's own connection pool, SQLite connections must not cross a fork
+    db.init_pool(db.db_path)
+    connections = [db.pool.acquire() for _ in range(db.pool.size)]
+    for conn in connections:
+        db.pool.release(conn)
+    # One purger for the whole server. In every worker they would take turns at the same batches and the write lock
+    if index == 0 and os.getenv('PURGE_IN_BACKGROUND', '1') == '1':
+        purge.purger.start()
+
+    max_requests = MAX_REQUESTS + random.randint(0, MAX_REQUESTS_JITTER) if MAX_REQUESTS else 0
+    server = WorkerServer(app, listener.fileno(), THREADS, max_requests)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+
+    logger.info('Worker %d ready in %.1f ms, RSS %d KB', os.getpid(), (time.perf_counter() - started) * 1000, rss_kb())
+    server.serve_forever()
+    server.drain()
+
+
+class Master:
+    '''Forks the workers, replaces the ones that exit and handles reload and stop signals.'''
+
+    def __init__(self, app, listener, workers=WORKERS):
+        self.app = app
+        self.listener = listener
+        self.size = workers
+        self.workers = {}  # pid -> (time it was started, index)
+        self.stopping = {}  # pid -> time by which it must have exited
+        self.signals = []
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                run_worker(self.app, self.listener, index)
+            except BaseException:
+                logger.exception('Worker %d failed', os.getpid())
+                status = 1
+            finally:
+                logging.shutdown()
+                os._exit(status)
+        self.workers[pid] = (time.monotonic(), index)
+
+    def stop(self, pids):
+        for pid in pids:
+            self.workers.pop(pid, None)
+            self.stopping[pid] = time.monotonic() + GRACEFUL_TIMEOUT
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def reap(self):
+        '''Collect exited workers and start replacements for the ones that weren't asked to stop.'''
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            self.stopping.pop(pid, None)
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            started, index = worker
+            if time.monotonic() - started < 1:
+                time.sleep(1)  # Don't fork in a tight loop while workers fail on startup
+            self.spawn(index)
+
+    def kill_overdue(self):
+        now = time.monotonic()
+        for pid, deadline in list(self.stopping.items()):
+            if now >= deadline:
+                logger.warning('Worker %d did not stop within %.0f s, killing it', pid, GRACEFUL_TIMEOUT)
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                self.stopping[pid] = float('inf')  # Reaped like any other exit
+
+    def reload(self):
+        # Start over in a fresh interpreter so changed code is loaded. The socket stays open and the workers keep
+        # answering until the new process has preloaded the app and started their replacements
+        logger.info('Reloading')
+        os.environ[LISTEN_FD_VARIABLE] = str(self.listener.fileno())
+        os.environ[OLD_WORKERS_VARIABLE] = ','.join(str(pid) for pid in [*self.workers, *self.stopping])
+        os.execv(sys.executable, [sys.executable, os.path.abspath(__file__), *sys.argv[1:]])
+
+    def run(self, old_workers=()):
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: self.signals.append(signum))
+
+        for index in range(self.size):
+            self.spawn(index)
+        self.stop(old_workers)  # Left over from before a reload
+
+        while True:
+            self.reap()
+            self.kill_overdue()
+            while self.signals:
+                if self.signals.pop(0) == signal.SIGHUP:
+                    self.reload()
+                else:
+                    return self.shutdown()
+            time.sleep(0.25)
+
+    def shutdown(self):
+        logger.info('Stopping %d workers', len(self.workers))
+        self.stop(list(self.workers))
+        while self.stopping:
+            self.reap()
+            self.kill_overdue()
+            time.sleep(0.1)
+        self.listener.close()
+
+def listen():
+    '''The listening socket, inherited across a reload or newly bound.'''
+    fd = os.getenv(LISTEN_FD_VARIABLE)
+    if fd:
+        listener = socket.socket(fileno=int(fd))
+    else:
+        listener = socket.create_server((HOST, PORT), backlog=2048)
+    listener.set_inheritable(True)
+    return listener
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(process)d %(levelname)s %(name)s: %(message)s')
+    started = time.perf_counter()
+    listener = listen()
+
+    # Import the app the way every worker will use it. The purger runs in the workers, a thread in the master would
+    # not survive the fork and could be holding a lock at the moment of it
+    purge_in_background = os.getenv('PURGE_IN_BACKGROUND', '1')
+    os.environ['PURGE_IN_BACKGROUND'] = '0'
+    if WORKERS > 1:
+        os.environ.setdefault('EVENT_BROKER', 'sqlite')
+    os.environ.setdefault('PROXY_HOPS', '1')
+    from app import app
+    os.environ['PURGE_IN_BACKGROUND'] = purge_in_background
+
+    # Compile every template once here instead of once per worker
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+    logger.info('Preloaded the app in %.1f ms, master RSS %d KB, serving http://%s:%d with %d workers x %d threads',
+                (time.perf_counter() - started) * 1000, rss_kb(), HOST, listener.getsockname()[1], WORKERS, THREADS)
+    old_workers = [int(pid) for pid in os.environ.pop(OLD_WORKERS_VARIABLE, '').split(',') if pid]
+    os.environ.pop(LISTEN_FD_VARIABLE, None)
+    Master(app, listener).run(old_workers)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"use strict";
+
+// This script receives live updates for the project page.
+// It listens on the Server-Sent Events stream, or long-polls when EventSource is not available,
+// and re-dispatches each update as a "project:message" or "project:task" event on the document.
+
+const live = document.getElementById("live");
+
+let lastEventId = Number(live.dataset.lastEventId);
+
+let dispatch = (type, data) => {
+    document.dispatchEvent(new CustomEvent(`project:${type}`, { detail: data }));
+};
+
+let listen = () => {
+    let source = new EventSource(`${live.dataset.eventsUrl}?after=${lastEventId}`);
+    ["message", "task"].forEach(type => {
+        source.addEventListener(type, event => {
+            lastEventId = Number(event.lastEventId);
+            dispatch(type, JSON.parse(event.data));
+        });
+    });
+};
+
+let poll = async () => {
+    while (true) {
+        try {
+            let response = await fetch(`${live.dataset.pollUrl}?after=${lastEventId}`);
+            if (!response.ok) {
+                throw new Error(response.statusText);
+            }
+            let result = await response.json();
+            result["events"].forEach(event => dispatch(event["type"], event["data"]));
+            lastEventId = result["last_event_id"];
+        } catch (error) {
+            // Back off before retrying after a failed request
+            await new Promise(resolve => setTimeout(resolve, 3000));
+        }
+    }
+};
+
+if (window.EventSource) {
+    listen();
+} else {
+    poll();
+}
@@ -0,0 +1,125 @@
+"use strict";
+
+// This script loads older chat history as the user scrolls up the message list, sends messages without
+// reloading the page and appends messages pushed by live.js.
+// The project page only renders the newest messages, older pages are fetched from the history endpoint.
+// Loading the page marks its messages as read, the ones pushed later are marked read when the user leaves the page.
+
+const messageList = document.getElementById("message_list");
+const messageForm = document.getElementById("message_form");
+
+let hasMore = messageList.dataset.hasMore === "true";
+let loading = false;
+let unread = false;
+
+// Dates and times in the viewer's chosen time zone, formatted like the server does ("10/18", "02:05 PM")
+const timeZone = messageList.dataset.timezone || undefined;
+const dateFormat = new Intl.DateTimeFormat("en-US", { timeZone, month: "2-digit", day: "2-digit" });
+const timeFormat = new Intl.DateTimeFormat("en-US", { timeZone, hour: "2-digit", minute: "2-digit", hour12: true });
+
+// Pushed messages only carry their UTC "YYYY-MM-DD HH:MM:SS" timestamp, the sender's zone may differ from this viewer's
+let localize = message => {
+    if (message["date"]) {
+        return [message["date"], message["time"]];
+    }
+    let utc = new Date(message["date_time"].replace(" ", "T") + "Z");
+    return [dateFormat.format(utc), timeFormat.format(utc)];
+};
+
+// Create a message element matching the server-rendered format
+let createMessage = message => {
+    let [date, time] = localize(message);
+    let messageItem = document.createElement("div");
+    messageItem.classList.add("message");
+    messageItem.dataset.messageId = message["message_id"];
+    messageItem.dataset.timestamp = message["date_time"];
+
+    let sender = document.createElement("strong");
+    sender.textContent = message["sender_name"];
+    messageItem.appendChild(sender);
+    messageItem.appendChild(document.createTextNode(` ${date} ${time}: ${message["content"]}`));
+    return messageItem;
+};
+
+// Fetch the page of messages before the oldest one currently shown and prepend it
+let loadOlderMessages = async () => {
+    if (!hasMore || loading) {
+        return;
+    }
+    loading = true;
+
+    let oldest = messageList.querySelector(".message");
+    let params = new URLSearchParams();
+    if (oldest) {
+        params.set("before_ts", oldest.dataset.timestamp);
+        params.set("before_id", oldest.dataset.messageId);
+    }
+
+    try {
+        let response = await fetch(`${messageList.dataset.historyUrl}?${params}`);
+        if (!response.ok) {
+            return;
+        }
+        let page = await response.json();
+
+        let fragment = document.createDocumentFragment();
+        page["messages"].forEach(message => fragment.appendChild(createMessage(message)));
+
+        // Keep the messages the user was looking at in place
+        let previousHeight = messageList.scrollHeight;
+        messageList.insertBefore(fragment, messageList.firstChild);
+        messageList.scrollTop += messageList.scrollHeight - previousHeight;
+
+        hasMore = page["has_more"];
+    } finally {
+        loading = false;
+    }
+};
+
+messageList.addEventListener("scroll", () => {
+    if (messageList.scrollTop < 50) {
+        loadOlderMessages();
+    }
+});
+
+// Append a new message unless it is already shown (the sender gets it from both the send request and the stream)
+let appendMessage = message => {
+    if (messageList.querySelector(`[data-message-id="${message["message_id"]}"]`)) {
+        return;
+    }
+    let atBottom = messageList.scrollHeight - messageList.scrollTop - messageList.clientHeight < 50;
+    messageList.appendChild(createMessage(message));
+    if (atBottom) {
+        messageList.scrollTop = messageList.scrollHeight;
+    }
+};
+
+// Send messages in the background, the server answers with just the new message
+messageForm.addEventListener("submit", async event => {
+    event.preventDefault();
+    let response = await fetch(messageForm.action, {
+        method: "POST",
+        body: new FormData(messageForm),
+        headers: { "Accept": "application/json" },
+    });
+    if (response.ok) {
+        appendMessage(await response.json());
+        messageForm.reset();
+    }
+});
+
+document.addEventListener("project:message", event => {
+    appendMessage(event.detail);
+    unread = true;
+});
+
+// Report pushed messages as read once the user switches away, a beacon still goes out while the page unloads
+document.addEventListener("visibilitychange", () => {
+    if (document.visibilityState === "hidden" && unread) {
+        unread = false;
+        navigator.sendBeacon(messageList.dataset.readUrl);
+    }
+});
+
+// Start at the newest message
+messageList.scrollTop = messageList.scrollHeight;
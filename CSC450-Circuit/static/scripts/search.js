@@ -0,0 +1,64 @@
+"use strict";
+
+// This script runs full-text searches against the project's search endpoint and lists the hits under the chat.
+// Highlighted text arrives as HTML that the server already escaped, with the matched words wrapped in <mark>.
+
+const searchForm = document.getElementById("search_form");
+const searchResults = document.getElementById("search_results");
+const searchMore = document.getElementById("search_more");
+
+let nextSearch = null;
+
+// Create a hit element for a message or a task
+let createHit = (hit, type) => {
+    let hitItem = document.createElement("div");
+    hitItem.classList.add("search_hit");
+
+    let heading = document.createElement("strong");
+    let text = document.createElement("div");
+    if (type === "messages") {
+        heading.textContent = `${hit["message"]["sender_name"]} ${hit["message"]["date"]} ${hit["message"]["time"]}`;
+        text.innerHTML = hit["highlight"];
+    } else {
+        heading.innerHTML = hit["highlight"];
+        text.innerHTML = hit["snippet"] || "";
+    }
+    hitItem.appendChild(heading);
+    hitItem.appendChild(text);
+    return hitItem;
+};
+
+// Fetch one page of hits and append it, the first page replaces the previous search
+let runSearch = async (params, offset) => {
+    params.set("offset", offset);
+    let response = await fetch(`${searchForm.dataset.searchUrl}?${params}`);
+    if (!response.ok) {
+        return;
+    }
+    let page = await response.json();
+
+    if (offset === 0) {
+        searchResults.replaceChildren();
+    }
+    let fragment = document.createDocumentFragment();
+    page["hits"].forEach(hit => fragment.appendChild(createHit(hit, page["type"])));
+    if (offset === 0 && page["hits"].length === 0) {
+        fragment.appendChild(document.createTextNode("No results"));
+    }
+    searchResults.appendChild(fragment);
+    searchResults.hidden = false;
+
+    nextSearch = page["next_offset"] === null ? null : () => runSearch(params, page["next_offset"]);
+    searchMore.hidden = nextSearch === null;
+};
+
+searchForm.addEventListener("submit", event => {
+    event.preventDefault();
+    runSearch(new URLSearchParams(new FormData(searchForm)), 0);
+});
+
+searchMore.addEventListener("click", () => {
+    if (nextSearch) {
+        nextSearch();
+    }
+});
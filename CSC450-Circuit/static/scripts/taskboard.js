@@ -1,12 +1,20 @@
 "use strict";
 
 // This script is used to create a taskboard for a project management application.
-// It includes functionality to build the task board, create task pop-up modals, and event listeners for clicking on tasks.
+// It includes functionality to build the task board, fill in the task pop-up modal, and event listeners for clicking on tasks.
+// Tasks are indexed by ID, and each column only creates elements for the tasks scrolled into view, so a board with
+// thousands of tasks builds quickly and keeps a small DOM. Every task opens the same modal, filled in on click.
+// Status changes and deletions go through the JSON task API, and the board is kept current by fetching only
+// the tasks changed since the version it last saw.
 
 const variables = document.getElementById("variables");
 
-const projectId   = variables.dataset.projectId;
-const tasks   = JSON.parse(variables.dataset.tasks);
+const tasksUrl    = variables.dataset.tasksUrl;
+
+// Task ID -> task, in board order
+const tasks = new Map(JSON.parse(variables.dataset.tasks).map(task => [task["task_id"], task]));
+
+let version = Number(variables.dataset.version);
 
 const statuses = {};
 statuses['todo'] = 'To Do';
@@ -15,107 +23,193 @@ statuses['inProgress'] = 'In Progress';
 statuses['testing'] = 'Testing';
 statuses['done'] = 'Done';
 
-let columns = document.querySelectorAll(".task_list");
+// Height of one task in pixels, including the gap below it. Must match .task_list li in project.css
+const ROW_HEIGHT = 48;
 
-// Build the taskboard
-tasks.forEach(task => {
-    // Create new element format
-    let taskItem = document.createElement("li");
-    let anchor = document.createElement("a");
-    anchor.href = "#";
-    anchor.textContent = task["task_title"];
-    anchor.classList.add("taskModal")
-    anchor.setAttribute("data-bs-toggle", "modal");
-    anchor.setAttribute("data-bs-target", "#taskModal");
-    anchor.setAttribute("id", task["task_id"]);
-    anchor.setAttribute("data-description", task["task_description"]);
-    anchor.setAttribute("data-status", task["task_status"]);
-    taskItem.appendChild(anchor);
-
-    // Add task to the correct column
-    columns.forEach(column => {
-        if (column.id === task["task_status"] + "_list") {
-            column.appendChild(taskItem);
-        }
+// Tasks rendered above and below the visible ones, so scrolling doesn't show blank rows before the next frame
+const OVERSCAN = 10;
+
+// Per status: its list, a spacer giving the list the height of all its tasks, the IDs of its tasks in order and the
+// range of them currently rendered
+const columns = {};
+
+// Render the tasks of a column that are scrolled into view, in one DocumentFragment
+let renderColumn = (column, force) => {
+    let visibleHeight = column.list.clientHeight || window.innerHeight;
+    let first = Math.max(0, Math.floor(column.list.scrollTop / ROW_HEIGHT) - OVERSCAN);
+    let last = Math.min(column.taskIds.length, Math.ceil((column.list.scrollTop + visibleHeight) / ROW_HEIGHT) + OVERSCAN);
+    if (!force && first === column.first && last === column.last) {
+        return;
+    }
+    column.first = first;
+    column.last = last;
+
+    let fragment = document.createDocumentFragment();
+    for (let index = first; index < last; index++) {
+        let task = tasks.get(column.taskIds[index]);
+        let taskItem = document.createElement("li");
+        taskItem.style.top = `${index * ROW_HEIGHT}px`;
+        let anchor = document.createElement("a");
+        anchor.href = "#";
+        anchor.className = "taskModal";
+        anchor.textContent = task["task_title"];
+        anchor.title = task["task_title"];
+        anchor.dataset.taskId = task["task_id"];
+        taskItem.appendChild(anchor);
+        fragment.appendChild(taskItem);
+    }
+    column.spacer.style.height = `${column.taskIds.length * ROW_HEIGHT}px`;
+    column.list.replaceChildren(column.spacer, fragment);
+};
+
+// Re-render a column at most once per frame while it scrolls
+let scheduleRender = column => {
+    if (column.scheduled) {
+        return;
+    }
+    column.scheduled = true;
+    requestAnimationFrame(() => {
+        column.scheduled = false;
+        renderColumn(column, false);
     });
+};
+
+Object.keys(statuses).forEach(status => {
+    let column = { list: document.getElementById(`${status}_list`), spacer: document.createElement("li"), taskIds: [], first: 0, last: 0, scheduled: false };
+    column.spacer.className = "task_spacer";
+    column.list.addEventListener("scroll", () => scheduleRender(column), { passive: true });
+    columns[status] = column;
 });
 
-// Create modal format
-let createModal = (taskId, taskTitle, taskDescription, taskStatus) => {
-    const modal = document.createElement("div");
-    modal.classList.add("modal", "fade");
-    modal.id = `taskModal-${taskId}`;
-    modal.tabIndex = -1;
-    modal.setAttribute("aria-labelledby", `taskModalLabel-${taskId}`);
-    modal.setAttribute("aria-hidden", "true");
-
-    let taskAssignees = () => {
-        let taskAssigneeList = [];
-        for (let i = 0; i < tasks.length; i++) {
-            if (tasks[i]["task_id"] == taskId) {
-                taskAssigneeList = tasks[i]["assigned_members"];
-            }
+// Build the taskboard
+let buildBoard = () => {
+    Object.values(columns).forEach(column => {
+        column.taskIds = [];
+    });
+
+    // Add each task to the column of its status
+    tasks.forEach(task => {
+        let column = columns[task["task_status"]];
+        if (column) {
+            column.taskIds.push(task["task_id"]);
         }
-        return taskAssigneeList;
-    };
+    });
 
-    let assignedMemberString = "";
-    taskAssignees().forEach(assignee => {
-        assignedMemberString += "<li>" + assignee + "</li>";
+    Object.values(columns).forEach(column => {
+        renderColumn(column, true);
     });
+};
+
+buildBoard();
 
-    // Modal content
-    modal.innerHTML = `
-        <div class="modal-dialog">
-            <div class="modal-content">
-                <div class="modal-header">
-                    <h5 class="modal-title" id="taskModalLabel-${taskId}">${taskTitle}</h5>
-                    <button type="button" class="btn-close" data-bs-dismiss="modal" aria-label="Close"></button>
-                </div>
-                <div class="modal-body">
-                    <p>${taskDescription}</p>
-                    <h5>Assignees</h5>
-                    <ul>
-                        ${assignedMemberString}
-                    </ul>
-                    <p><strong>Status:</strong> ${statuses[taskStatus]}</p>
-                    <h5>Change Status</h5>
-                    <form action="change_status" method="POST">
-                        <input type="hidden" name="project_id" value="${projectId}">
-                        <input type="hidden" name="task_id" value="${taskId}">
-                        <select name="task_status" class="form-select">
-                            <option value="todo" ${taskStatus === "todo" ? "selected" : ""}>To Do</option>
-                            <option value="designing" ${taskStatus === "designing" ? "selected" : ""}>Designing</option>
-                            <option value="inProgress" ${taskStatus === "inProgress" ? "selected" : ""}>In Progress</option>
-                            <option value="testing" ${taskStatus === "testing" ? "selected" : ""}>Testing</option>
-                            <option value="done" ${taskStatus === "done" ? "selected" : ""}>Done</option>
-                        </select>
-                        <button type="submit" id="change_status_btn" class="btn btn-primary">Change Status</button>
-                    </form>
-                    <form action="delete_task" method="POST">
-                        <input type="hidden" name="project_id" value="${projectId}">
-                        <input type="hidden" name="task_id" value="${taskId}">
-                        <button type="submit" id="delete_task_btn" class="btn btn-danger">Delete Task</button>
-                    </form>
-                
-                </div>
-                <div class="modal-footer">
-                    <button type="button" class="btn btn-secondary" data-bs-dismiss="modal">Close</button>
-                </div>
-            </div>
-        </div>
-    `;
-    return modal;
+// The one task modal and the parts of it that change with the task
+const taskModal = document.getElementById("taskModal");
+const taskModalParts = {
+    title: document.getElementById("taskModalLabel"),
+    description: document.getElementById("task_modal_description"),
+    assignees: document.getElementById("task_modal_assignees"),
+    status: document.getElementById("task_modal_status"),
+    statusSelect: document.getElementById("task_modal_status_select"),
+    taskIds: [document.getElementById("task_modal_change_id"), document.getElementById("task_modal_delete_id")],
+};
+
+// Fill in the task modal for a task
+let openTask = taskId => {
+    let task = tasks.get(taskId);
+    if (!task) {
+        return false;
+    }
+
+    taskModalParts.title.textContent = task["task_title"];
+    taskModalParts.description.textContent = task["task_description"];
+    let assignees = document.createDocumentFragment();
+    (task["assigned_members"] || []).forEach(assignee => {
+        let item = document.createElement("li");
+        item.textContent = assignee;
+        assignees.appendChild(item);
+    });
+    taskModalParts.assignees.replaceChildren(assignees);
+    taskModalParts.status.textContent = statuses[task["task_status"]];
+    taskModalParts.statusSelect.value = task["task_status"];
+    taskModalParts.taskIds.forEach(input => {
+        input.value = task["task_id"];
+    });
+    return true;
 };
 
 // Add event listeners to task items
-// This will create a modal when a task is clicked
-let taskItems = document.querySelectorAll(".taskModal");
-taskItems.forEach(taskItem => {
-    taskItem.addEventListener("click", () => {
-        document.querySelector("body").appendChild(createModal(taskItem.id, taskItem.textContent, taskItem.dataset.description, taskItem.dataset.status));
-        let modalStructure = document.getElementById(`taskModal-${taskItem.id}`);
-        let modal = new bootstrap.Modal(modalStructure);
-        modal.show();
+// This will open the task modal when a task is clicked
+let columnsElement = document.getElementById("columns");
+columnsElement.addEventListener("click", event => {
+    let taskItem = event.target.closest(".taskModal");
+    if (!taskItem) {
+        return;
+    }
+    event.preventDefault();
+    if (openTask(Number(taskItem.dataset.taskId))) {
+        bootstrap.Modal.getOrCreateInstance(taskModal).show();
+    }
+});
+
+// Fetch the tasks changed since the version the board has and merge them in
+let syncing = false;
+let syncAgain = false;
+let sync = async () => {
+    if (syncing) {
+        syncAgain = true;
+        return;
+    }
+    syncing = true;
+    try {
+        let response = await fetch(`${tasksUrl}?since=${version}`);
+        if (!response.ok) {
+            return;
+        }
+        let changes = await response.json();
+
+        // The whole board comes back when the deletions since our version are no longer known
+        if (changes["full"]) {
+            tasks.clear();
+        }
+        changes["tasks"].forEach(changed => {
+            tasks.set(changed["task_id"], changed);
+        });
+        changes["deleted"].forEach(taskId => {
+            tasks.delete(taskId);
+        });
+        version = changes["version"];
+        buildBoard();
+    } finally {
+        syncing = false;
+        if (syncAgain) {
+            syncAgain = false;
+            sync();
+        }
+    }
+};
+
+// Send status changes and deletions to the JSON API instead of reloading the page
+document.addEventListener("submit", async event => {
+    let form = event.target;
+    let request;
+    if (form.classList.contains("change_status_form")) {
+        request = { method: "PATCH", body: JSON.stringify({ task_status: form.elements["task_status"].value }) };
+    } else if (form.classList.contains("delete_task_form")) {
+        request = { method: "DELETE" };
+    } else {
+        return;
+    }
+    event.preventDefault();
+
+    let response = await fetch(`${tasksUrl}/${form.elements["task_id"].value}`, {
+        ...request,
+        headers: { "Content-Type": "application/json" },
     });
-});
\ No newline at end of file
+    if (response.ok) {
+        bootstrap.Modal.getInstance(form.closest(".modal")).hide();
+        sync();
+    }
+});
+
+// Task changes pushed by live.js, from this or another member
+document.addEventListener("project:task", () => sync());
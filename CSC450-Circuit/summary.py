@@ -0,0 +1,32 @@
+import argparse
+import json
+import create_db
+import db
+
+# Checks the dashboard counters against the tables they summarize
+# Project_Summary is kept up to date by triggers inside the same transactions as the writes it counts, so it should
+# never drift. Rows written with the triggers missing, e.g. by hand or from a restored copy of a table, are found here
+# `python summary.py` lists the differences, `python summary.py --rebuild` recomputes the projects that drifted and
+# `--rebuild --all` every project
+
+def main():
+    parser = argparse.ArgumentParser(description='Verify or rebuild the per-project dashboard counters.')
+    parser.add_argument('--rebuild', action='store_true', help='recompute the projects whose counters drifted')
+    parser.add_argument('--all', action='store_true', help='with --rebuild, recompute every project')
+    args = parser.parse_args()
+
+    create_db.create_db(db.db_path)
+    drift = db.verify_project_summaries()
+    result = {'drift': [dict(zip(('project_id', 'column', 'stored', 'expected'), row)) for row in drift]}
+
+    if args.rebuild:
+        project_ids = None if args.all else sorted({row[0] for row in drift})
+        result['rebuilt'] = db.rebuild_project_summaries(project_ids) if project_ids != [] else 0
+        result['remaining_drift'] = len(db.verify_project_summaries())
+    db.writer.close()
+
+    print(json.dumps(result, indent=2))
+    raise SystemExit(1 if drift and not args.rebuild else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+import metrics
+
+# Single writer with group commit
+# SQLite lets one connection write at a time, so requests writing on their own connections queue for the write lock,
+# each paying for its own commit, and give up with "database is locked" when a burst lasts longer than busy_timeout.
+# Instead every write in db.py is a function of a cursor, handed to one writer thread that owns the only connection
+# that writes. The writer takes everything queued, up to WRITE_BATCH_SIZE operations, runs it in one transaction with
+# each operation in its own savepoint, so a failing one is rolled back alone, and commits once for the whole batch.
+# Callers wait on a future that is resolved once their write is committed
+# A write that finds the queue empty is committed straight away, and the writes that arrive meanwhile make up the next
+# batch. With WRITE_MAX_WAIT_MS set, a batch that already has several writes waits that long for more to join, which
+# pays off when commits are expensive (synchronous = FULL, slow disks) and only adds latency when they are not
+
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', 64))
+WRITE_MAX_WAIT = float(os.getenv('WRITE_MAX_WAIT_MS', 0)) / 1000
+
+# Seconds a caller waits for its write to be committed
+WRITE_TIMEOUT = float(os.getenv('WRITE_TIMEOUT', 10))
+
+
+class Writer:
+    '''Runs write operations on a dedicated thread and commits them in batches.'''
+
+    def __init__(self, connect, batch_size=WRITE_BATCH_SIZE, max_wait=WRITE_MAX_WAIT, timeout=WRITE_TIMEOUT):
+        self._connect = connect  # Opens the writing connection, on the writer thread
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.batches = 0  # Transactions committed
+        self.operations = 0  # Operations run in them
+        self.largest_batch = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _start(self):
+        # Started on first use. A forked worker process has no writer thread even if its parent had one
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    @property
+    def queued(self):
+        '''Number of operations waiting for the writer.'''
+        return self._queue.qsize()
+
+    def submit(self, operation, *args):
+        '''Queue `operation(cursor, *args)`. Returns a future for its result, set once it is committed.'''
+        if self._pid != os.getpid():
+            self._start()
+        future = Future()
+        self._queue.put((operation, args, future))
+        return future
+
+    @metrics.timed('db')
+    def run(self, operation, *args):
+        '''Run `operation(cursor, *args)` in the writer's next batch and return its result once it is committed.
+
+        The operation must not commit or roll back itself. Its exceptions are raised here, after its changes have been
+        rolled back. Raises sqlite3.OperationalError if the write isn't committed within the timeout.
+        '''
+        future = self.submit(operation, *args)
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            if future.cancel():
+                raise sqlite3.OperationalError('Timed out waiting for the database writer')
+            return future.result()  # Already in a transaction that is about to commit
+
+    def close(self):
+        '''Commit what is queued and stop the writer thread.'''
+        if self._thread is not None and self._pid == os.getpid():
+            self._queue.put(None)
+            self._thread.join()
+        self._thread = self._pid = None
+
+    def _next_batch(self):
+        '''Wait for the next operation and take whatever is queued with it. None when the writer is closed.'''
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = None
+        while len(batch) < self.batch_size:
+            try:
+                if deadline is None:
+                    item = self._queue.get_nowait()
+                else:
+                    item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                if deadline is not None or len(batch) == 1 or self.max_wait <= 0:
+                    break
+                # Writes are arriving together, give the ones on their way a moment to join
+                deadline = time.monotonic() + self.max_wait
+                continue
+            if item is None:
+                self._queue.put(None)  # Close after this batch
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        conn = self._connect()
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            self._commit(conn, batch)
+        conn.close()
+
+    def _commit(self, conn, batch):
+        results = []
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            for operation, args, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue  # The caller gave up waiting
+                cursor.execute('SAVEPOINT operation')
+                try:
+                    results.append((future, operation(cursor, *args), None))
+                except Exception as error:
+                    cursor.execute('ROLLBACK TO operation')
+                    results.append((future, None, error))
+                cursor.execute('RELEASE operation')
+            conn.commit()
+        except Exception as error:
+            # Nothing in the batch was committed
+            if conn.in_transaction:
+                conn.rollback()
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+        self.batches += 1
+        self.operations += len(results)
+        self.largest_batch = max(self.largest_batch, len(results))